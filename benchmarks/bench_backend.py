@@ -0,0 +1,108 @@
+"""Benchmarks the chromadb backend offline: ingestion through `embed_documents`, `/query` under concurrent load and
+the same questions through `/query/batch`.
+
+Vertex AI is replaced by the fakes, everything else (splitting, the vector store, the chains, FastAPI) is real.
+Run it in the backend's environment, e.g. `make bench` in knowledge-worker-chromadb/backend.
+"""
+import argparse
+import asyncio
+import functools
+import os
+import sys
+import tempfile
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+BACKEND_DIR = os.path.join(BENCHMARKS_DIR, os.pardir, "knowledge-worker-chromadb", "backend")
+
+sys.path[:0] = [BENCHMARKS_DIR, os.path.abspath(BACKEND_DIR)]
+
+import fakes  # noqa: E402
+import harness  # noqa: E402
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--documents", type=int, default=200, help="pages ingested")
+    parser.add_argument("--words", type=int, default=400, help="words per page")
+    parser.add_argument("--ingest-batches", type=int, default=10, help="embed_documents calls the pages are split into")
+    parser.add_argument("--queries", type=int, default=200, help="/query requests")
+    parser.add_argument("--concurrency", type=int, default=16, help="concurrent /query requests")
+    parser.add_argument("--batch-size", type=int, default=100, help="questions per /query/batch request")
+    parser.add_argument("--embedding-latency", type=float, default=0.05, help="seconds per embeddings request")
+    parser.add_argument("--llm-latency", type=float, default=0.5, help="seconds per LLM call")
+    parser.add_argument("--vector-store", default="chroma", choices=["chroma", "mmap"])
+    parser.add_argument("--no-trace-memory", action="store_true", help="don't trace peak Python memory")
+    parser.add_argument("--output", help="write the JSON report to this file instead of stdout")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+
+    # The backend persists its store relative to the working directory, and reads its settings on import
+    os.chdir(tempfile.mkdtemp(prefix="bench-backend-"))
+    os.environ.setdefault("BACKEND_URL", "https://example.com/")
+    os.environ["INGEST_MODE"] = "full"
+    os.environ["VECTOR_STORE"] = args.vector_store
+
+    import api
+    import chains
+
+    chains.VertexAIEmbeddings = functools.partial(fakes.FakeEmbeddings, latency=args.embedding_latency)
+    chains.ChatVertexAI = functools.partial(fakes.FakeChatModel, latency=args.llm_latency)
+
+    harness.start_memory_tracing(not args.no_trace_memory)
+    results = [bench_ingest(chains, args), *asyncio.run(bench_query(api, args))]
+    harness.report(results, vars(args), args.output)
+
+
+def bench_ingest(chains, args):
+    documents = fakes.fake_documents(args.documents, words=args.words)
+    batch_size = -(-len(documents) // args.ingest_batches)
+    vector_store = chains.get_vector_store()
+
+    def ingest(i):
+        chains.embed_documents(vector_store, documents[i * batch_size : (i + 1) * batch_size])
+
+    return harness.measure("backend.embed_documents", ingest, args.ingest_batches, items=batch_size)
+
+
+async def bench_query(api, args):
+    import httpx
+
+    # The store exists now, so the startup hook only warms the shared chain, in the background
+    await api.startup_event()
+    while not api.index_loaded.is_set():
+        await asyncio.sleep(0.01)
+
+    transport = httpx.ASGITransport(app=api.app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://benchmark", timeout=None) as client:
+
+        async def query(i):
+            response = await client.post(
+                "/query", json={"question": f"What does {fakes.fake_text(i, 8)} mean?", "chat_history": []}
+            )
+            response.raise_for_status()
+
+        async def batch(i):
+            questions = [
+                {"question": f"What does {fakes.fake_text(args.queries + j, 8)} mean?", "chat_history": []}
+                for j in range(i * args.batch_size, (i + 1) * args.batch_size)
+            ]
+            async with client.stream("POST", "/query/batch", json={"questions": questions}) as response:
+                response.raise_for_status()
+                async for line in response.aiter_lines():
+                    if line and '"error"' in line:
+                        raise RuntimeError(line)
+
+        # Distinct questions from the /query run, so neither cache serves them
+        return [
+            await harness.ameasure("backend.api_query", query, args.queries, args.concurrency),
+            await harness.ameasure(
+                "backend.api_query_batch", batch, max(args.queries // args.batch_size, 1), items=args.batch_size
+            ),
+        ]
+
+
+if __name__ == "__main__":
+    main()
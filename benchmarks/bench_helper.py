@@ -0,0 +1,125 @@
+"""Benchmarks the hackathon helper offline: `CustomVertexAIEmbeddings.embed_documents` and `EnterpriseSearchRetriever`.
+
+The Vertex AI embedding model and the Discovery Engine clients are replaced by the fakes.
+Run it in the helper's environment, e.g. `make bench` in dt_gen_ai_hackathon_helper.
+"""
+import argparse
+import asyncio
+import functools
+import os
+import sys
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+HELPER_DIR = os.path.join(
+    BENCHMARKS_DIR, os.pardir, "knowledge-worker-vertex-ai-search-hackathon", "dt_gen_ai_hackathon_helper"
+)
+
+sys.path[:0] = [BENCHMARKS_DIR, os.path.abspath(HELPER_DIR)]
+
+import fakes  # noqa: E402
+import harness  # noqa: E402
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--texts", type=int, default=500, help="texts per embed_documents call")
+    parser.add_argument("--embed-runs", type=int, default=5, help="embed_documents calls")
+    parser.add_argument("--embedding-latency", type=float, default=0.05, help="seconds per embeddings request")
+    parser.add_argument("--embedding-concurrency", type=int, default=4, help="embeddings requests in flight")
+    parser.add_argument("--requests-per-minute", type=int, default=100000, help="embeddings rate limit")
+    parser.add_argument("--searches", type=int, default=200, help="searches per retriever benchmark")
+    parser.add_argument("--concurrency", type=int, default=16, help="concurrent searches")
+    parser.add_argument("--search-latency", type=float, default=0.3, help="seconds per search request")
+    parser.add_argument("--k", type=int, default=100, help="search results per query")
+    parser.add_argument("--no-trace-memory", action="store_true", help="don't trace peak Python memory")
+    parser.add_argument("--output", help="write the JSON report to this file instead of stdout")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    harness.start_memory_tracing(not args.no_trace_memory)
+
+    results = [bench_embed_documents(args)]
+    results.extend(bench_enterprise_search(args))
+    harness.report(results, vars(args), args.output)
+
+
+def bench_embed_documents(args):
+    from dt_gen_ai_hackathon_helper.embeddings.embeddings import CustomVertexAIEmbeddings
+
+    # construct() skips the validator, which would connect to Vertex AI to create the client
+    embeddings = CustomVertexAIEmbeddings.construct(
+        requests_per_minute=args.requests_per_minute,
+        num_instances_per_batch=5,
+        max_concurrent_requests=args.embedding_concurrency,
+        client=fakes.FakeTextEmbeddingModel(latency=args.embedding_latency),
+    )
+    texts = [fakes.fake_text(i, 200) for i in range(args.texts)]
+
+    result = harness.measure(
+        "helper.embed_documents",
+        lambda i: embeddings.embed_documents(texts),
+        args.embed_runs,
+        items=len(texts),
+    )
+    # Time spent stalled by --requests-per-minute, as opposed to waiting on the (fake) model
+    result["rate_limit_wait_seconds"] = round(embeddings.rate_limit_wait_seconds, 3)
+    result["embedding_request_seconds"] = round(embeddings.embedding_request_seconds, 3)
+    return result
+
+
+def bench_enterprise_search(args):
+    try:
+        from google.cloud import discoveryengine_v1beta
+
+        from dt_gen_ai_hackathon_helper.enterprise_search.enterprise_search import EnterpriseSearchRetriever
+    except ImportError as e:
+        return [harness.skipped("helper.enterprise_search", str(e))]
+
+    client = functools.partial(fakes.FakeSearchServiceClient, latency=args.search_latency)
+    async_client = functools.partial(fakes.FakeSearchServiceAsyncClient, latency=args.search_latency)
+    with fakes.patched(discoveryengine_v1beta, "SearchServiceClient", client), fakes.patched(
+        discoveryengine_v1beta, "SearchServiceAsyncClient", async_client
+    ):
+        # Every query is distinct, so the search cache doesn't hide the cost of searching
+        retriever = EnterpriseSearchRetriever(
+            project_id="benchmark",
+            search_engine_id="benchmark",
+            location_id="global",
+            max_snippet_count=3,
+            k=args.k,
+        )
+
+        def query(i):
+            return f"What does {fakes.fake_text(i, 8)} mean?"
+
+        return [
+            harness.measure(
+                "helper.enterprise_search.get_relevant_documents",
+                lambda i: retriever.get_relevant_documents(query(i)),
+                args.searches,
+                args.concurrency,
+            ),
+            asyncio.run(
+                harness.ameasure(
+                    "helper.enterprise_search.aget_relevant_documents",
+                    lambda i: retriever.aget_relevant_documents(query(args.searches + i)),
+                    args.searches,
+                    args.concurrency,
+                )
+            ),
+            harness.measure(
+                "helper.enterprise_search.get_relevant_documents_for_queries",
+                lambda i: retriever.get_relevant_documents_for_queries(
+                    [query(2 * args.searches + 3 * i + variant) for variant in range(3)]
+                ),
+                args.searches // 3,
+                max(args.concurrency // 3, 1),
+                items=3,
+            ),
+        ]
+
+
+if __name__ == "__main__":
+    main()
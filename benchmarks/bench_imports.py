@@ -0,0 +1,137 @@
+"""Benchmarks the import time of the backend's serving entry point and of the helper's formatter, against a budget.
+
+Each module is imported in fresh interpreters with `python -X importtime`, and the median of its cumulative import
+time is compared to the budget. Modules which mustn't be imported at startup (e.g. LangChain, which alone takes
+seconds) fail the check whatever the time, and so do modules which fail to import. Exits with status 1 when a check
+fails, so it can gate CI; the backend's tests run the same checks (tests/test_imports.py).
+Run it in the environment of the target, e.g. `make importtime` in knowledge-worker-chromadb/backend.
+"""
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+BACKEND_DIR = os.path.join(BENCHMARKS_DIR, os.pardir, "knowledge-worker-chromadb", "backend")
+HELPER_DIR = os.path.join(
+    BENCHMARKS_DIR, os.pardir, "knowledge-worker-vertex-ai-search-hackathon", "dt_gen_ai_hackathon_helper"
+)
+
+sys.path.insert(0, BENCHMARKS_DIR)
+
+import harness  # noqa: E402
+
+# target -> (module imported, directory imported from, packages it mustn't import)
+TARGETS = {
+    "backend": ("main", BACKEND_DIR, ("langchain", "chromadb", "vertexai", "numpy")),
+    "helper": (
+        "dt_gen_ai_hackathon_helper.formatter_helper.formatter_helper",
+        HELPER_DIR,
+        ("langchain", "pandas", "IPython"),
+    ),
+}
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--target", choices=sorted(TARGETS), action="append", help="targets measured (default: all)")
+    parser.add_argument("--runs", type=int, default=5, help="interpreters started per target")
+    parser.add_argument("--budget-ms", type=float, default=500, help="median import time allowed per target")
+    parser.add_argument("--top", type=int, default=10, help="slowest imports reported per target")
+    parser.add_argument("--output", help="write the JSON report to this file instead of stdout")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+
+    results = [bench_import(target, args) for target in args.target or sorted(TARGETS)]
+    harness.report(results, vars(args), args.output)
+
+    failures = [f"{result['name']}: {failure}" for result in results for failure in result.get("failures", [])]
+    for failure in failures:
+        print(failure, file=sys.stderr)
+    sys.exit(1 if failures else 0)
+
+
+def bench_import(target, args):
+    module, directory, forbidden = TARGETS[target]
+    return check_import(module, directory, forbidden, args.runs, args.budget_ms, args.top, name=f"imports.{target}")
+
+
+def check_import(module, directory, forbidden=(), runs=5, budget_ms=500, top=10, name=None):
+    """Import `module` from `directory` in `runs` fresh interpreters, and list what fails the checks in "failures".
+
+    A module which can't be imported fails the check too, its error is printed.
+    """
+    name = name or f"imports.{module}"
+    import_ms, imported, slowest = [], set(), {}
+    for _ in range(runs):
+        timings, modules, error = _import(module, directory)
+        if error is not None:
+            print(error, file=sys.stderr)
+            error_line = error.strip().splitlines()[-1] if error.strip() else "no output"
+            return {"name": name, "module": module, "failures": [f"importing {module} failed: {error_line}"]}
+        import_ms.append(timings[module][1] / 1000)
+        imported |= modules
+        for imported_module, (self_us, _) in timings.items():
+            slowest[imported_module] = max(slowest.get(imported_module, 0), self_us)
+
+    median_ms = statistics.median(import_ms)
+    failures = []
+    if median_ms > budget_ms:
+        failures.append(f"importing {module} took {median_ms:.1f}ms, over the budget of {budget_ms:g}ms")
+    for package in sorted({imported_module.split(".")[0] for imported_module in imported} & set(forbidden)):
+        failures.append(f"importing {module} imported {package}")
+
+    return {
+        "name": name,
+        "module": module,
+        "runs": runs,
+        "import_ms_p50": round(median_ms, 3),
+        "import_ms_min": round(min(import_ms), 3),
+        "import_ms_max": round(max(import_ms), 3),
+        "budget_ms": budget_ms,
+        # Time spent in the module itself, excluding what it imports
+        "slowest_ms": {
+            imported_module: round(self_us / 1000, 3)
+            for imported_module, self_us in sorted(slowest.items(), key=lambda item: -item[1])[:top]
+        },
+        "failures": failures,
+    }
+
+
+def _import(module, directory):
+    # A fresh interpreter per run, so no import is cached. Returns {module: (self µs, cumulative µs)}, the modules
+    # imported, which include the ones imported before the first measured import (e.g. by the site module), and the
+    # interpreter's output when the import failed.
+    process = subprocess.run(
+        [
+            sys.executable,
+            "-X",
+            "importtime",
+            "-c",
+            f"import sys, {module}; print('\\n'.join(sys.modules))",
+        ],
+        cwd=directory,
+        # The backend reads its settings on import
+        env={"BACKEND_URL": "https://example.com/", **os.environ},
+        capture_output=True,
+        text=True,
+    )
+    if process.returncode:
+        # Without the import times, which precede the traceback
+        return {}, set(), "\n".join(line for line in process.stderr.splitlines() if not line.startswith("import time:"))
+
+    timings = {}
+    for line in process.stderr.splitlines():
+        if not line.startswith("import time:") or "[us]" in line:
+            continue
+        self_us, cumulative_us, imported_module = line[len("import time:") :].split("|")
+        timings[imported_module.strip()] = (int(self_us), int(cumulative_us))
+    return timings, set(process.stdout.split()), None
+
+
+if __name__ == "__main__":
+    main()
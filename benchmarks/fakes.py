@@ -0,0 +1,208 @@
+"""Deterministic, latency-configurable stand-ins for the Vertex AI and Discovery Engine clients.
+
+Outputs only depend on the inputs, so two runs of a benchmark do the same work. Latencies are simulated with
+`time.sleep` (or `asyncio.sleep`), which releases the GIL like a network call would.
+"""
+import asyncio
+import contextlib
+import hashlib
+import threading
+import time
+from types import SimpleNamespace
+from typing import Any, List, Optional
+
+import numpy as np
+from langchain.callbacks.manager import CallbackManagerForLLMRun
+from langchain.chat_models.base import BaseChatModel
+from langchain.embeddings.base import Embeddings
+from langchain.llms.base import LLM
+from langchain.schema import AIMessage, ChatGeneration, ChatResult, Document
+
+WORDS = (
+    "data cloud model pipeline query vector search answer source document page team project platform "
+    "engineering analytics machine learning customer product service deploy monitor latency throughput"
+).split()
+
+
+def seeded_rng(*parts) -> np.random.Generator:
+    digest = hashlib.sha256("\0".join(map(str, parts)).encode("utf-8")).digest()
+    return np.random.default_rng(int.from_bytes(digest[:8], "little"))
+
+
+def fake_text(seed, words: int) -> str:
+    rng = seeded_rng("text", seed)
+    return " ".join(WORDS[i] for i in rng.integers(0, len(WORDS), size=words))
+
+
+def fake_embedding(text: str, dimensions: int) -> List[float]:
+    vector = seeded_rng("embedding", text).standard_normal(dimensions).astype(np.float32)
+    return (vector / np.linalg.norm(vector)).tolist()
+
+
+def fake_documents(count: int, words: int = 400, pages: int = 50) -> List[Document]:
+    """Web pages as returned by the loaders, spread over `pages` sources."""
+    return [
+        Document(
+            page_content=fake_text(i, words),
+            metadata={"source": f"https://example.com/page-{i % pages}/{i}", "title": f"Page {i}"},
+        )
+        for i in range(count)
+    ]
+
+
+class FakeEmbeddings(Embeddings):
+    """Stands in for VertexAIEmbeddings: one request per call, plus a cost per text."""
+
+    def __init__(self, latency: float = 0.05, latency_per_text: float = 0.0, dimensions: int = 768, **kwargs):
+        self.latency = latency
+        self.latency_per_text = latency_per_text
+        self.dimensions = dimensions
+        self.model_name = "fake-embeddings"
+        self.requests = 0
+        self._lock = threading.Lock()
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        self._request(len(texts))
+        return [fake_embedding(text, self.dimensions) for text in texts]
+
+    def embed_query(self, text: str) -> List[float]:
+        self._request(1)
+        return fake_embedding(text, self.dimensions)
+
+    def _request(self, texts):
+        with self._lock:
+            self.requests += 1
+        time.sleep(self.latency + self.latency_per_text * texts)
+
+
+class FakeTextEmbeddingModel:
+    """Stands in for vertexai's TextEmbeddingModel, the client of CustomVertexAIEmbeddings."""
+
+    def __init__(self, latency: float = 0.05, dimensions: int = 768, max_instances: int = 5):
+        self.latency = latency
+        self.dimensions = dimensions
+        self.max_instances = max_instances
+        self.requests = 0
+        self._lock = threading.Lock()
+
+    def get_embeddings(self, texts: List[str]):
+        # The API rejects larger requests, so a regression in batching fails loudly
+        if len(texts) > self.max_instances:
+            raise ValueError(f"{len(texts)} instances exceed the limit of {self.max_instances} per request")
+        with self._lock:
+            self.requests += 1
+        time.sleep(self.latency)
+        return [SimpleNamespace(values=fake_embedding(text, self.dimensions)) for text in texts]
+
+
+class FakeChatModel(BaseChatModel):
+    """Stands in for ChatVertexAI. Like it, async generation isn't supported unless `async_supported` is set.
+
+    Without async support it reports ChatVertexAI's model type, by which the backend tells sync-only models apart.
+    """
+
+    latency: float = 0.5
+    answer_words: int = 60
+    temperature: float = 0.0
+    async_supported: bool = False
+
+    @property
+    def _llm_type(self) -> str:
+        return "fake-chat" if self.async_supported else "vertexai"
+
+    def _generate(self, messages, stop=None, run_manager: Optional[CallbackManagerForLLMRun] = None, **kwargs):
+        time.sleep(self.latency)
+        return self._result(messages, run_manager)
+
+    async def _agenerate(self, messages, stop=None, run_manager=None, **kwargs):
+        if not self.async_supported:
+            raise NotImplementedError("Async generation not implemented for this LLM.")
+        await asyncio.sleep(self.latency)
+        return self._result(messages, None)
+
+    def _result(self, messages, run_manager):
+        text = fake_text(messages[-1].content, self.answer_words)
+        if run_manager:
+            for word in text.split():
+                run_manager.on_llm_new_token(word + " ")
+        return ChatResult(generations=[ChatGeneration(message=AIMessage(content=text))])
+
+
+class FakeLLM(LLM):
+    """Stands in for the VertexAI completion model."""
+
+    latency: float = 0.5
+    answer_words: int = 60
+    temperature: float = 0.0
+
+    @property
+    def _llm_type(self) -> str:
+        return "fake-llm"
+
+    def _call(self, prompt: str, stop=None, run_manager=None, **kwargs) -> str:
+        time.sleep(self.latency)
+        return fake_text(prompt, self.answer_words)
+
+    async def _acall(self, prompt: str, stop=None, run_manager=None, **kwargs) -> str:
+        await asyncio.sleep(self.latency)
+        return fake_text(prompt, self.answer_words)
+
+
+class FakeSearchServiceClient:
+    """Stands in for discoveryengine's SearchServiceClient, returning `page_size` results with snippets."""
+
+    def __init__(self, credentials: Any = None, latency: float = 0.3, snippets: int = 3, words: int = 40, **kwargs):
+        self.latency = latency
+        self.snippets = snippets
+        self.words = words
+        self.requests = 0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def serving_config_path(project, location, data_store, serving_config):
+        return (
+            f"projects/{project}/locations/{location}/collections/default_collection/"
+            f"dataStores/{data_store}/servingConfigs/{serving_config}"
+        )
+
+    def search(self, request):
+        with self._lock:
+            self.requests += 1
+        time.sleep(self.latency)
+        return self._response(request)
+
+    def _response(self, request):
+        results = []
+        for i in range(request.page_size):
+            document_id = seeded_rng("document", request.query, i).integers(0, 10**6)
+            derived_struct_data = {
+                "link": f"gs://bench-bucket/document-{document_id}.pdf",
+                "snippets": [
+                    {"snippet": fake_text((document_id, page), self.words), "pageNumber": page}
+                    for page in range(1, self.snippets + 1)
+                ],
+            }
+            results.append(
+                SimpleNamespace(document=SimpleNamespace(id=str(document_id), derived_struct_data=derived_struct_data))
+            )
+        return SimpleNamespace(results=results)
+
+
+class FakeSearchServiceAsyncClient(FakeSearchServiceClient):
+    """Stands in for discoveryengine's SearchServiceAsyncClient."""
+
+    async def search(self, request):
+        self.requests += 1
+        await asyncio.sleep(self.latency)
+        return self._response(request)
+
+
+@contextlib.contextmanager
+def patched(target, name: str, value):
+    """Temporarily replace an attribute, e.g. a client class of a module."""
+    original = getattr(target, name)
+    setattr(target, name, value)
+    try:
+        yield value
+    finally:
+        setattr(target, name, original)
@@ -0,0 +1,161 @@
+"""Latency, throughput and memory measurements, reported as JSON."""
+import asyncio
+import json
+import os
+import platform
+import resource
+import subprocess
+import sys
+import time
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+
+import numpy as np
+
+
+def measure(name: str, operation: Callable[[int], Any], iterations: int, concurrency: int = 1, items: int = 1):
+    """Run `operation(i)` for i in range(iterations) on `concurrency` threads and summarise its latencies.
+
+    `items` is the number of items (e.g. texts) processed by one operation, to report items per second.
+    """
+    latencies, errors = [], []
+
+    def timed(i):
+        started = time.perf_counter()
+        try:
+            operation(i)
+        except Exception as e:
+            errors.append(repr(e))
+        else:
+            latencies.append(time.perf_counter() - started)
+
+    _reset_peak_memory()
+    started = time.perf_counter()
+    if concurrency == 1:
+        for i in range(iterations):
+            timed(i)
+    else:
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            list(executor.map(timed, range(iterations)))
+    elapsed = time.perf_counter() - started
+
+    return summarise(name, latencies, errors, elapsed, concurrency, items)
+
+
+async def ameasure(
+    name: str, operation: Callable[[int], Awaitable[Any]], iterations: int, concurrency: int = 1, items: int = 1
+):
+    """Await `operation(i)` for i in range(iterations), at most `concurrency` at once, and summarise its latencies."""
+    latencies, errors = [], []
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def timed(i):
+        async with semaphore:
+            started = time.perf_counter()
+            try:
+                await operation(i)
+            except Exception as e:
+                errors.append(repr(e))
+            else:
+                latencies.append(time.perf_counter() - started)
+
+    _reset_peak_memory()
+    started = time.perf_counter()
+    await asyncio.gather(*(timed(i) for i in range(iterations)))
+    elapsed = time.perf_counter() - started
+
+    return summarise(name, latencies, errors, elapsed, concurrency, items)
+
+
+def summarise(name, latencies, errors, elapsed, concurrency, items) -> Dict[str, Any]:
+    latencies_ms = np.asarray(latencies) * 1000
+    result = {
+        "name": name,
+        "iterations": len(latencies) + len(errors),
+        "concurrency": concurrency,
+        "errors": len(errors),
+        "seconds": round(elapsed, 4),
+        "throughput_per_second": round(len(latencies) / elapsed, 3) if elapsed else None,
+        "items_per_second": round(len(latencies) * items / elapsed, 3) if elapsed else None,
+        "latency_ms": {
+            "mean": _round(latencies_ms.mean()) if len(latencies_ms) else None,
+            "p50": _percentile(latencies_ms, 50),
+            "p95": _percentile(latencies_ms, 95),
+            "p99": _percentile(latencies_ms, 99),
+            "max": _round(latencies_ms.max()) if len(latencies_ms) else None,
+        },
+        "peak_traced_memory_mb": _peak_memory_mb(),
+    }
+    if errors:
+        # The first few are enough to tell what broke
+        result["first_errors"] = errors[:3]
+    return result
+
+
+def skipped(name: str, reason: str) -> Dict[str, Any]:
+    return {"name": name, "skipped": reason}
+
+
+def report(benchmarks: List[Dict[str, Any]], config: Dict[str, Any], output: Optional[str] = None):
+    """Print (or write) the results with what's needed to compare them across commits."""
+    document = {
+        "commit": _git_commit(),
+        "timestamp": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "max_rss_mb": _max_rss_mb(),
+        "config": config,
+        "benchmarks": benchmarks,
+    }
+    text = json.dumps(document, indent=2)
+    if output:
+        with open(output, "w") as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+
+
+def start_memory_tracing(enabled: bool = True):
+    # Tracing allocations slows Python code down, but does so equally on every commit
+    if enabled:
+        tracemalloc.start()
+
+
+def _reset_peak_memory():
+    if tracemalloc.is_tracing():
+        tracemalloc.reset_peak()
+
+
+def _peak_memory_mb():
+    if not tracemalloc.is_tracing():
+        return None
+    return round(tracemalloc.get_traced_memory()[1] / 2**20, 2)
+
+
+def _max_rss_mb():
+    # Kilobytes on Linux, bytes on macOS
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return round(max_rss / (2**20 if sys.platform == "darwin" else 2**10), 2)
+
+
+def _percentile(values, percentile):
+    return _round(np.percentile(values, percentile)) if len(values) else None
+
+
+def _round(value):
+    return round(float(value), 3)
+
+
+def _git_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "HEAD"],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
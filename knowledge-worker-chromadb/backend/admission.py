@@ -0,0 +1,155 @@
+"""Admission control and request coalescing for the query endpoints."""
+import asyncio
+import contextlib
+import json
+import math
+import time
+from collections import defaultdict
+from typing import Any, Awaitable, Callable, Dict, Optional
+
+
+class Rejected(Exception):
+    """A request shed without being answered, with the status code and the seconds after which to retry."""
+
+    def __init__(self, status_code: int, retry_after: int, detail: str):
+        super().__init__(detail)
+        self.status_code = status_code
+        self.retry_after = retry_after
+        self.detail = detail
+
+
+class AdmissionController:
+    """Bounds the questions answered concurrently, the requests queued for a slot and the requests of each client.
+
+    Requests beyond the per-client limit are rejected with a 429, and requests finding the queue full, or still queued
+    after `queue_timeout` seconds, with a 503. Rejecting early keeps the latency of the admitted requests bounded under
+    a spike, instead of queueing requests until they time out or exhaust the Vertex AI quota.
+    Retry-After is estimated from the queue length and the average time a slot is held.
+
+    Arguments:
+        max_concurrency (int): The requests holding a slot, i.e. running a chain, at once.
+        max_queue (int): The requests waiting for a slot, 0 sheds every request finding no free slot.
+        queue_timeout (float): Seconds a request may wait for a slot.
+        client_limit (int): The requests of one client admitted or queued at once, 0 for no limit.
+    """
+
+    def __init__(self, max_concurrency: int, max_queue: int = 64, queue_timeout: float = 30.0, client_limit: int = 0):
+        self.max_concurrency = max_concurrency
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.client_limit = client_limit
+        self.queued = 0
+        self.rejected = defaultdict(int)
+        self._clients = defaultdict(int)
+        # Created lazily, so the semaphore binds to the loop serving the requests
+        self._semaphore = None
+        # Moving average of the seconds a slot is held
+        self._service_seconds = 1.0
+
+    @contextlib.contextmanager
+    def client(self, client_id: Optional[str]):
+        """Count a request towards the limit of its client, for as long as it's in flight."""
+        self.admit_client(client_id)
+        try:
+            yield
+        finally:
+            self.release_client(client_id)
+
+    def admit_client(self, client_id: Optional[str]):
+        if client_id is None:
+            return
+        if self.client_limit and self._clients[client_id] >= self.client_limit:
+            self.rejected["client_limit"] += 1
+            raise Rejected(429, 1, f"Too many concurrent requests for client {client_id}")
+        self._clients[client_id] += 1
+
+    def release_client(self, client_id: Optional[str]):
+        if client_id is None:
+            return
+        self._clients[client_id] -= 1
+        if not self._clients[client_id]:
+            del self._clients[client_id]
+
+    async def acquire(self):
+        """Wait for a slot, or raise Rejected when the queue is full or the wait times out. Returns when acquired."""
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.max_concurrency)
+
+        if not self._semaphore.locked():
+            # A free slot is taken without suspending, so requests arriving together see it taken
+            await self._semaphore.acquire()
+            return time.monotonic()
+
+        if self.queued >= self.max_queue:
+            self.rejected["queue_full"] += 1
+            raise Rejected(503, self.retry_after(), "The service is overloaded, retry later")
+
+        self.queued += 1
+        try:
+            await asyncio.wait_for(self._semaphore.acquire(), self.queue_timeout)
+        except asyncio.TimeoutError:
+            self.rejected["queue_timeout"] += 1
+            raise Rejected(503, self.retry_after(), "Timed out waiting for a free slot, retry later")
+        finally:
+            self.queued -= 1
+        return time.monotonic()
+
+    def release(self, acquired_at: float):
+        self._service_seconds = 0.9 * self._service_seconds + 0.1 * (time.monotonic() - acquired_at)
+        self._semaphore.release()
+
+    @contextlib.asynccontextmanager
+    async def slot(self):
+        acquired_at = await self.acquire()
+        try:
+            yield
+        finally:
+            self.release(acquired_at)
+
+    def retry_after(self) -> int:
+        # The time for the queue ahead to drain through the slots
+        return max(1, math.ceil((self.queued + 1) * self._service_seconds / self.max_concurrency))
+
+
+class SingleFlight:
+    """Coalesces concurrent calls with the same key into one execution, whose result (or error) they all share.
+
+    Only calls in flight at the same time are coalesced, nothing is kept once the leading call completes: repeating
+    an answer later is the answer cache's job.
+    """
+
+    def __init__(self):
+        self.coalesced = 0
+        self._calls: Dict[Any, asyncio.Future] = {}
+
+    async def run(self, key, func: Callable[[], Awaitable[Any]]):
+        call = self._calls.get(key)
+        if call is not None:
+            self.coalesced += 1
+            # A follower going away mustn't cancel the call the others are waiting on
+            return await asyncio.shield(call)
+
+        call = asyncio.ensure_future(func())
+        self._calls[key] = call
+        call.add_done_callback(lambda done: self._done(key, done))
+        return await asyncio.shield(call)
+
+    def _done(self, key, call):
+        self._calls.pop(key, None)
+        # Retrieve the error, the call may complete after every request waiting on it went away
+        if not call.cancelled():
+            call.exception()
+
+    def __len__(self):
+        return len(self._calls)
+
+
+def question_key(question: str, chat_history, **options) -> str:
+    """Questions differing only in whitespace or case, with the same history and options, share their answer."""
+    history = [[_normalise(str(text)) for text in turn] for turn in chat_history]
+    return json.dumps([_normalise(question), history, sorted(options.items())], default=str)
+
+
+def _normalise(text: str) -> str:
+    # As the helper's query_embedding_cache.normalise_query, without importing LangChain along with it
+    return " ".join(text.split()).lower()
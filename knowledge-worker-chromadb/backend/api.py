@@ -1,37 +1,393 @@
+import hmac
+import json
 import os
-from pathlib import Path
+import threading
+import traceback
+from typing import List, Optional
 
 import chains
-from fastapi import FastAPI, HTTPException
-from pydantic import BaseModel
+import metrics
+from admission import AdmissionController, Rejected, SingleFlight, question_key
+from fastapi import FastAPI, Header, HTTPException, Request
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse, PlainTextResponse, StreamingResponse
+from ingestion_jobs import IngestionJobs, JobAlreadyRunning
+from pydantic import BaseModel, Field, validator
+from starlette.background import BackgroundTask
+from store_pool import CollectionNotFound, validate_collection_name
 
 WEBSITE = os.environ["BACKEND_URL"]
+DEFAULT_TEMPERATURE = float(os.environ.get("DEFAULT_TEMPERATURE", 0.0))
+DEFAULT_K = int(os.environ.get("DEFAULT_K", 4))
+# "full" only ingests the website when there is no persisted store, "sync" re-ingests what changed on every start.
+# Either way ingestion runs in the background, and /ready fails until an index is loaded.
+INGEST_MODE = os.environ.get("INGEST_MODE", "full")
+# Enables POST /admin/rebuild, for requests with this token in their X-Admin-Token header
+ADMIN_TOKEN = os.environ.get("ADMIN_TOKEN", "")
+# Requests waiting for one of the QUERY_CONCURRENCY slots, beyond which they are shed with a 503
+ADMISSION_MAX_QUEUE = int(os.environ.get("ADMISSION_MAX_QUEUE", 64))
+ADMISSION_QUEUE_TIMEOUT = float(os.environ.get("ADMISSION_QUEUE_TIMEOUT", 30))
+# Requests in flight per client, beyond which they are rejected with a 429 (0 for no limit). Clients are identified
+# by the CLIENT_ID_HEADER header, else the session_id of the message, else their address.
+ADMISSION_CLIENT_LIMIT = int(os.environ.get("ADMISSION_CLIENT_LIMIT", 0))
+CLIENT_ID_HEADER = os.environ.get("CLIENT_ID_HEADER", "X-Client-ID")
+# Documents a request may retrieve, each distinct temperature and k builds a chain of its own
+MAX_K = int(os.environ.get("MAX_K", 20))
+# Questions accepted by one /query/batch request
+BATCH_MAX_QUESTIONS = int(os.environ.get("BATCH_MAX_QUESTIONS", 1000))
 
 app = FastAPI()
 
+# Bounds the questions answered concurrently by this worker, and the requests queued for them
+admission = AdmissionController(
+    chains.QUERY_CONCURRENCY, ADMISSION_MAX_QUEUE, ADMISSION_QUEUE_TIMEOUT, ADMISSION_CLIENT_LIMIT
+)
+# Identical questions asked at the same time share one chain run
+in_flight_questions = SingleFlight()
+# Ingestion of the website at startup, and rebuilds triggered by an admin
+ingestion_jobs = IngestionJobs()
+# Set once the default collection's index is loaded and its chain built
+index_loaded = threading.Event()
+# Why the default collection's index couldn't be loaded, reported until an ingestion succeeds
+index_error = None
+
+
+def _check_collection(cls, collection):
+    return collection if collection is None else validate_collection_name(collection)
+
 
 class Message(BaseModel):
     question: str
     chat_history: tuple
+    temperature: float = Field(DEFAULT_TEMPERATURE, ge=0.0, le=1.0)
+    k: int = Field(DEFAULT_K, ge=1, le=MAX_K)
+    # Identifies the conversation, so its summarised history is reused between turns
+    session_id: Optional[str] = None
+    # The knowledge base to answer from, the default collection when not set
+    collection: Optional[str] = None
+
+    _check_collection = validator("collection", allow_reuse=True)(_check_collection)
+
+
+class BatchQuestion(BaseModel):
+    question: str
+    chat_history: tuple = ()
+    # Echoed back with the answer, e.g. the id of the question in an evaluation set
+    id: Optional[str] = None
+
+
+class BatchMessage(BaseModel):
+    questions: List[BatchQuestion]
+    temperature: float = Field(DEFAULT_TEMPERATURE, ge=0.0, le=1.0)
+    k: int = Field(DEFAULT_K, ge=1, le=MAX_K)
+    collection: Optional[str] = None
+    session_id: Optional[str] = None
+
+    _check_collection = validator("collection", allow_reuse=True)(_check_collection)
+
+
+class RebuildRequest(BaseModel):
+    # The website to ingest, the one the backend serves when not set
+    url: Optional[str] = None
+    collection: Optional[str] = None
+
+    _check_collection = validator("collection", allow_reuse=True)(_check_collection)
 
 
 @app.on_event("startup")
 async def startup_event():
-    if not Path(chains.PERSIST_DIR).exists():
-        chains.create_embeddings(WEBSITE)
+    # Ingestion runs on a thread of its own (the crawler runs its own event loop), so the server starts right away.
+    # An existing index is served while a sync updates it, without one /ready fails until the first ingestion is done.
+    if chains.collection_exists():
+        # Importing LangChain and loading the index take seconds, so they run in the background too: the worker
+        # accepts connections right away, and /ready fails until the index is loaded
+        threading.Thread(target=_warm_up, name="warm-up", daemon=True).start()
+    else:
+        ingestion_jobs.start("initial", WEBSITE, None, _ingestion(chains.create_embeddings, WEBSITE, None))
 
 
-@app.post("/query")
-async def query_model(message: Message):
+def _warm_up():
+    # Build the shared vector store and default chain so the first request doesn't pay for building them
+    try:
+        chains.get_qa_chain(DEFAULT_TEMPERATURE, DEFAULT_K)
+    except Exception as e:
+        # e.g. missing credentials or a corrupt store, which an admin rebuild may fix
+        traceback.print_exc()
+        _index_failed(e)
+        return
+    _index_loaded()
+    if INGEST_MODE == "sync":
+        ingestion_jobs.start("sync", WEBSITE, None, _ingestion(chains.sync_embeddings, WEBSITE, None))
+
+
+def _ingestion(ingest, url, collection):
+    def run(job):
+        try:
+            ingest(url, collection, job=job)
+            # Built on the job's thread, so the store is loaded before the collection is reported ready
+            chains.get_qa_chain(DEFAULT_TEMPERATURE, DEFAULT_K, collection)
+        except Exception as e:
+            if collection is None and not index_loaded.is_set():
+                _index_failed(e)
+            raise
+        if collection is None:
+            _index_loaded()
+
+    return run
+
+
+def _index_loaded():
+    global index_error
+
+    index_error = None
+    index_loaded.set()
+
+
+def _index_failed(error):
+    # Reported by /ready, /status and the queries to the default collection, rather than "still being built"
+    global index_error
+
+    index_error = f"{type(error).__name__}: {error}"
+
+
+@app.get("/ready")
+async def ready():
+    # Readiness probe: fails until an index is loaded, e.g. while a cold container ingests the website
+    if not index_loaded.is_set():
+        return JSONResponse({"ready": False, "error": index_error}, status_code=503)
+    return {"ready": True}
+
+
+@app.get("/status")
+async def status():
+    return {
+        "ready": index_loaded.is_set(),
+        "error": index_error,
+        "jobs": [job.as_dict() for job in ingestion_jobs.recent()],
+        "collections": [
+            {"collection": store.collection, "size_bytes": store.size_bytes} for store in chains.open_collections()
+        ],
+    }
+
+
+@app.post("/admin/rebuild", status_code=202)
+async def rebuild(request: RebuildRequest, x_admin_token: Optional[str] = Header(None)):
+    # Re-ingests a collection into a new directory and swaps it in once done, without interrupting queries
+    if not ADMIN_TOKEN:
+        raise HTTPException(status_code=403, detail="Admin endpoints are disabled, set ADMIN_TOKEN to enable them")
+    if not x_admin_token or not hmac.compare_digest(x_admin_token.encode(), ADMIN_TOKEN.encode()):
+        raise HTTPException(status_code=401, detail="Invalid admin token")
+
+    collection = None if request.collection == chains.DEFAULT_COLLECTION else request.collection
+    url = request.url or WEBSITE
     try:
-        response = chains.qa_with_sources_chain()(
+        job = ingestion_jobs.start("rebuild", url, collection, _ingestion(chains.rebuild_embeddings, url, collection))
+    except JobAlreadyRunning as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    return job.as_dict()
+
+
+@app.post("/query")
+async def query_model(message: Message, request: Request):
+    _check_index_loaded(message)
+    with metrics.trace_request("/query") as trace:
+        try:
+            with admission.client(_client_id(request, message)):
+                key = question_key(
+                    message.question,
+                    message.chat_history,
+                    temperature=message.temperature,
+                    k=message.k,
+                    collection=message.collection,
+                )
+                response = await in_flight_questions.run(key, lambda: _answer(message, trace))
+        except Rejected as e:
+            raise _rejection(e)
+        except CollectionNotFound:
+            raise _collection_not_found(message)
+        except Exception as e:
+            error_msg = f"Error querying model request, with following error: {e}"
+            raise HTTPException(status_code=500, detail=error_msg)
+
+    # A coalesced request gets the answer to the same question, but asked in its own words
+    return dict(response, question=message.question)
+
+
+async def _answer(message, trace):
+    qa_chain = await chains.aget_qa_chain(message.temperature, message.k, message.collection)
+    async with admission.slot():
+        chat_history = await chains.run_in_executor(
+            chains.compact_chat_history, message.chat_history, message.session_id
+        )
+        return await chains.arun_chain(
+            qa_chain,
             {
                 "question": message.question,
-                "chat_history": message.chat_history,
-            }
+                "chat_history": chat_history,
+            },
+            callbacks=metrics.callbacks(trace),
+        )
+
+
+@app.post("/query/stream")
+async def stream_query_model(message: Message, request: Request):
+    _check_index_loaded(message)
+    try:
+        qa_chain = await chains.aget_qa_chain(message.temperature, message.k, message.collection)
+    except CollectionNotFound:
+        raise _collection_not_found(message)
+    release = await _admit_stream(request, message)
+
+    # Server-sent events: the source documents first, then the answer tokens as they are generated
+    return StreamingResponse(
+        _stream_events(qa_chain, message, release),
+        media_type="text/event-stream",
+        background=BackgroundTask(release),
+    )
+
+
+async def _stream_events(qa_chain, message, release):
+    try:
+        with metrics.trace_request("/query/stream") as trace:
+            async for event in _stream_answer(qa_chain, message, trace):
+                yield event
+    finally:
+        release()
+
+
+async def _stream_answer(qa_chain, message, trace):
+    try:
+        chat_history = await chains.run_in_executor(
+            chains.compact_chat_history, message.chat_history, message.session_id
         )
+        events = chains.stream_qa(qa_chain, message.question, chat_history, trace)
+        while True:
+            # Each step of the chain blocks, so advance the generator on the thread pool
+            event = await chains.run_in_executor(next, events, None)
+            if event is None:
+                break
+
+            name, payload = event
+            if name == "sources":
+                yield _format_event("sources", {"source_documents": payload})
+            elif name == "token":
+                yield _format_event("token", {"token": payload})
+            else:
+                yield _format_event("end", {"answer": payload})
     except Exception as e:
+        if trace is not None:
+            trace.status = "error"
         error_msg = f"Error querying model request, with following error: {e}"
-        raise HTTPException(status_code=500, detail=error_msg)
+        yield _format_event("error", {"detail": error_msg})
+
+
+@app.post("/query/batch")
+async def batch_query_model(message: BatchMessage, request: Request):
+    # Many questions against the same chain, e.g. an evaluation run. Their standalone questions are embedded and
+    # searched together, and the answers stream back as NDJSON lines in the order they complete.
+    if len(message.questions) > BATCH_MAX_QUESTIONS:
+        raise HTTPException(status_code=413, detail=f"At most {BATCH_MAX_QUESTIONS} questions per batch")
+    _check_index_loaded(message)
+    try:
+        qa_chain = await chains.aget_qa_chain(message.temperature, message.k, message.collection)
+    except CollectionNotFound:
+        raise _collection_not_found(message)
+    # The batch holds a single slot, its generation concurrency is bounded by BATCH_CONCURRENCY
+    release = await _admit_stream(request, message)
+
+    return StreamingResponse(
+        _batch_lines(qa_chain, message, release),
+        media_type="application/x-ndjson",
+        background=BackgroundTask(release),
+    )
+
+
+async def _batch_lines(qa_chain, message, release):
+    questions = [(item.question, item.chat_history) for item in message.questions]
+    try:
+        with metrics.trace_request("/query/batch") as trace:
+            async for index, result in chains.abatch_qa(qa_chain, questions, trace):
+                item = message.questions[index]
+                line = {"index": index, "id": item.id, "question": item.question, "chat_history": item.chat_history}
+                if isinstance(result, Exception):
+                    if trace is not None:
+                        trace.status = "error"
+                    line["error"] = f"Error querying model request, with following error: {result}"
+                else:
+                    line.update(answer=result["answer"], source_documents=result["source_documents"])
+                yield json.dumps(jsonable_encoder(line)) + "\n"
+    finally:
+        release()
+
+
+@app.get("/metrics")
+async def get_metrics():
+    # Prometheus text exposition format
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
+
+
+def _admission_metrics():
+    for reason, count in list(admission.rejected.items()):
+        yield "knowledge_worker_rejected_requests_total", "Requests shed, by reason.", {"reason": reason}, count
+    yield "knowledge_worker_coalesced_requests_total", "Requests answered by an identical request in flight.", {}, (
+        in_flight_questions.coalesced
+    )
+
+
+metrics.register_collector(_admission_metrics)
+
+
+async def _admit_stream(request, message):
+    # Admitted before a streamed response starts, so a shed request gets a status code rather than an error event.
+    # Returns the idempotent release of its slot: when the events end, or after the response when the client went
+    # away before they started.
+    client_id = _client_id(request, message)
+    try:
+        admission.admit_client(client_id)
+    except Rejected as e:
+        raise _rejection(e)
+    try:
+        acquired_at = await admission.acquire()
+    except Rejected as e:
+        admission.release_client(client_id)
+        raise _rejection(e)
+
+    released = False
+
+    def release():
+        nonlocal released
+        if not released:
+            released = True
+            admission.release(acquired_at)
+            admission.release_client(client_id)
+
+    return release
+
+
+def _client_id(request, message):
+    return request.headers.get(CLIENT_ID_HEADER) or message.session_id or (request.client and request.client.host)
+
+
+def _rejection(error):
+    return HTTPException(
+        status_code=error.status_code, detail=error.detail, headers={"Retry-After": str(error.retry_after)}
+    )
+
+
+def _check_index_loaded(message):
+    # The default collection is created by the ingestion at startup, an empty index would answer "I don't know"
+    if message.collection or index_loaded.is_set():
+        return
+    if index_error is not None:
+        raise HTTPException(status_code=503, detail=f"The index failed to load: {index_error}")
+    raise HTTPException(
+        status_code=503, detail="The index is still being built, retry later", headers={"Retry-After": "30"}
+    )
+
+
+def _collection_not_found(message):
+    return HTTPException(status_code=404, detail=f"Unknown collection: {message.collection}")
+
 
-    return response
+def _format_event(event, data):
+    return f"event: {event}\ndata: {json.dumps(jsonable_encoder(data))}\n\n"
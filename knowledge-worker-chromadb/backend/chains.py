@@ -1,16 +1,150 @@
-from langchain.chains import ConversationalRetrievalChain
-from langchain.chat_models import ChatVertexAI
-from langchain.document_loaders.recursive_url_loader import RecursiveUrlLoader
-from langchain.embeddings import VertexAIEmbeddings
-from langchain.prompts import PromptTemplate
-from langchain.text_splitter import RecursiveCharacterTextSplitter
-from langchain.vectorstores import Chroma
+import asyncio
+import contextvars
+import functools
+import importlib
+import json
+import os
+import queue
+import shutil
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from typing import TYPE_CHECKING
 
+import metrics
+from pipeline import IngestionPipeline
+from store_pool import VectorStorePool, validate_collection_name
+
+if TYPE_CHECKING:
+    from crawler import CrawlCache, Crawler
+    from dt_gen_ai_hackathon_helper.cache.answer_cache import (
+        CachedQAChain,
+        InMemoryAnswerCache,
+        SQLiteAnswerCache,
+        bump_corpus_version,
+        vector_store_corpus_version,
+    )
+    from dt_gen_ai_hackathon_helper.cache.embedding_cache import EmbeddingCache
+    from dt_gen_ai_hackathon_helper.cache.query_embedding_cache import CachedQueryEmbeddings
+    from dt_gen_ai_hackathon_helper.context_packer.context_packer import (
+        ContextPacker,
+        ContextPackingRetriever,
+        search_many_with_embeddings,
+    )
+    from dt_gen_ai_hackathon_helper.history.history import ChatHistoryManager
+    from dt_gen_ai_hackathon_helper.vector_store.mmap_store import MmapVectorStore
+    from handlers import TimedEmbeddings, TokenQueueHandler
+    from langchain.chains import ConversationalRetrievalChain
+    from langchain.chains.conversational_retrieval.base import _get_chat_history
+    from langchain.chat_models import ChatVertexAI
+    from langchain.embeddings import VertexAIEmbeddings
+    from langchain.prompts import PromptTemplate
+    from langchain.text_splitter import RecursiveCharacterTextSplitter
+    from langchain.vectorstores import Chroma
+
+# LangChain, and the modules built on it, take seconds to import: they are imported on first use instead, by
+# _import_dependencies, so a worker starts serving (e.g. its health and readiness checks) before they are loaded.
+# Names already set on the module, e.g. fakes patched in by the benchmarks, are kept. Keep in sync with the imports
+# for type checkers above.
+_DEPENDENCIES = {
+    "CachedQAChain": "dt_gen_ai_hackathon_helper.cache.answer_cache",
+    "InMemoryAnswerCache": "dt_gen_ai_hackathon_helper.cache.answer_cache",
+    "SQLiteAnswerCache": "dt_gen_ai_hackathon_helper.cache.answer_cache",
+    "bump_corpus_version": "dt_gen_ai_hackathon_helper.cache.answer_cache",
+    "vector_store_corpus_version": "dt_gen_ai_hackathon_helper.cache.answer_cache",
+    "ContextPacker": "dt_gen_ai_hackathon_helper.context_packer.context_packer",
+    "ContextPackingRetriever": "dt_gen_ai_hackathon_helper.context_packer.context_packer",
+    "search_many_with_embeddings": "dt_gen_ai_hackathon_helper.context_packer.context_packer",
+    "CrawlCache": "crawler",
+    "Crawler": "crawler",
+    "EmbeddingCache": "dt_gen_ai_hackathon_helper.cache.embedding_cache",
+    "TimedEmbeddings": "handlers",
+    "TokenQueueHandler": "handlers",
+    "ChatHistoryManager": "dt_gen_ai_hackathon_helper.history.history",
+    "ConversationalRetrievalChain": "langchain.chains",
+    "_get_chat_history": "langchain.chains.conversational_retrieval.base",
+    "ChatVertexAI": "langchain.chat_models",
+    "VertexAIEmbeddings": "langchain.embeddings",
+    "PromptTemplate": "langchain.prompts",
+    "RecursiveCharacterTextSplitter": "langchain.text_splitter",
+    "Chroma": "langchain.vectorstores",
+    "MmapVectorStore": "dt_gen_ai_hackathon_helper.vector_store.mmap_store",
+    "CachedQueryEmbeddings": "dt_gen_ai_hackathon_helper.cache.query_embedding_cache",
+}
+_dependencies_lock = threading.Lock()
+_dependencies_imported = False
+
+# The default collection, which requests name no collection for
 PERSIST_DIR = "chromadb"
+DEFAULT_COLLECTION = "default"
+# Every other collection (knowledge base) is persisted in its own directory below COLLECTIONS_DIR
+COLLECTIONS_DIR = os.environ.get("COLLECTIONS_DIR", "collections")
+# Collections are opened on demand, and the least recently used closed beyond this estimated memory (0 for no limit)
+COLLECTION_MEMORY_BUDGET_MB = float(os.environ.get("COLLECTION_MEMORY_BUDGET_MB", 2048))
+MAX_OPEN_COLLECTIONS = int(os.environ.get("MAX_OPEN_COLLECTIONS", 0))
+# Every (temperature, k) requested builds a chain (and LLM client) of its own, of which the most recently used are kept
+# per collection. Temperatures are rounded, so that near-identical ones share a chain.
+MAX_CHAINS_PER_COLLECTION = int(os.environ.get("MAX_CHAINS_PER_COLLECTION", 8))
+TEMPERATURE_DECIMALS = 2
+# Records the fingerprint and chunk ids of every ingested page, so re-ingestion only embeds what changed
+MANIFEST_FILE = "manifest.json"
+# ETag / Last-Modified validators of the crawled pages, so unchanged pages aren't downloaded again
+CRAWL_CACHE_FILE = "crawl_cache.json"
+# A rebuild ingests into a new directory below "<collection directory>-builds", and points "<collection
+# directory>.current" at it once done. The previous build is kept, requests which started on it may still read it.
+BUILDS_SUFFIX = "-builds"
+CURRENT_BUILD_SUFFIX = ".current"
+# "chroma", or "mmap" for memory-mapped NumPy segments shared read-only between workers through the page cache
+VECTOR_STORE = os.environ.get("VECTOR_STORE", "chroma")
+# Precision of the vectors of the "mmap" store, "float16" halves its size
+VECTOR_STORE_DTYPE = os.environ.get("VECTOR_STORE_DTYPE", "float32")
+
+# Building the embeddings client, opening the persisted Chroma store and constructing the chain is expensive.
+# We therefore build them once per process and share them between requests: one embeddings client, one store per
+# collection, and one chain per (collection, temperature, k), kept with the store it's built on.
+_registry_lock = threading.Lock()
+_embeddings = None
+_history_manager = None
+
+# Chain steps without a native async implementation run on a bounded thread pool, so they never block the event loop.
+# The same limit caps how many questions a single worker answers at once.
+QUERY_CONCURRENCY = int(os.environ.get("QUERY_CONCURRENCY", 8))
+_executor = ThreadPoolExecutor(max_workers=QUERY_CONCURRENCY, thread_name_prefix="qa-chain")
+# Models whose async generation raises NotImplementedError, by their _llm_type (ChatVertexAI and VertexAI). Chains using
+# them run on the thread pool from the start, the async path would only fail once retrieval has run.
+SYNC_ONLY_LLM_TYPES = {"vertexai"}
+
+# Questions of a batch are condensed, embedded and searched a chunk at a time, so answers start streaming back before
+# the whole batch is searched. Generation of a batch's answers runs at most BATCH_CONCURRENCY at once, on a thread pool
+# of its own so a large batch never takes the threads of the single queries.
+BATCH_CHUNK_SIZE = int(os.environ.get("BATCH_CHUNK_SIZE", 64))
+BATCH_CONCURRENCY = int(os.environ.get("BATCH_CONCURRENCY", QUERY_CONCURRENCY))
+_batch_executor = ThreadPoolExecutor(max_workers=BATCH_CONCURRENCY, thread_name_prefix="qa-batch")
+
+# Opt-in semantic answer cache: "memory" (per process) or "sqlite" (shared between workers and restarts)
+ANSWER_CACHE = os.environ.get("ANSWER_CACHE", "")
+ANSWER_CACHE_PATH = os.environ.get("ANSWER_CACHE_PATH", "answer_cache.sqlite")
+ANSWER_CACHE_THRESHOLD = float(os.environ.get("ANSWER_CACHE_THRESHOLD", 0.95))
+ANSWER_CACHE_TTL = float(os.environ.get("ANSWER_CACHE_TTL", 3600))
+ANSWER_CACHE_MAX_ENTRIES = int(os.environ.get("ANSWER_CACHE_MAX_ENTRIES", 1000))
+
+# Query embeddings kept in memory per process, and optionally on disk so they survive restarts
+QUERY_EMBEDDING_CACHE_SIZE = int(os.environ.get("QUERY_EMBEDDING_CACHE_SIZE", 1024))
+QUERY_EMBEDDING_CACHE_PATH = os.environ.get("QUERY_EMBEDDING_CACHE_PATH", "")
+
+# Optional packing of the retrieved documents: CONTEXT_FETCH_K candidates are deduplicated, diversified (MMR) and cut
+# to the k most useful ones within CONTEXT_TOKEN_BUDGET tokens. A budget of 0 stuffs all k documents into the prompt.
+CONTEXT_TOKEN_BUDGET = int(os.environ.get("CONTEXT_TOKEN_BUDGET", 0))
+CONTEXT_FETCH_K = int(os.environ.get("CONTEXT_FETCH_K", 20))
+CONTEXT_MIN_SCORE = float(os.environ["CONTEXT_MIN_SCORE"]) if os.environ.get("CONTEXT_MIN_SCORE") else None
+
+# Conversations beyond the token budget keep their last turns verbatim, and older turns are folded into a summary
+HISTORY_TOKEN_BUDGET = int(os.environ.get("HISTORY_TOKEN_BUDGET", 1000))
+HISTORY_KEEP_TURNS = int(os.environ.get("HISTORY_KEEP_TURNS", 3))
 
 # The PromptTemplate reads input variables (i.e.: 'chat_history', 'question') from the template
-SYSTEM_PROMPT = PromptTemplate.from_template(
-    """\
+SYSTEM_PROMPT_TEMPLATE = """\
 You are a helpful chatbot designed to perform Q&A on a set of documents.
 Always respond to users with friendly and helpful messages.
 Your goal is to answer user questions using relevant sources.
@@ -28,65 +162,256 @@ Chat History:
 {chat_history}
 Question: {question}
 """
-)
+
+
+def _import_dependencies():
+    global _dependencies_imported, SYSTEM_PROMPT
+
+    if _dependencies_imported:
+        return
+
+    with _dependencies_lock:
+        if _dependencies_imported:
+            return
+        for name, module in _DEPENDENCIES.items():
+            if name not in globals():
+                globals()[name] = getattr(importlib.import_module(module), name)
+        SYSTEM_PROMPT = PromptTemplate.from_template(SYSTEM_PROMPT_TEMPLATE)
+        _dependencies_imported = True
+
+
+def __getattr__(name):
+    # The deferred names are still attributes of the module, e.g. chains.MmapVectorStore, imported when first read
+    if name in _DEPENDENCIES or name == "SYSTEM_PROMPT":
+        _import_dependencies()
+        return globals()[name]
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
 
 
 def load_documents(url):
+    _import_dependencies()
     # Search the target URL to find subpages.
     # This search may fail to expose all sites. This is due to restrictions webservers place to prevent webscraping.
-    loader = RecursiveUrlLoader(url=url)
-    documents = loader.load()
+    documents = Crawler().crawl_sync(url).documents
 
     print(f"Loaded: {len(documents)} documents from {url}.")
 
     return documents
 
 
-def create_embeddings(source_dir):
-    vector_store = load_embeddings()
+def create_embeddings(source_dir, collection=None, job=None):
+    # On an empty store an incremental sync embeds everything, and records the manifest for the next sync
+    return sync_embeddings(source_dir, collection, job)
 
-    documents = load_documents(source_dir=source_dir)
-    vector_store = embed_documents(vector_store, documents)
 
+def sync_embeddings(url, collection=None, job=None):
+    # Updates the live store in place, the requests served meanwhile see the pages as they are re-embedded
+    vector_store = get_vector_store(collection, create=True)
+    _ingest(url, vector_store, live_directory(collection), job)
+    _stores.update_size(collection or DEFAULT_COLLECTION)
     return vector_store
 
 
+def rebuild_embeddings(url, collection=None, job=None):
+    # Ingests the whole website into a new directory, then swaps it in: the requests opening the collection from then
+    # on use the new store, while the requests in flight complete on the old one
+    base_dir = collection_directory(collection)
+    build_dir = os.path.join(base_dir + BUILDS_SUFFIX, f"{time.strftime('%Y%m%d-%H%M%S')}-{uuid.uuid4().hex[:6]}")
+    vector_store = load_embeddings(build_dir)
+    _ingest(url, vector_store, build_dir, job)
+
+    previous_dir = live_directory(collection)
+    # Renaming the pointer is atomic, so a store is always opened from one complete build or the other
+    with open(base_dir + CURRENT_BUILD_SUFFIX + ".tmp", "w") as f:
+        f.write(build_dir)
+    os.replace(base_dir + CURRENT_BUILD_SUFFIX + ".tmp", base_dir + CURRENT_BUILD_SUFFIX)
+    reset_registry(collection or DEFAULT_COLLECTION)
+    print(f"Swapped in {build_dir}, replacing {previous_dir}.")
+
+    # Older builds can't be in use anymore
+    for name in os.listdir(base_dir + BUILDS_SUFFIX):
+        path = os.path.join(base_dir + BUILDS_SUFFIX, name)
+        if path not in (build_dir, previous_dir):
+            shutil.rmtree(path, ignore_errors=True)
+
+    return build_dir
+
+
+def _ingest(url, vector_store, persist_dir, job=None):
+    _import_dependencies()
+    manifest = _load_manifest(persist_dir)
+
+    if not manifest["sources"] and _count_chunks(vector_store):
+        # Chunks ingested without a manifest can't be matched to their pages, so start over
+        print("No ingestion manifest found, re-embedding all documents.")
+        vector_store.delete()
+
+    # Pages the server reports as not modified are skipped without downloading them.
+    # Only revalidate pages recorded in the manifest, any other page has to be fetched in full.
+    crawl_cache = CrawlCache(os.path.join(persist_dir, CRAWL_CACHE_FILE))
+    crawl_cache.retain(manifest["sources"])
+
+    # Pages stream through splitting, embedding and writing, with only new or changed chunks embedded
+    pipeline = IngestionPipeline(
+        vector_store,
+        manifest,
+        _create_text_splitter(),
+        checkpoint=functools.partial(_save_manifest, persist_dir=persist_dir),
+    )
+    if job is not None:
+        # Reports the pipeline's progress while it runs
+        job.pipeline = pipeline
+    try:
+        stats = pipeline.run(Crawler(cache=crawl_cache), url)
+    finally:
+        # Pages may have been re-embedded even if the run failed, the answers cached until now may be stale
+        bump_corpus_version(vector_store)
+    if job is not None:
+        job.stats = stats
+
+    crawl_cache.save()
+    vector_store.persist()
+
+    print(
+        f"Synced {url}: {stats['added']} chunks added, {stats['deleted']} chunks deleted, "
+        f"{stats['unchanged']} pages unchanged in {stats['seconds']}s."
+    )
+    for name, stage in stats["stages"].items():
+        print(
+            f"  {name}: {stage['items']} items, {stage['items_per_second']}/s, busy {stage['busy_seconds']}s, "
+            f"waiting on the next stage {stage['queue_wait_seconds']}s"
+        )
+
+    return stats
+
+
 def embed_documents(vector_store, documents):
+    _import_dependencies()
     # Individual documents will often exceed the token limit.
     # By splitting documents into chunks of 1000 token
     # These chunks fit into the token limit alongside the user prompt
-    text_splitter = RecursiveCharacterTextSplitter(chunk_size=1000, chunk_overlap=0)
+    text_splitter = _create_text_splitter()
     texts = text_splitter.split_documents(documents)
 
     # Add our documents (split into shards) to the DB
     # They will be embedded using the defined GooglePalmEmbeddings model
-    vector_store.add_texts(texts)
+    vector_store.add_documents(texts)
 
     # Persist the ChromaDB locally, so we can reload the script without expensively re-embedding the database
     vector_store.persist()
+    bump_corpus_version(vector_store)
 
     return vector_store
 
 
-def load_embeddings():
-    # We use GoogleLLM embeddings model, however other models can be substituted here
-    embeddings = VertexAIEmbeddings()
+def _create_text_splitter():
+    return RecursiveCharacterTextSplitter(chunk_size=1000, chunk_overlap=0)
+
+
+def _load_manifest(persist_dir=PERSIST_DIR):
+    manifest_path = os.path.join(persist_dir, MANIFEST_FILE)
+    if not os.path.exists(manifest_path):
+        return {"sources": {}}
+
+    with open(manifest_path) as f:
+        return json.load(f)
+
+
+def _save_manifest(manifest, persist_dir=PERSIST_DIR):
+    # Write to a temporary file and rename it, so a crash never leaves a truncated manifest behind
+    manifest_path = os.path.join(persist_dir, MANIFEST_FILE)
+    os.makedirs(persist_dir, exist_ok=True)
+    with open(manifest_path + ".tmp", "w") as f:
+        json.dump(manifest, f)
+    os.replace(manifest_path + ".tmp", manifest_path)
+
+
+def load_embeddings(persist_dir=PERSIST_DIR):
+    _import_dependencies()
+    # The embeddings model, and its query embedding cache, are shared by every collection
+    embeddings = get_embeddings()
 
     # Creating embeddings with each re-run is highly inefficient and costly.
     # We instead aim to embed once, then load these embeddings from storage.
+    if VECTOR_STORE == "mmap":
+        # Opens in milliseconds, the vectors are only paged in as searches touch them
+        return MmapVectorStore(
+            embedding_function=embeddings,
+            persist_directory=persist_dir,
+            dtype=VECTOR_STORE_DTYPE,
+        )
+
     vector_store = Chroma(
         embedding_function=embeddings,
-        persist_directory=PERSIST_DIR,
+        persist_directory=persist_dir,
     )
 
     return vector_store
 
 
+def _create_embeddings():
+    _import_dependencies()
+    # We use GoogleLLM embeddings model, however other models can be substituted here
+    # Regenerated answers and frequently asked questions reuse the embedding of their standalone question
+    embeddings = VertexAIEmbeddings()
+    if metrics.METRICS_ENABLED:
+        # Only the requests which miss the query embedding cache reach the model, and are timed
+        embeddings = TimedEmbeddings(embeddings)
+    return CachedQueryEmbeddings(
+        embeddings,
+        max_entries=QUERY_EMBEDDING_CACHE_SIZE,
+        persistent_cache=EmbeddingCache(QUERY_EMBEDDING_CACHE_PATH) if QUERY_EMBEDDING_CACHE_PATH else None,
+    )
+
+
+def collection_directory(collection=None):
+    if not collection or collection == DEFAULT_COLLECTION:
+        return PERSIST_DIR
+    return os.path.join(COLLECTIONS_DIR, validate_collection_name(collection))
+
+
+def live_directory(collection=None):
+    # The directory of the collection's current build, when it was ever rebuilt
+    base_dir = collection_directory(collection)
+    try:
+        with open(base_dir + CURRENT_BUILD_SUFFIX) as f:
+            return f.read().strip()
+    except FileNotFoundError:
+        return base_dir
+
+
+def collection_exists(collection=None):
+    return os.path.exists(live_directory(collection))
+
+
+_stores = VectorStorePool(
+    open_store=lambda collection, persist_dir: load_embeddings(persist_dir),
+    directory_of=live_directory,
+    memory_budget_bytes=int(COLLECTION_MEMORY_BUDGET_MB * 2**20),
+    max_open=MAX_OPEN_COLLECTIONS,
+)
+
+
+def _count_chunks(vector_store):
+    if isinstance(vector_store, MmapVectorStore):
+        return vector_store.count()
+    return vector_store._collection.count()
+
+
 def qa_with_sources_chain(temperature, k):
-    vector_store = load_embeddings()
+    return get_qa_chain(temperature, k)
 
+
+def _build_qa_chain(vector_store, temperature, k, collection=DEFAULT_COLLECTION):
+    _import_dependencies()
     # A vector store retriever relates queries to embedded documents
-    retriever = vector_store.as_retriever(k=k)
+    retriever = vector_store.as_retriever(search_kwargs={"k": k})
+    if CONTEXT_TOKEN_BUDGET:
+        retriever = ContextPackingRetriever(
+            vector_store=vector_store,
+            packer=ContextPacker(token_budget=CONTEXT_TOKEN_BUDGET, max_documents=k, min_score=CONTEXT_MIN_SCORE),
+            fetch_k=max(k, CONTEXT_FETCH_K),
+        )
 
     # The selected GoogleLLM model uses embedded documents related to the query
     # It parses these documents in order to answer the user question.
@@ -104,4 +429,395 @@ def qa_with_sources_chain(temperature, k):
         condense_question_prompt=SYSTEM_PROMPT,
     )
 
+    # The default collection keeps the namespace it had before collections were introduced
+    namespace = f"{temperature}-{k}" if collection == DEFAULT_COLLECTION else f"{collection}-{temperature}-{k}"
+    answer_cache = _create_answer_cache(namespace=namespace)
+    if answer_cache is not None:
+        # Near-identical standalone questions against the same documents reuse the cached answer and sources
+        qa_chain = CachedQAChain(
+            qa_chain=qa_chain,
+            embeddings=vector_store._embedding_function,
+            answer_cache=answer_cache,
+            corpus_version=lambda: vector_store_corpus_version(vector_store),
+        )
+
     return qa_chain
+
+
+def _create_answer_cache(namespace):
+    # Answers depend on the collection, temperature and k of the chain, so each chain gets its own cache (namespace)
+    if ANSWER_CACHE == "memory":
+        return InMemoryAnswerCache(
+            similarity_threshold=ANSWER_CACHE_THRESHOLD,
+            ttl_seconds=ANSWER_CACHE_TTL,
+            max_entries=ANSWER_CACHE_MAX_ENTRIES,
+        )
+    if ANSWER_CACHE == "sqlite":
+        return SQLiteAnswerCache(
+            ANSWER_CACHE_PATH,
+            namespace=namespace,
+            similarity_threshold=ANSWER_CACHE_THRESHOLD,
+            ttl_seconds=ANSWER_CACHE_TTL,
+            max_entries=ANSWER_CACHE_MAX_ENTRIES,
+        )
+    return None
+
+
+def get_embeddings():
+    global _embeddings
+
+    # Double-checked locking: only the first caller pays for creating the client
+    if _embeddings is None:
+        with _registry_lock:
+            if _embeddings is None:
+                _embeddings = _create_embeddings()
+
+    return _embeddings
+
+
+def get_vector_store(collection=None, create=False):
+    # Raises CollectionNotFound for a collection which was never ingested, unless `create`.
+    # The default collection is always created, as before collections were introduced.
+    collection = collection or DEFAULT_COLLECTION
+    return _stores.get(collection, create=create or collection == DEFAULT_COLLECTION).vector_store
+
+
+def get_qa_chain(temperature, k, collection=None):
+    collection = collection or DEFAULT_COLLECTION
+    store = _stores.get(collection, create=collection == DEFAULT_COLLECTION)
+    temperature, k = _chain_key(temperature, k)
+
+    qa_chain = store.get_chain((temperature, k))
+    if qa_chain is None:
+        with store.lock:
+            qa_chain = store.get_chain((temperature, k))
+            if qa_chain is None:
+                qa_chain = _build_qa_chain(store.vector_store, temperature, k, collection)
+                store.add_chain((temperature, k), qa_chain, MAX_CHAINS_PER_COLLECTION)
+
+    return qa_chain
+
+
+def _chain_key(temperature, k):
+    return round(float(temperature), TEMPERATURE_DECIMALS), int(k)
+
+
+def get_history_manager():
+    global _history_manager
+
+    _import_dependencies()
+    if _history_manager is None:
+        with _registry_lock:
+            if _history_manager is None:
+                _history_manager = ChatHistoryManager(
+                    # Summaries should be faithful, so they don't depend on the temperature requested
+                    llm=ChatVertexAI(temperature=0.0),
+                    token_budget=HISTORY_TOKEN_BUDGET,
+                    keep_last_turns=HISTORY_KEEP_TURNS,
+                )
+
+    return _history_manager
+
+
+def compact_chat_history(chat_history, session_id=None):
+    # An empty history stays empty, in which case the chain skips condensing the question altogether
+    if not chat_history:
+        return []
+
+    with metrics.span("compact_history"):
+        return get_history_manager().compact(chat_history, session_id=session_id)
+
+
+def open_collections():
+    return _stores.stores()
+
+
+def reset_registry(collection=None):
+    # Drop the cached store and chains of a collection, or of all of them, e.g. after the persisted store was rebuilt
+    _stores.discard(collection)
+
+
+def _cache_metrics():
+    # Hit and miss counts kept by the caches, read when /metrics is scraped.
+    # Nothing is imported here, the caches only exist once their dependencies were imported to create them.
+    if _embeddings is not None:
+        labels = {"cache": "query_embedding"}
+        yield "knowledge_worker_cache_hits_total", "Cache hits, by cache.", labels, _embeddings.hits
+        yield "knowledge_worker_cache_misses_total", "Cache misses, by cache.", labels, _embeddings.misses
+
+    for store in _stores.stores():
+        for (temperature, k), qa_chain in store.chains():
+            if _dependencies_imported and isinstance(qa_chain, CachedQAChain):
+                labels = {"cache": "answer", "collection": store.collection, "chain": f"{temperature}-{k}"}
+                cache = qa_chain.answer_cache
+                yield "knowledge_worker_cache_hits_total", "Cache hits, by cache.", labels, cache.hits
+                yield "knowledge_worker_cache_misses_total", "Cache misses, by cache.", labels, cache.misses
+
+    yield "knowledge_worker_collection_evictions_total", "Collections closed to stay within the memory budget.", {}, (
+        _stores.evictions
+    )
+
+
+metrics.register_collector(_cache_metrics)
+
+
+async def aget_qa_chain(temperature, k, collection=None):
+    store = _stores.get_opened(collection or DEFAULT_COLLECTION)
+    qa_chain = store.get_chain(_chain_key(temperature, k)) if store is not None else None
+    if qa_chain is None:
+        # Building a chain opens clients and the persisted store, so keep it off the event loop
+        qa_chain = await run_in_executor(get_qa_chain, temperature, k, collection)
+
+    return qa_chain
+
+
+async def arun_chain(qa_chain, inputs, callbacks=None):
+    # Prefer the native async path: retrieval and LLM calls are awaited instead of holding a thread
+    if supports_async(qa_chain):
+        return await qa_chain.acall(inputs, callbacks=callbacks)
+
+    return await run_in_executor(functools.partial(qa_chain, inputs, callbacks=callbacks))
+
+
+def supports_async(qa_chain):
+    # Whether every step of the chain runs natively async. The answer cache's chain has no async path of its own.
+    _import_dependencies()
+    if isinstance(qa_chain, CachedQAChain):
+        return False
+    llms = [qa_chain.question_generator.llm, qa_chain.combine_docs_chain.llm_chain.llm]
+    return not any(llm._llm_type in SYNC_ONLY_LLM_TYPES for llm in llms)
+
+
+async def run_in_executor(func, *args, executor=None):
+    loop = asyncio.get_running_loop()
+    # Like asyncio.to_thread, the function runs in the caller's context, e.g. the trace of the current request
+    context = contextvars.copy_context()
+    return await loop.run_in_executor(executor or _executor, functools.partial(context.run, func, *args))
+
+
+async def run_in_batch_executor(func, *args):
+    return await run_in_executor(func, *args, executor=_batch_executor)
+
+
+def stream_qa(qa_chain, question, chat_history, trace=None):
+    # Follows the same steps as ConversationalRetrievalChain, but yields ("sources", documents) as soon as
+    # retrieval finishes, then ("token", text) as the answer is generated and finally ("answer", text).
+    # The stages are timed as part of the request's trace, if any.
+    _import_dependencies()
+    if isinstance(qa_chain, CachedQAChain):
+        yield from _stream_cached_qa(qa_chain, question, chat_history, trace)
+        return
+
+    chat_history_str = (qa_chain.get_chat_history or _get_chat_history)(list(chat_history))
+    if chat_history_str:
+        question = qa_chain.question_generator.run(
+            question=question,
+            chat_history=chat_history_str,
+            callbacks=metrics.callbacks(trace, "condense_question"),
+        )
+
+    documents = qa_chain.retriever.get_relevant_documents(question, callbacks=metrics.callbacks(trace, "retrieve"))
+    yield "sources", documents
+
+    # Generation runs in its own thread, the tokens it streams are handed over through the queue
+    tokens = queue.Queue()
+    end_of_answer = object()
+    result = {}
+
+    def generate():
+        try:
+            result["answer"] = qa_chain.combine_docs_chain.run(
+                input_documents=documents,
+                question=question,
+                chat_history=chat_history_str,
+                callbacks=[TokenQueueHandler(tokens)] + metrics.callbacks(trace, "generate"),
+            )
+        except Exception as e:
+            result["error"] = e
+        finally:
+            tokens.put(end_of_answer)
+
+    threading.Thread(target=contextvars.copy_context().run, args=(generate,), daemon=True).start()
+
+    streamed = False
+    for token in iter(tokens.get, end_of_answer):
+        streamed = True
+        yield "token", token
+
+    if "error" in result:
+        raise result["error"]
+
+    # Models without token streaming produce the whole answer at once
+    if not streamed:
+        yield "token", result["answer"]
+
+    yield "answer", result["answer"]
+
+
+def _stream_cached_qa(cached_chain, question, chat_history, trace=None):
+    question = cached_chain.condense_question(
+        question, chat_history, callbacks=metrics.callbacks(trace, "condense_question")
+    )
+    with metrics.span("answer_cache_lookup"):
+        embedding, corpus_version, result = cached_chain.lookup(question)
+
+    if result is not None:
+        yield "sources", result["source_documents"]
+        yield "token", result["answer"]
+        yield "answer", result["answer"]
+        return
+
+    # The question is already standalone, so the wrapped chain doesn't need the chat history
+    documents = []
+    for event, payload in stream_qa(cached_chain.qa_chain, question, [], trace):
+        if event == "sources":
+            documents = payload
+        elif event == "answer":
+            cached_chain.answer_cache.update(
+                embedding, question, {"answer": payload, "source_documents": documents}, corpus_version
+            )
+        yield event, payload
+
+
+async def abatch_qa(qa_chain, questions, trace=None, concurrency=BATCH_CONCURRENCY):
+    # Answers many (question, chat_history) pairs, yielding (index, result) as each answer completes, where result is
+    # the chain's output or the exception raised answering it. Rather than running the whole chain per question, the
+    # standalone questions of a chunk are embedded in one request and searched in one vector store call, so only
+    # condensing (for follow-up questions) and generation call the LLM per question.
+    _import_dependencies()
+    cached_chain = qa_chain if isinstance(qa_chain, CachedQAChain) else None
+    chain = cached_chain.qa_chain if cached_chain is not None else qa_chain
+    embeddings = _retriever_vector_store(chain.retriever)._embedding_function
+    semaphore = asyncio.Semaphore(concurrency)
+    results = asyncio.Queue()
+    tasks = set()
+
+    async def condense(question, chat_history):
+        if chat_history:
+            chat_history = await run_in_batch_executor(compact_chat_history, chat_history)
+        chat_history_str = (chain.get_chat_history or _get_chat_history)(list(chat_history))
+        if not chat_history_str:
+            return question, ""
+        async with semaphore:
+            standalone_question = await run_in_batch_executor(
+                functools.partial(
+                    chain.question_generator.run,
+                    question=question,
+                    chat_history=chat_history_str,
+                    callbacks=metrics.callbacks(trace, "condense_question"),
+                )
+            )
+        # A cached chain answers the standalone question on its own, like CachedQAChain does
+        return standalone_question, "" if cached_chain is not None else chat_history_str
+
+    async def generate(index, question, chat_history_str, embedding, corpus_version, documents):
+        async with semaphore:
+            try:
+                answer = await run_in_batch_executor(
+                    functools.partial(
+                        chain.combine_docs_chain.run,
+                        input_documents=documents,
+                        question=question,
+                        chat_history=chat_history_str,
+                        callbacks=metrics.callbacks(trace, "generate"),
+                    )
+                )
+                result = {"answer": answer, "source_documents": documents}
+                if cached_chain is not None:
+                    cached_chain.answer_cache.update(embedding, question, result, corpus_version)
+            except Exception as e:
+                result = e
+        results.put_nowait((index, result))
+
+    async def answer_chunk(start, chunk):
+        condensed = await asyncio.gather(
+            *(condense(question, chat_history) for question, chat_history in chunk), return_exceptions=True
+        )
+        pending = []
+        for index, result in enumerate(condensed, start):
+            if isinstance(result, Exception):
+                results.put_nowait((index, result))
+            else:
+                pending.append((index, *result))
+        if not pending:
+            return
+
+        # The questions not answered yet, which get the error if embedding, the cache lookup or the search fails
+        unanswered = pending
+        try:
+            query_embeddings = await run_in_batch_executor(_embed_queries, embeddings, [item[1] for item in pending])
+            corpus_version, cached_results = None, [None] * len(pending)
+            if cached_chain is not None:
+                corpus_version = cached_chain.corpus_version()
+                lookup = functools.partial(cached_chain.answer_cache.lookup, corpus_version=corpus_version)
+                cached_results = await run_in_batch_executor(
+                    lambda: [lookup(embedding) for embedding in query_embeddings]
+                )
+
+            misses = []
+            for item, embedding, cached in zip(pending, query_embeddings, cached_results):
+                if cached is not None:
+                    results.put_nowait((item[0], cached))
+                else:
+                    misses.append((*item, embedding))
+            unanswered = misses
+            if not misses:
+                return
+            with metrics.span("retrieve"):
+                documents = await run_in_batch_executor(_retrieve_many, chain.retriever, [item[3] for item in misses])
+        except Exception as e:
+            for item in unanswered:
+                results.put_nowait((item[0], e))
+            return
+
+        for (index, question, chat_history_str, embedding), item_documents in zip(misses, documents):
+            _spawn(tasks, generate(index, question, chat_history_str, embedding, corpus_version, item_documents))
+
+    async def prepare():
+        # Chunks are prepared one after the other, while the answers of the previous ones are generated
+        for start in range(0, len(questions), BATCH_CHUNK_SIZE):
+            await answer_chunk(start, questions[start : start + BATCH_CHUNK_SIZE])
+
+    _spawn(tasks, prepare())
+    try:
+        for _ in range(len(questions)):
+            yield await results.get()
+    finally:
+        # The client went away, or every answer was yielded
+        for task in tasks:
+            task.cancel()
+
+
+def _spawn(tasks, coroutine):
+    task = asyncio.ensure_future(coroutine)
+    tasks.add(task)
+    task.add_done_callback(tasks.discard)
+
+
+def _retriever_vector_store(retriever):
+    if isinstance(retriever, ContextPackingRetriever):
+        return retriever.vector_store
+    return retriever.vectorstore
+
+
+def _embed_queries(embeddings, texts):
+    if hasattr(embeddings, "embed_queries"):
+        return embeddings.embed_queries(texts)
+    return embeddings.embed_documents(texts)
+
+
+def _retrieve_many(retriever, query_embeddings):
+    # One vector store search for all the queries, selecting the same documents as the retriever would
+    if isinstance(retriever, ContextPackingRetriever):
+        return retriever.search_and_pack_many(query_embeddings)
+
+    vector_store = retriever.vectorstore
+    k = retriever.search_kwargs.get("k", 4)
+    return [documents for documents, _ in search_many_with_embeddings(vector_store, query_embeddings, k)]
+
+
+if __name__ == "__main__":
+    import sys
+
+    # Incremental re-ingestion, e.g. from a nightly job: python chains.py https://www.example.com/ [collection]
+    sync_embeddings(sys.argv[1], *sys.argv[2:3])
@@ -0,0 +1,218 @@
+import asyncio
+import json
+import os
+import time
+from urllib.parse import urldefrag, urljoin, urlsplit, urlunsplit
+
+import aiohttp
+from bs4 import BeautifulSoup
+from langchain.docstore.document import Document
+
+CRAWL_CONCURRENCY = int(os.environ.get("CRAWL_CONCURRENCY", 16))
+CRAWL_HOST_CONCURRENCY = int(os.environ.get("CRAWL_HOST_CONCURRENCY", 4))
+CRAWL_MAX_DEPTH = int(os.environ.get("CRAWL_MAX_DEPTH", 10))
+CRAWL_MAX_PAGES = int(os.environ.get("CRAWL_MAX_PAGES", 10000))
+CRAWL_TIMEOUT = float(os.environ.get("CRAWL_TIMEOUT", 30))
+
+_DEFAULT_PORTS = {"http": 80, "https": 443}
+
+
+def normalise_url(url):
+    # Drop the fragment and default port, and lowercase the scheme and host, so each page is crawled once
+    url, _ = urldefrag(url)
+    parts = urlsplit(url)
+    scheme = parts.scheme.lower()
+    netloc = parts.hostname or ""
+    if parts.port and parts.port != _DEFAULT_PORTS.get(scheme):
+        netloc = f"{netloc}:{parts.port}"
+    return urlunsplit((scheme, netloc, parts.path or "/", parts.query, ""))
+
+
+class CrawlCache:
+    # Remembers the ETag / Last-Modified validators and outgoing links of every crawled page,
+    # so the next crawl can revalidate pages with conditional requests.
+    def __init__(self, path):
+        self.path = path
+        self.entries = {}
+        if os.path.exists(path):
+            with open(path) as f:
+                self.entries = json.load(f)
+
+    def get(self, url):
+        return self.entries.get(url)
+
+    def set(self, url, etag, last_modified, links):
+        self.entries[url] = {"etag": etag, "last_modified": last_modified, "links": links}
+
+    def retain(self, urls):
+        # Forget pages we no longer hold the content of, so they are fetched in full again
+        self.entries = {url: entry for url, entry in self.entries.items() if url in urls}
+
+    def save(self):
+        with open(self.path + ".tmp", "w") as f:
+            json.dump(self.entries, f)
+        os.replace(self.path + ".tmp", self.path)
+
+
+class CrawlResult:
+    def __init__(self):
+        # Pages which were fetched, as the Documents the langchain web loaders produce.
+        # Empty when the documents are handed to an on_document callback instead.
+        self.documents = []
+        self.fetched = 0
+        # Pages which the server reported as not modified since the previous crawl
+        self.unchanged = set()
+        # Pages which the server reported as removed (404 or 410)
+        self.gone = set()
+        # Pages which couldn't be fetched (timeouts, connection errors, other error statuses): url -> reason.
+        # They may still exist, and link to pages the crawl didn't reach because of it.
+        self.failed = {}
+        # Whether links were left unfollowed because of the page limit
+        self.truncated = False
+        # Seconds spent fetching and parsing pages, summed over the concurrent fetches. Excludes on_document.
+        self.fetch_seconds = 0.0
+
+    @property
+    def complete(self):
+        # Every page linked from the root was reached, so a page that wasn't is no longer on the site
+        return not self.failed and not self.truncated
+
+
+class Crawler:
+    # Crawls the pages below a root URL concurrently, with a limit on the total and per-host connections.
+    # With a CrawlCache, pages are revalidated with conditional requests and unchanged pages are skipped.
+    def __init__(
+        self,
+        max_concurrency=CRAWL_CONCURRENCY,
+        max_per_host=CRAWL_HOST_CONCURRENCY,
+        max_depth=CRAWL_MAX_DEPTH,
+        max_pages=CRAWL_MAX_PAGES,
+        timeout=CRAWL_TIMEOUT,
+        cache=None,
+    ):
+        self.max_concurrency = max_concurrency
+        self.max_per_host = max_per_host
+        self.max_depth = max_depth
+        self.max_pages = max_pages
+        self.timeout = timeout
+        self.cache = cache
+
+    def crawl_sync(self, url, on_document=None):
+        return asyncio.run(self.crawl(url, on_document))
+
+    async def crawl(self, url, on_document=None):
+        # on_document(document) is called from a worker thread for every fetched page, and may block
+        # to apply backpressure. Without it the documents are collected in the result.
+        root = normalise_url(url)
+        result = CrawlResult()
+        pages = asyncio.Queue()
+        seen = {root}
+        pages.put_nowait((root, 0))
+
+        connector = aiohttp.TCPConnector(limit=self.max_concurrency, limit_per_host=self.max_per_host)
+        timeout = aiohttp.ClientTimeout(total=self.timeout)
+        async with aiohttp.ClientSession(connector=connector, timeout=timeout) as session:
+
+            async def worker():
+                while True:
+                    page_url, depth = await pages.get()
+                    try:
+                        links = await self._fetch(session, page_url, result, on_document)
+                        if depth >= self.max_depth:
+                            continue
+                        # Only follow links to subpages of the root URL, like RecursiveUrlLoader
+                        for link in links:
+                            if not link.startswith(root) or link in seen:
+                                continue
+                            if len(seen) >= self.max_pages:
+                                result.truncated = True
+                                continue
+                            seen.add(link)
+                            pages.put_nowait((link, depth + 1))
+                    except Exception as e:
+                        print(f"Failed to crawl {page_url}: {e!r}")
+                        result.failed[page_url] = repr(e)
+                    finally:
+                        pages.task_done()
+
+            workers = [asyncio.create_task(worker()) for _ in range(self.max_concurrency)]
+            await pages.join()
+            for task in workers:
+                task.cancel()
+            await asyncio.gather(*workers, return_exceptions=True)
+
+        print(
+            f"Crawled {len(seen)} pages from {url}: "
+            f"{result.fetched} fetched, {len(result.unchanged)} unchanged, {len(result.gone)} gone, "
+            f"{len(result.failed)} failed."
+        )
+        return result
+
+    async def _fetch(self, session, url, result, on_document):
+        headers = {}
+        cached = self.cache.get(url) if self.cache else None
+        if cached:
+            if cached["etag"]:
+                headers["If-None-Match"] = cached["etag"]
+            if cached["last_modified"]:
+                headers["If-Modified-Since"] = cached["last_modified"]
+
+        started = time.monotonic()
+        try:
+            async with session.get(url, headers=headers) as response:
+                if response.status == 304 and cached:
+                    result.unchanged.add(url)
+                    return cached["links"]
+
+                if response.status in (404, 410):
+                    result.gone.add(url)
+                    return []
+
+                if response.status != 200:
+                    print(f"Failed to crawl {url}: HTTP {response.status}")
+                    result.failed[url] = f"HTTP {response.status}"
+                    return []
+
+                if "html" not in response.headers.get("Content-Type", ""):
+                    return []
+
+                html = await response.text()
+                etag = response.headers.get("ETag")
+                last_modified = response.headers.get("Last-Modified")
+
+            # Parsing is CPU bound, keep it off the event loop
+            loop = asyncio.get_running_loop()
+            document, links = await loop.run_in_executor(None, _parse_page, url, html)
+        finally:
+            result.fetch_seconds += time.monotonic() - started
+
+        result.fetched += 1
+        if on_document is None:
+            result.documents.append(document)
+        else:
+            await loop.run_in_executor(None, on_document, document)
+
+        if self.cache:
+            self.cache.set(url, etag, last_modified, links)
+        return links
+
+
+def _parse_page(url, html):
+    soup = BeautifulSoup(html, "html.parser")
+
+    # Same content and metadata as langchain's WebBaseLoader, which RecursiveUrlLoader uses for every page
+    metadata = {"source": url}
+    if title := soup.find("title"):
+        metadata["title"] = title.get_text()
+    if description := soup.find("meta", attrs={"name": "description"}):
+        metadata["description"] = description.get("content", "No description found.")
+    if html_tag := soup.find("html"):
+        metadata["language"] = html_tag.get("lang", "No language found.")
+
+    links = []
+    for anchor in soup.find_all("a", href=True):
+        link = urljoin(url, anchor["href"])
+        if urlsplit(link).scheme in ("http", "https"):
+            links.append(normalise_url(link))
+
+    return Document(page_content=soup.get_text(), metadata=metadata), list(dict.fromkeys(links))
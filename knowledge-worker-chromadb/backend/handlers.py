@@ -0,0 +1,139 @@
+"""LangChain callbacks and wrappers reporting to the metrics, so that importing metrics doesn't import LangChain."""
+import time
+from typing import List
+
+from langchain.callbacks.base import BaseCallbackHandler
+from langchain.embeddings.base import Embeddings
+
+import metrics
+
+# Chains combining the retrieved documents into the answer, any LLM call below them is generation
+COMBINE_DOCUMENTS_CHAINS = {
+    "StuffDocumentsChain",
+    "MapReduceDocumentsChain",
+    "RefineDocumentsChain",
+    "MapRerankDocumentsChain",
+}
+
+
+class StageCallbackHandler(BaseCallbackHandler):
+    """Times the stages of a ConversationalRetrievalChain run from its callbacks.
+
+    Runs are assigned a stage from their class and parent: the LLMChain directly under the top-level chain condenses
+    the question, retrievers retrieve, and everything below a combine documents chain generates the answer.
+    LLM calls count their tokens towards the stage they run in. When a step of the chain is called on its own, `stage`
+    names the stage of its top-level run instead.
+    """
+
+    def __init__(self, trace=None, stage="chain"):
+        self.trace = trace
+        self.stage = stage
+        # run id -> (stage, whether the run starts the stage, started)
+        self._runs = {}
+
+    def on_chain_start(self, serialized, inputs, *, run_id, parent_run_id=None, **kwargs):
+        name = (serialized.get("id") or [""])[-1]
+        parent_stage = self._stage(parent_run_id)
+        if parent_run_id is None:
+            self._start(run_id, self.stage, self.stage != "chain")
+        elif name in COMBINE_DOCUMENTS_CHAINS and parent_stage == "chain":
+            self._start(run_id, "generate", True)
+        elif name == "LLMChain" and parent_stage == "chain":
+            self._start(run_id, "condense_question", True)
+        else:
+            self._start(run_id, parent_stage, False)
+
+    def on_chain_end(self, outputs, *, run_id, **kwargs):
+        self._end(run_id)
+
+    def on_chain_error(self, error, *, run_id, **kwargs):
+        self._end(run_id, error=True)
+
+    def on_retriever_start(self, serialized, query, *, run_id, parent_run_id=None, **kwargs):
+        self._start(run_id, "retrieve", True)
+
+    def on_retriever_end(self, documents, *, run_id, **kwargs):
+        self._end(run_id)
+
+    def on_retriever_error(self, error, *, run_id, **kwargs):
+        self._end(run_id, error=True)
+
+    def on_llm_start(self, serialized, prompts, *, run_id, parent_run_id=None, **kwargs):
+        stage = self._stage(parent_run_id) if parent_run_id else self.stage
+        self._start(run_id, stage, False)
+        self._record_tokens(stage, "prompt", sum(_approximate_token_count(prompt) for prompt in prompts))
+
+    def on_llm_end(self, response, *, run_id, **kwargs):
+        stage = self._stage(run_id)
+        usage = (response.llm_output or {}).get("token_usage") or {}
+        completion_tokens = usage.get("completion_tokens")
+        if completion_tokens is None:
+            completion_tokens = sum(
+                _approximate_token_count(generation.text) for generations in response.generations
+                for generation in generations
+            )
+        self._record_tokens(stage, "completion", completion_tokens)
+        self._end(run_id)
+
+    def on_llm_error(self, error, *, run_id, **kwargs):
+        self._end(run_id, error=True)
+
+    def _record_tokens(self, stage, kind, count):
+        metrics.LLM_TOKENS.inc(count, stage=stage, kind=kind)
+        if self.trace is not None:
+            self.trace.add_tokens(kind, count)
+
+    def _stage(self, run_id):
+        run = self._runs.get(run_id)
+        return run[0] if run else self.stage
+
+    def _start(self, run_id, stage, timed):
+        self._runs[run_id] = (stage, timed, time.perf_counter())
+
+    def _end(self, run_id, error=False):
+        run = self._runs.pop(run_id, None)
+        if run is None:
+            return
+        stage, timed, started = run
+        if error:
+            metrics.ERRORS.inc(stage=stage)
+            if self.trace is not None:
+                self.trace.status = "error"
+        if timed:
+            elapsed = time.perf_counter() - started
+            metrics.STAGE_SECONDS.observe(elapsed, stage=stage)
+            if self.trace is not None:
+                self.trace.add_stage(stage, elapsed)
+
+
+class TimedEmbeddings(Embeddings):
+    """Times the calls to an embeddings model, i.e. the requests which weren't served by a cache."""
+
+    def __init__(self, embeddings: Embeddings):
+        self.embeddings = embeddings
+        self.model_name = getattr(embeddings, "model_name", type(embeddings).__name__)
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        with metrics.span("embed_documents"):
+            return self.embeddings.embed_documents(texts)
+
+    def embed_query(self, text: str) -> List[float]:
+        with metrics.span("embed_query"):
+            return self.embeddings.embed_query(text)
+
+    def embed_queries(self, texts: List[str]) -> List[List[float]]:
+        with metrics.span("embed_query"):
+            return getattr(self.embeddings, "embed_queries", self.embeddings.embed_documents)(texts)
+
+
+class TokenQueueHandler(BaseCallbackHandler):
+    # Forwards tokens from a streaming model to a queue, so they can be consumed while generation runs
+    def __init__(self, tokens):
+        self.tokens = tokens
+
+    def on_llm_new_token(self, token, **kwargs):
+        self.tokens.put(token)
+
+
+def _approximate_token_count(text):
+    return len(text) // 4 + 1
@@ -0,0 +1,106 @@
+"""Ingestion jobs run in the background, so the server starts (and keeps) serving while a corpus is embedded."""
+import threading
+import time
+import traceback
+import uuid
+from collections import deque
+from typing import Callable, Optional
+
+
+class JobAlreadyRunning(Exception):
+    """A collection is already being ingested."""
+
+
+class IngestionJob:
+    """One ingestion of a collection: its state, and its progress read from the running pipeline.
+
+    Arguments:
+        kind (str): "initial", "sync" or "rebuild".
+        url (str): The website ingested.
+        collection (str): The collection ingested into, None for the default one.
+    """
+
+    def __init__(self, kind: str, url: str, collection: Optional[str] = None):
+        self.id = uuid.uuid4().hex[:12]
+        self.kind = kind
+        self.url = url
+        self.collection = collection
+        self.state = "pending"
+        self.created_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+        self.error = None
+        # Set by the ingestion while it runs, so its progress can be reported
+        self.pipeline = None
+        self.stats = None
+
+    @property
+    def running(self) -> bool:
+        return self.state in ("pending", "running")
+
+    def run(self, func: Callable[["IngestionJob"], None]):
+        self.state = "running"
+        self.started_at = time.time()
+        try:
+            func(self)
+        except Exception as e:
+            traceback.print_exc()
+            self.state = "failed"
+            self.error = f"{type(e).__name__}: {e}"
+        else:
+            self.state = "succeeded"
+        finally:
+            self.finished_at = time.time()
+
+    def as_dict(self):
+        job = {
+            "id": self.id,
+            "kind": self.kind,
+            "url": self.url,
+            "collection": self.collection,
+            "state": self.state,
+            "created_at": self.created_at,
+            "started_at": self.started_at,
+            "finished_at": self.finished_at,
+            "error": self.error,
+        }
+        if self.stats is not None:
+            job["stats"] = self.stats
+        elif self.pipeline is not None:
+            job["progress"] = self.pipeline.progress()
+        return job
+
+
+class IngestionJobs:
+    """Runs ingestion jobs on their own threads, at most one per collection, and keeps the most recent ones.
+
+    Ingestion is long running and mostly waits on the crawler and the embeddings API, so it gets a thread of its own
+    rather than one of the workers answering questions.
+    """
+
+    def __init__(self, history: int = 20):
+        self._jobs = deque(maxlen=history)
+        self._lock = threading.Lock()
+
+    def start(self, kind: str, url: str, collection: Optional[str], func: Callable[[IngestionJob], None]):
+        """Start `func(job)` in the background, or raise JobAlreadyRunning if the collection is being ingested."""
+        with self._lock:
+            running = self.running(collection)
+            if running is not None:
+                raise JobAlreadyRunning(f"Job {running.id} is already ingesting this collection")
+
+            job = IngestionJob(kind, url, collection)
+            self._jobs.append(job)
+
+        threading.Thread(target=job.run, args=(func,), name=f"ingestion-{job.id}", daemon=True).start()
+        return job
+
+    def running(self, collection: Optional[str] = None) -> Optional[IngestionJob]:
+        for job in list(self._jobs):
+            if job.running and job.collection == collection:
+                return job
+        return None
+
+    def recent(self):
+        # Most recent first
+        return list(reversed(self._jobs))
@@ -0,0 +1,15 @@
+"""Serving entry point: `uvicorn main:app`.
+
+Importing it only imports the API and its light modules. LangChain, the vector store and the chain are loaded in the
+background once the server started, see api.startup_event, so a new worker answers its health checks right away.
+"""
+import os
+
+from api import app
+
+__all__ = ["app"]
+
+if __name__ == "__main__":
+    import uvicorn
+
+    uvicorn.run(app, host="0.0.0.0", port=int(os.environ.get("PORT", 8000)))
@@ -0,0 +1,233 @@
+"""Per-stage timings, counters and latency histograms, exposed in the Prometheus text format."""
+import contextlib
+import contextvars
+import json
+import logging
+import os
+import threading
+import time
+from bisect import bisect_left
+from collections import defaultdict
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+# Disabled, requests aren't traced and spans are a no-op, so the overhead is a flag check per request
+METRICS_ENABLED = os.environ.get("METRICS_ENABLED", "true").lower() == "true"
+# Opt-in JSON log line per request, with its stage timings and token counts
+METRICS_LOG_REQUESTS = os.environ.get("METRICS_LOG_REQUESTS", "false").lower() == "true"
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+logger = logging.getLogger("knowledge_worker.requests")
+if METRICS_LOG_REQUESTS and not logger.handlers:
+    logger.addHandler(logging.StreamHandler())
+    logger.setLevel(logging.INFO)
+    logger.propagate = False
+
+
+class Counter:
+    def __init__(self, name, help_text, labels=()):
+        self.name = name
+        self.help_text = help_text
+        self.labels = labels
+        self._values = defaultdict(float)
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1.0, **labels):
+        key = tuple(labels.get(label, "") for label in self.labels)
+        with self._lock:
+            self._values[key] += amount
+
+    def render(self):
+        yield f"# HELP {self.name} {self.help_text}"
+        yield f"# TYPE {self.name} counter"
+        with self._lock:
+            values = list(self._values.items())
+        for key, value in values:
+            yield f"{self.name}{_format_labels(zip(self.labels, key))} {_format_value(value)}"
+
+
+class Histogram:
+    def __init__(self, name, help_text, labels=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.labels = labels
+        self.buckets = buckets
+        # Per label values: the count of each bucket (and +Inf), and the sum of the observations
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = tuple(labels.get(label, "") for label in self.labels)
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            counts, total = self._values.get(key, ([0] * (len(self.buckets) + 1), 0.0))
+            counts[index] += 1
+            self._values[key] = (counts, total + value)
+
+    def render(self):
+        yield f"# HELP {self.name} {self.help_text}"
+        yield f"# TYPE {self.name} histogram"
+        with self._lock:
+            values = [(key, list(counts), total) for key, (counts, total) in self._values.items()]
+        for key, counts, total in values:
+            labels = list(zip(self.labels, key))
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                le = "+Inf" if bound == float("inf") else _format_value(bound)
+                yield f"{self.name}_bucket{_format_labels(labels + [('le', le)])} {cumulative}"
+            yield f"{self.name}_sum{_format_labels(labels)} {_format_value(total)}"
+            yield f"{self.name}_count{_format_labels(labels)} {cumulative}"
+
+
+REQUESTS = Counter(
+    "knowledge_worker_requests_total", "Requests answered, by endpoint and status.", ("endpoint", "status")
+)
+REQUEST_SECONDS = Histogram("knowledge_worker_request_seconds", "Request latency, by endpoint.", ("endpoint",))
+STAGE_SECONDS = Histogram(
+    "knowledge_worker_stage_seconds",
+    "Latency of the stages of answering a question (condense_question, retrieve, embed_query, generate, ...).",
+    ("stage",),
+)
+LLM_TOKENS = Counter(
+    "knowledge_worker_llm_tokens_total",
+    "LLM tokens by stage and kind (prompt or completion), estimated when the model doesn't report usage.",
+    ("stage", "kind"),
+)
+ERRORS = Counter("knowledge_worker_errors_total", "Errors, by stage.", ("stage",))
+_METRICS = [REQUESTS, REQUEST_SECONDS, STAGE_SECONDS, LLM_TOKENS, ERRORS]
+
+# Read on every scrape, e.g. the hit and miss counts kept by the caches: (name, help, labels, value) tuples
+_collectors: List[Callable[[], Iterable[Tuple[str, str, Dict[str, str], float]]]] = []
+
+_current_trace = contextvars.ContextVar("knowledge_worker_trace", default=None)
+
+
+class RequestTrace:
+    """The stage timings and token counts of one request, for its structured log line."""
+
+    def __init__(self, endpoint):
+        self.endpoint = endpoint
+        self.started = time.perf_counter()
+        self.stages = defaultdict(float)
+        self.tokens = defaultdict(int)
+        self.status = "ok"
+        self._lock = threading.Lock()
+
+    def add_stage(self, stage, seconds):
+        with self._lock:
+            self.stages[stage] += seconds
+
+    def add_tokens(self, kind, count):
+        with self._lock:
+            self.tokens[kind] += count
+
+
+@contextlib.contextmanager
+def trace_request(endpoint):
+    """Time a request, counting it by status. Yields its RequestTrace, or None when metrics are disabled."""
+    if not METRICS_ENABLED:
+        yield None
+        return
+
+    trace = RequestTrace(endpoint)
+    token = _current_trace.set(trace)
+    try:
+        yield trace
+    except BaseException:
+        trace.status = "error"
+        raise
+    finally:
+        try:
+            _current_trace.reset(token)
+        except ValueError:
+            # A streaming response's generator closed from another context when the client went away
+            pass
+        finish_request(trace)
+
+
+def finish_request(trace):
+    elapsed = time.perf_counter() - trace.started
+    REQUESTS.inc(endpoint=trace.endpoint, status=trace.status)
+    REQUEST_SECONDS.observe(elapsed, endpoint=trace.endpoint)
+    if METRICS_LOG_REQUESTS:
+        logger.info(
+            json.dumps(
+                {
+                    "endpoint": trace.endpoint,
+                    "status": trace.status,
+                    "seconds": round(elapsed, 4),
+                    "stages": {stage: round(seconds, 4) for stage, seconds in trace.stages.items()},
+                    "tokens": dict(trace.tokens),
+                }
+            )
+        )
+
+
+@contextlib.contextmanager
+def span(stage):
+    """Time a stage, adding it to the histogram and to the trace of the current request."""
+    if not METRICS_ENABLED:
+        yield
+        return
+
+    started = time.perf_counter()
+    try:
+        yield
+    except BaseException:
+        ERRORS.inc(stage=stage)
+        raise
+    finally:
+        record_stage(stage, time.perf_counter() - started)
+
+
+def record_stage(stage, seconds):
+    STAGE_SECONDS.observe(seconds, stage=stage)
+    trace = _current_trace.get()
+    if trace is not None:
+        trace.add_stage(stage, seconds)
+
+
+def register_collector(collector):
+    _collectors.append(collector)
+
+
+def render():
+    """All metrics in the Prometheus text exposition format."""
+    lines = []
+    for metric in _METRICS:
+        lines.extend(metric.render())
+
+    samples = defaultdict(list)
+    helps = {}
+    for collector in _collectors:
+        for name, help_text, labels, value in collector():
+            helps[name] = help_text
+            samples[name].append(f"{name}{_format_labels(labels.items())} {_format_value(value)}")
+    for name, lines_of_metric in samples.items():
+        lines.append(f"# HELP {name} {helps[name]}")
+        lines.append(f"# TYPE {name} counter")
+        lines.extend(lines_of_metric)
+
+    return "\n".join(lines) + "\n"
+
+
+def callbacks(trace: Optional[RequestTrace], stage: str = "chain") -> list:
+    """LangChain callbacks timing the stages of a chain run as part of a request, none when metrics are disabled."""
+    if trace is None:
+        return []
+
+    # Imports LangChain, which requests only need once they run a chain
+    from handlers import StageCallbackHandler
+
+    return [StageCallbackHandler(trace, stage)]
+
+
+def _format_labels(labels):
+    labels = [(key, str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")) for key, value in labels]
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{key}="{value}"' for key, value in labels) + "}"
+
+
+def _format_value(value):
+    return repr(float(value)) if not float(value).is_integer() else str(int(value))
@@ -0,0 +1,271 @@
+import hashlib
+import json
+import os
+import queue
+import threading
+import time
+
+PIPELINE_QUEUE_SIZE = int(os.environ.get("PIPELINE_QUEUE_SIZE", 64))
+# Number of chunks embedded and written to the vector store at a time
+PIPELINE_BATCH_SIZE = int(os.environ.get("PIPELINE_BATCH_SIZE", 100))
+# Minimum seconds between two checkpoints, the manifest grows with the corpus so it isn't saved after every batch
+PIPELINE_CHECKPOINT_INTERVAL = float(os.environ.get("PIPELINE_CHECKPOINT_INTERVAL", 10))
+
+_END = object()
+
+
+def fingerprint(*parts):
+    content = json.dumps(parts, sort_keys=True, default=str)
+    return hashlib.sha256(content.encode("utf-8")).hexdigest()
+
+
+class _StageStats:
+    # The time a stage spends blocked on the next stage's full queue is counted apart from its busy time,
+    # so a stage waiting on a slower one downstream isn't reported as slow itself
+    def __init__(self, name):
+        self.name = name
+        self.items = 0
+        self.busy_seconds = 0.0
+        self.queue_wait_seconds = 0.0
+
+    def record(self, items, started, waited=0.0):
+        # `waited` is the part of the time since `started` spent blocked on the next stage's queue
+        self.items += items
+        self.busy_seconds += time.monotonic() - started - waited
+        self.queue_wait_seconds += waited
+
+    def as_dict(self, elapsed):
+        return {
+            "items": self.items,
+            "busy_seconds": round(self.busy_seconds, 3),
+            "queue_wait_seconds": round(self.queue_wait_seconds, 3),
+            "items_per_second": round(self.items / elapsed, 2) if elapsed else 0.0,
+        }
+
+
+class IngestionPipeline:
+    # Streams pages from the crawler through the splitter, the embedder and the vector store writer.
+    # The stages run in their own threads, connected by bounded queues, so they overlap in time and
+    # only a bounded number of pages and chunks is held in memory, however large the corpus.
+    #
+    # The manifest (fingerprint and chunk ids per source page) doubles as the checkpoint: it is updated
+    # once a page's chunks are written, and saved periodically, so a crashed run resumes where it stopped.
+    def __init__(
+        self,
+        vector_store,
+        manifest,
+        text_splitter,
+        checkpoint,
+        batch_size=PIPELINE_BATCH_SIZE,
+        queue_size=PIPELINE_QUEUE_SIZE,
+        checkpoint_interval=PIPELINE_CHECKPOINT_INTERVAL,
+    ):
+        self.vector_store = vector_store
+        self.manifest = manifest
+        self.text_splitter = text_splitter
+        self.checkpoint = checkpoint
+        self.batch_size = batch_size
+        self.queue_size = queue_size
+        self.checkpoint_interval = checkpoint_interval
+
+        self.stats = {name: _StageStats(name) for name in ("crawl", "split", "embed", "write")}
+        self.added, self.deleted, self.unchanged = 0, 0, 0
+        self._seen_sources = set()
+        self._stopped = threading.Event()
+        self._errors = []
+        self._last_checkpoint = time.monotonic()
+
+    def run(self, crawler, url):
+        started = time.monotonic()
+        pages = queue.Queue(maxsize=self.queue_size)
+        chunked_pages = queue.Queue(maxsize=self.queue_size)
+        batches = queue.Queue(maxsize=2)
+
+        crawl = {}
+        threads = [
+            threading.Thread(target=self._guard, args=(self._crawl, crawler, url, pages, crawl)),
+            threading.Thread(target=self._guard, args=(self._split, pages, chunked_pages)),
+            threading.Thread(target=self._guard, args=(self._embed, chunked_pages, batches)),
+            threading.Thread(target=self._guard, args=(self._write, batches)),
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        if self._errors:
+            # Keep the progress made so far, the manifest only lists pages whose chunks were written
+            self.checkpoint(self.manifest)
+            raise self._errors[0]
+
+        # Pages which disappeared from the site take their chunks with them. When the crawl didn't reach every page
+        # (a page failed to load, or the page limit was hit) only the pages the server reported as removed are:
+        # a page which failed, or which is only linked from one that did, may well still be on the site.
+        result = crawl["result"]
+        self._seen_sources.update(result.unchanged)
+        self.unchanged += len(result.unchanged)
+        stale_sources = set(self.manifest["sources"]).difference(self._seen_sources)
+        if not result.complete:
+            kept = stale_sources.difference(result.gone)
+            if kept:
+                print(f"Incomplete crawl ({len(result.failed)} pages failed), keeping {len(kept)} pages not reached.")
+            stale_sources.intersection_update(result.gone)
+        for source in stale_sources:
+            stale_chunk_ids = self.manifest["sources"].pop(source)["chunks"]
+            if stale_chunk_ids:
+                self.vector_store.delete(ids=stale_chunk_ids)
+            self.deleted += len(stale_chunk_ids)
+        self.checkpoint(self.manifest)
+
+        elapsed = time.monotonic() - started
+        return {
+            "added": self.added,
+            "deleted": self.deleted,
+            "unchanged": self.unchanged,
+            "failed": len(result.failed),
+            "seconds": round(elapsed, 3),
+            "stages": {name: stats.as_dict(elapsed) for name, stats in self.stats.items()},
+        }
+
+    def progress(self):
+        # Read from another thread while the pipeline runs, e.g. to report it on /status
+        return {
+            "pages_crawled": self.stats["crawl"].items,
+            "chunks_embedded": self.stats["embed"].items,
+            "chunks_written": self.stats["write"].items,
+            "added": self.added,
+            "unchanged": self.unchanged,
+        }
+
+    def _guard(self, stage, *args):
+        # A failing stage stops the others, instead of leaving them blocked on a queue
+        try:
+            stage(*args)
+        except Exception as e:
+            self._errors.append(e)
+            self._stopped.set()
+
+    def _put(self, items, item):
+        # Returns the seconds spent waiting for room in the queue
+        started = time.monotonic()
+        while not self._stopped.is_set():
+            try:
+                items.put(item, timeout=0.5)
+                break
+            except queue.Full:
+                pass
+        return time.monotonic() - started
+
+    def _get(self, items):
+        while not self._stopped.is_set():
+            try:
+                return items.get(timeout=0.5)
+            except queue.Empty:
+                pass
+        return _END
+
+    def _crawl(self, crawler, url, pages, crawl):
+        def on_document(document):
+            started = time.monotonic()
+            self.stats["crawl"].record(1, started, waited=self._put(pages, document))
+
+        try:
+            crawl["result"] = crawler.crawl_sync(url, on_document=on_document)
+            # The crawler fetches pages concurrently and hands them over once fetched, it times the fetches itself
+            self.stats["crawl"].busy_seconds = crawl["result"].fetch_seconds
+        finally:
+            self._put(pages, _END)
+
+    def _split(self, pages, chunked_pages):
+        try:
+            for document in iter(lambda: self._get(pages), _END):
+                started = time.monotonic()
+                source = document.metadata["source"]
+                self._seen_sources.add(source)
+                page_fingerprint = fingerprint(document.page_content, document.metadata)
+
+                entry = self.manifest["sources"].get(source)
+                if entry and entry["fingerprint"] == page_fingerprint:
+                    self.unchanged += 1
+                    continue
+
+                # Identify chunks by content, so chunks which didn't change within a changed page are kept
+                chunks = {
+                    fingerprint(source, chunk.page_content): chunk
+                    for chunk in self.text_splitter.split_documents([document])
+                }
+                previous_chunk_ids = set(entry["chunks"]) if entry else set()
+                page = {
+                    "source": source,
+                    "fingerprint": page_fingerprint,
+                    "chunk_ids": list(chunks),
+                    "new_chunks": {
+                        chunk_id: chunk for chunk_id, chunk in chunks.items() if chunk_id not in previous_chunk_ids
+                    },
+                    "stale_chunk_ids": list(previous_chunk_ids.difference(chunks)),
+                }
+                self.stats["split"].record(len(chunks), started, waited=self._put(chunked_pages, page))
+        finally:
+            self._put(chunked_pages, _END)
+
+    def _embed(self, chunked_pages, batches):
+        try:
+            batch, size = [], 0
+            for page in iter(lambda: self._get(chunked_pages), _END):
+                batch.append(page)
+                size += len(page["new_chunks"])
+                if size >= self.batch_size:
+                    self._put_batch(batches, self._embed_batch(batch))
+                    batch, size = [], 0
+            if batch:
+                self._put_batch(batches, self._embed_batch(batch))
+        finally:
+            self._put(batches, _END)
+
+    def _put_batch(self, batches, embedded_batch):
+        started = time.monotonic()
+        self.stats["embed"].record(0, started, waited=self._put(batches, embedded_batch))
+
+    def _embed_batch(self, batch):
+        started = time.monotonic()
+        texts = [chunk.page_content for page in batch for chunk in page["new_chunks"].values()]
+        embeddings = self.vector_store._embedding_function.embed_documents(texts) if texts else []
+        self.stats["embed"].record(len(texts), started)
+        return batch, embeddings
+
+    def _add_embeddings(self, ids, embeddings, chunks):
+        texts = [chunk.page_content for chunk in chunks]
+        metadatas = [chunk.metadata for chunk in chunks]
+        # Stores taking precomputed embeddings (MmapVectorStore), otherwise write to the Chroma collection directly
+        if hasattr(self.vector_store, "add_embeddings"):
+            self.vector_store.add_embeddings(texts, embeddings, metadatas=metadatas, ids=ids)
+        else:
+            self.vector_store._collection.add(ids=ids, embeddings=embeddings, documents=texts, metadatas=metadatas)
+
+    def _write(self, batches):
+        for batch, embeddings in iter(lambda: self._get(batches), _END):
+            started = time.monotonic()
+            ids = [chunk_id for page in batch for chunk_id in page["new_chunks"]]
+            chunks = [chunk for page in batch for chunk in page["new_chunks"].values()]
+
+            if ids:
+                # Deleting first makes the write idempotent, in case a previous run stopped before its checkpoint
+                self.vector_store.delete(ids=ids)
+                self._add_embeddings(ids, embeddings, chunks)
+
+            stale_chunk_ids = [chunk_id for page in batch for chunk_id in page["stale_chunk_ids"]]
+            if stale_chunk_ids:
+                self.vector_store.delete(ids=stale_chunk_ids)
+
+            for page in batch:
+                self.manifest["sources"][page["source"]] = {
+                    "fingerprint": page["fingerprint"],
+                    "chunks": page["chunk_ids"],
+                }
+            if time.monotonic() - self._last_checkpoint >= self.checkpoint_interval:
+                self.checkpoint(self.manifest)
+                self._last_checkpoint = time.monotonic()
+
+            self.added += len(ids)
+            self.deleted += len(stale_chunk_ids)
+            self.stats["write"].record(len(ids), started)
@@ -0,0 +1,181 @@
+"""A pool of opened vector stores, one per collection, evicted least recently used first under a memory budget."""
+import os
+import re
+import threading
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Optional
+
+# Collection names become directory names, so they are restricted to a safe alphabet
+COLLECTION_NAME = re.compile(r"^[A-Za-z0-9][A-Za-z0-9_-]{0,63}$")
+
+
+class CollectionNotFound(KeyError):
+    """The collection requested has no persisted store."""
+
+
+class PooledStore:
+    """An opened vector store, with the chains built on it, which are evicted along with it.
+
+    Its chains are kept least recently used first, up to the `max_chains` given when adding one.
+    """
+
+    def __init__(self, collection: str, vector_store, size_bytes: int):
+        self.collection = collection
+        self.vector_store = vector_store
+        self.size_bytes = size_bytes
+        self.qa_chains: "OrderedDict[Any, Any]" = OrderedDict()
+        # Serialises building chains, which can take seconds
+        self.lock = threading.Lock()
+        self._chains_lock = threading.Lock()
+
+    def get_chain(self, key):
+        with self._chains_lock:
+            chain = self.qa_chains.get(key)
+            if chain is not None:
+                self.qa_chains.move_to_end(key)
+            return chain
+
+    def add_chain(self, key, chain, max_chains: int = 0):
+        with self._chains_lock:
+            self.qa_chains[key] = chain
+            while max_chains and len(self.qa_chains) > max_chains:
+                self.qa_chains.popitem(last=False)
+
+    def chains(self):
+        with self._chains_lock:
+            return list(self.qa_chains.items())
+
+
+class VectorStorePool:
+    """Opens the vector store of a collection on first use, and keeps the most recently used ones open.
+
+    Stores are evicted least recently used first once the stores open exceed `memory_budget_bytes`, estimated from
+    their size on disk: Chroma loads its persisted collection into memory, and the pages of a memory-mapped store are
+    what it would keep resident when searched. The store just opened is never evicted, so a collection larger than
+    the budget is still served. Requests holding an evicted store keep using it until they complete.
+
+    Concurrent first opens of a collection are serialised by a lock per collection, so it's opened once, while
+    collections opening at the same time don't wait for each other.
+
+    Arguments:
+        open_store (Callable[[str, str], VectorStore]): Opens the store of a collection, given its name and directory.
+        directory_of (Callable[[str], str]): The persist directory of a collection.
+        memory_budget_bytes (int): The estimated memory of the stores kept open, 0 for no limit.
+        max_open (int): The stores kept open, 0 for no limit.
+    """
+
+    def __init__(
+        self,
+        open_store: Callable[[str, str], Any],
+        directory_of: Callable[[str], str],
+        memory_budget_bytes: int = 0,
+        max_open: int = 0,
+    ):
+        self.open_store = open_store
+        self.directory_of = directory_of
+        self.memory_budget_bytes = memory_budget_bytes
+        self.max_open = max_open
+        self.evictions = 0
+        self._stores: "OrderedDict[str, PooledStore]" = OrderedDict()
+        self._opening: Dict[str, threading.Lock] = {}
+        # Bumped when a collection is discarded, so a store opened from its previous directory isn't kept
+        self._generations: Dict[str, int] = {}
+        self._lock = threading.Lock()
+
+    def get(self, collection: str, create: bool = False) -> PooledStore:
+        """The opened store of the collection. Unless `create`, raises CollectionNotFound when it was never persisted."""
+        store = self.get_opened(collection)
+        if store is not None:
+            return store
+
+        with self._lock:
+            opening = self._opening.setdefault(collection, threading.Lock())
+            generation = self._generations.get(collection, 0)
+
+        with opening:
+            # Another request may have opened it while this one waited
+            store = self.get_opened(collection)
+            if store is not None:
+                return store
+
+            directory = self.directory_of(collection)
+            if not create and not os.path.exists(directory):
+                raise CollectionNotFound(collection)
+
+            vector_store = self.open_store(collection, directory)
+            store = PooledStore(collection, vector_store, directory_size(directory))
+            with self._lock:
+                self._opening.pop(collection, None)
+                if self._generations.get(collection, 0) == generation:
+                    self._stores[collection] = store
+                    self._evict(keep=collection)
+
+        return store
+
+    def discard(self, collection: Optional[str] = None):
+        """Close the store of the collection, or of every collection, e.g. after it was rebuilt."""
+        with self._lock:
+            # Including the collections being opened, whose directory may be the one discarded
+            for discarded in set(self._stores) | set(self._opening) if collection is None else [collection]:
+                self._stores.pop(discarded, None)
+                self._generations[discarded] = self._generations.get(discarded, 0) + 1
+
+    def update_size(self, collection: str):
+        """Re-estimate the size of an open store after writing to it, evicting others if it grew past the budget."""
+        store = self.get_opened(collection)
+        if store is None:
+            return
+        size_bytes = directory_size(self.directory_of(collection))
+        with self._lock:
+            store.size_bytes = size_bytes
+            self._evict(keep=collection)
+
+    def stores(self):
+        with self._lock:
+            return list(self._stores.values())
+
+    @property
+    def size_bytes(self) -> int:
+        with self._lock:
+            return sum(store.size_bytes for store in self._stores.values())
+
+    def get_opened(self, collection) -> Optional[PooledStore]:
+        """The store of the collection if it is open, without opening it."""
+        with self._lock:
+            store = self._stores.get(collection)
+            if store is not None:
+                self._stores.move_to_end(collection)
+            return store
+
+    def _evict(self, keep):
+        # Called with the lock held
+        def over_budget():
+            if self.max_open and len(self._stores) > self.max_open:
+                return True
+            size = sum(store.size_bytes for store in self._stores.values())
+            return bool(self.memory_budget_bytes) and size > self.memory_budget_bytes
+
+        for collection in list(self._stores):
+            if not over_budget():
+                break
+            if collection != keep:
+                del self._stores[collection]
+                self.evictions += 1
+
+
+def directory_size(directory: str) -> int:
+    size = 0
+    for root, _, files in os.walk(directory):
+        for name in files:
+            try:
+                size += os.path.getsize(os.path.join(root, name))
+            except OSError:
+                # Replaced while walking, e.g. by a concurrent write
+                pass
+    return size
+
+
+def validate_collection_name(collection: str) -> str:
+    if not COLLECTION_NAME.match(collection):
+        raise ValueError(f"Invalid collection name: {collection!r}")
+    return collection
@@ -0,0 +1,136 @@
+import functools
+import hashlib
+import os
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+# The benchmarks' fakes of the Vertex AI models
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir, os.pardir, os.pardir, "benchmarks"))
+
+
+class FixtureSite:
+    """A website served from memory on a local port, whose pages a test can change between crawls.
+
+    Pages are added with `page(path, body, ...)`, and answer 304 to a conditional request matching their ETag.
+    Every request is recorded in `requests`, as (path, headers).
+    """
+
+    def __init__(self):
+        self.pages = {}
+        self.requests = []
+        self._server = ThreadingHTTPServer(("127.0.0.1", 0), self._handler())
+        self._server.daemon_threads = True
+        self.url = f"http://127.0.0.1:{self._server.server_port}/"
+
+    def page(self, path, body="", links=(), status=200, etag=None, content_type="text/html", delay=0.0):
+        anchors = "".join(f'<a href="{link}">{link}</a>' for link in links)
+        self.pages[path] = {
+            "status": status,
+            "body": f"<html><head><title>{path}</title></head><body><p>{body}</p>{anchors}</body></html>",
+            "etag": etag,
+            "content_type": content_type,
+            "delay": delay,
+        }
+
+    def requested(self, path):
+        return [headers for requested_path, headers in self.requests if requested_path == path]
+
+    def start(self):
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def _handler(self):
+        site = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                site.requests.append((self.path, dict(self.headers)))
+                page = site.pages.get(self.path)
+                if page is None:
+                    self._respond(404, "text/plain", b"Not found")
+                    return
+
+                time.sleep(page["delay"])
+                if page["etag"] and self.headers.get("If-None-Match") == page["etag"]:
+                    self._respond(304)
+                    return
+                headers = {"ETag": page["etag"]} if page["etag"] else {}
+                self._respond(page["status"], page["content_type"], page["body"].encode("utf-8"), headers)
+
+            def _respond(self, status, content_type=None, body=b"", headers=None):
+                self.send_response(status)
+                for name, value in (headers or {}).items():
+                    self.send_header(name, value)
+                if content_type:
+                    self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        return Handler
+
+
+class FakeEmbeddings:
+    """Deterministic embeddings derived from a hash of the text, counting the texts embedded."""
+
+    def __init__(self, dimensions=16):
+        self.dimensions = dimensions
+        self.embedded = 0
+
+    def embed_documents(self, texts):
+        self.embedded += len(texts)
+        return [self._embed(text) for text in texts]
+
+    def embed_query(self, text):
+        self.embedded += 1
+        return self._embed(text)
+
+    def _embed(self, text):
+        digest = hashlib.sha256(text.encode("utf-8")).digest()
+        return [byte / 255 - 0.5 for byte in digest[: self.dimensions]]
+
+
+@pytest.fixture
+def embeddings():
+    return FakeEmbeddings()
+
+
+@pytest.fixture
+def site():
+    site = FixtureSite()
+    site.start()
+    yield site
+    site.stop()
+
+
+@pytest.fixture
+def backend(monkeypatch, tmp_path, embeddings):
+    """The chains module serving from memory-mapped stores in `tmp_path`, with fake embeddings and chat model."""
+    import chains
+    import fakes
+    from store_pool import VectorStorePool
+
+    # The stores are persisted relative to the working directory
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(chains, "VECTOR_STORE", "mmap")
+    monkeypatch.setattr(chains, "ChatVertexAI", functools.partial(fakes.FakeChatModel, latency=0.0))
+    monkeypatch.setattr(chains, "_embeddings", embeddings)
+    monkeypatch.setattr(
+        chains,
+        "_stores",
+        VectorStorePool(
+            open_store=lambda collection, directory: chains.load_embeddings(directory),
+            directory_of=chains.live_directory,
+        ),
+    )
+    return chains
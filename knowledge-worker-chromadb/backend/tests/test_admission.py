@@ -0,0 +1,197 @@
+import asyncio
+import os
+import threading
+
+import httpx
+import pytest
+
+os.environ.setdefault("BACKEND_URL", "http://127.0.0.1/")
+
+import api  # noqa: E402
+import chains  # noqa: E402
+from admission import AdmissionController, SingleFlight  # noqa: E402
+
+
+class FakeChainRuns:
+    """Stands in for chains.arun_chain: records the questions run, and holds each run until `finish` is set."""
+
+    def __init__(self, error=None):
+        self.error = error
+        self.questions = []
+        self.finish = None
+
+    async def __call__(self, qa_chain, inputs, callbacks=None):
+        self.questions.append(inputs["question"])
+        await self.finish.wait()
+        if self.error is not None:
+            raise self.error
+        return {"question": inputs["question"], "answer": f"The answer to {inputs['question']}", "source_documents": []}
+
+
+@pytest.fixture
+def chain_runs(monkeypatch):
+    index_loaded = threading.Event()
+    index_loaded.set()
+    monkeypatch.setattr(api, "index_loaded", index_loaded)
+    monkeypatch.setattr(api, "in_flight_questions", SingleFlight())
+    monkeypatch.setattr(api, "admission", AdmissionController(max_concurrency=1, max_queue=4, queue_timeout=5.0))
+
+    async def aget_qa_chain(temperature, k, collection=None):
+        return object()
+
+    runs = FakeChainRuns()
+    monkeypatch.setattr(chains, "aget_qa_chain", aget_qa_chain)
+    monkeypatch.setattr(chains, "compact_chat_history", lambda chat_history, session_id=None: chat_history)
+    monkeypatch.setattr(chains, "arun_chain", runs)
+    return runs
+
+
+async def _until(condition):
+    for _ in range(500):
+        if condition():
+            return
+        await asyncio.sleep(0.01)
+    raise AssertionError("Timed out waiting for the condition")
+
+
+def _serve(chain_runs, scenario):
+    # Runs `scenario(query)` against the app, where `query(question, client_id=None)` starts a /query request
+    async def run():
+        chain_runs.finish = asyncio.Event()
+        transport = httpx.ASGITransport(app=api.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+
+            def query(question, client_id=None):
+                headers = {api.CLIENT_ID_HEADER: client_id} if client_id else {}
+                message = {"question": question, "chat_history": []}
+                return asyncio.ensure_future(client.post("/query", json=message, headers=headers))
+
+            return await asyncio.wait_for(scenario(query), 10)
+
+    return asyncio.run(run())
+
+
+def test_identical_questions_in_flight_share_one_chain_run(chain_runs):
+    async def scenario(query):
+        first = query("What is A?")
+        await _until(lambda: chain_runs.questions)
+        same, other = query("  what is a?"), query("What is B?")
+        await _until(lambda: api.in_flight_questions.coalesced == 1 and api.admission.queued == 1)
+        chain_runs.finish.set()
+        return await asyncio.gather(first, same, other)
+
+    first, same, other = _serve(chain_runs, scenario)
+
+    assert chain_runs.questions == ["What is A?", "What is B?"]
+    assert first.json()["answer"] == same.json()["answer"] == "The answer to What is A?"
+    # Each request gets the shared answer to its question, in its own words
+    assert same.json()["question"] == "  what is a?"
+    assert other.json()["answer"] == "The answer to What is B?"
+
+
+def test_a_failed_run_fails_every_request_waiting_on_it(chain_runs):
+    chain_runs.error = RuntimeError("quota exceeded")
+
+    async def scenario(query):
+        leader = query("What is A?")
+        await _until(lambda: chain_runs.questions)
+        followers = [query("What is A?") for _ in range(2)]
+        await _until(lambda: api.in_flight_questions.coalesced == 2)
+        chain_runs.finish.set()
+        responses = await asyncio.gather(leader, *followers)
+        # Nothing is left of the failed run, the question is run again
+        chain_runs.error = None
+        return responses, await query("What is A?")
+
+    responses, retried = _serve(chain_runs, scenario)
+
+    assert [response.status_code for response in responses] == [500] * 3
+    assert {response.json()["detail"] for response in responses} == {
+        "Error querying model request, with following error: quota exceeded"
+    }
+    assert len(api.in_flight_questions) == 0
+    assert retried.status_code == 200
+    assert chain_runs.questions == ["What is A?"] * 2
+
+
+def test_a_request_finding_the_queue_full_is_shed_with_a_503(monkeypatch, chain_runs):
+    monkeypatch.setattr(api, "admission", AdmissionController(max_concurrency=1, max_queue=1, queue_timeout=5.0))
+
+    async def scenario(query):
+        running = query("What is A?")
+        await _until(lambda: chain_runs.questions)
+        queued = query("What is B?")
+        await _until(lambda: api.admission.queued == 1)
+        shed = await query("What is C?")
+        chain_runs.finish.set()
+        return await asyncio.gather(running, queued), shed
+
+    (running, queued), shed = _serve(chain_runs, scenario)
+
+    assert shed.status_code == 503
+    assert shed.json()["detail"] == "The service is overloaded, retry later"
+    assert int(shed.headers["Retry-After"]) >= 1
+    assert [running.status_code, queued.status_code] == [200, 200]
+    assert api.admission.rejected == {"queue_full": 1}
+
+
+def test_a_request_queued_too_long_gets_a_503(monkeypatch, chain_runs):
+    monkeypatch.setattr(api, "admission", AdmissionController(max_concurrency=1, max_queue=4, queue_timeout=0.05))
+
+    async def scenario(query):
+        running = query("What is A?")
+        await _until(lambda: chain_runs.questions)
+        timed_out = await query("What is B?")
+        chain_runs.finish.set()
+        return await running, timed_out
+
+    running, timed_out = _serve(chain_runs, scenario)
+
+    assert timed_out.status_code == 503
+    assert timed_out.json()["detail"] == "Timed out waiting for a free slot, retry later"
+    assert "Retry-After" in timed_out.headers
+    assert running.status_code == 200
+    assert chain_runs.questions == ["What is A?"]
+    assert api.admission.queued == 0
+
+
+def test_a_client_over_its_limit_gets_a_429(monkeypatch, chain_runs):
+    monkeypatch.setattr(
+        api, "admission", AdmissionController(max_concurrency=4, max_queue=4, queue_timeout=5.0, client_limit=1)
+    )
+
+    async def scenario(query):
+        running = query("What is A?", client_id="notebook")
+        await _until(lambda: chain_runs.questions)
+        limited = await query("What is B?", client_id="notebook")
+        other_client = query("What is B?", client_id="evaluation")
+        await _until(lambda: len(chain_runs.questions) == 2)
+        chain_runs.finish.set()
+        return limited, await asyncio.gather(running, other_client)
+
+    limited, admitted = _serve(chain_runs, scenario)
+
+    assert limited.status_code == 429
+    assert limited.json()["detail"] == "Too many concurrent requests for client notebook"
+    assert [response.status_code for response in admitted] == [200, 200]
+
+
+def test_a_follower_going_away_leaves_the_call_running():
+    single_flight = SingleFlight()
+    calls = []
+
+    async def answer():
+        calls.append(1)
+        await asyncio.sleep(0.05)
+        return "answer"
+
+    async def run():
+        leader = asyncio.ensure_future(single_flight.run("key", answer))
+        follower = asyncio.ensure_future(single_flight.run("key", answer))
+        await asyncio.sleep(0.01)
+        follower.cancel()
+        return await leader, follower.cancelled()
+
+    assert asyncio.run(run()) == ("answer", True)
+    assert calls == [1]
+    assert len(single_flight) == 0
@@ -0,0 +1,71 @@
+import chains
+import pytest
+from dt_gen_ai_hackathon_helper.cache.answer_cache import SQLiteAnswerCache, vector_store_corpus_version
+from dt_gen_ai_hackathon_helper.vector_store.mmap_store import MmapVectorStore
+from langchain.schema import Document
+
+
+class FakeChroma:
+    """The parts of langchain's Chroma which ingestion and the answer cache use, kept in memory."""
+
+    def __init__(self, embedding_function, persist_directory):
+        self._embedding_function = embedding_function
+        self._persist_directory = persist_directory
+        self._collection = self
+        self.rows = {}
+
+    def add(self, ids, embeddings, documents, metadatas):
+        self.rows.update(zip(ids, documents))
+
+    def count(self):
+        return len(self.rows)
+
+    def delete(self, ids=None):
+        for row_id in ids if ids is not None else list(self.rows):
+            self.rows.pop(row_id, None)
+
+    def persist(self):
+        pass
+
+
+@pytest.fixture
+def answer_cache(tmp_path):
+    return SQLiteAnswerCache(str(tmp_path / "answer_cache.sqlite"), namespace="test", similarity_threshold=0.95)
+
+
+def _cache_answer(answer_cache, vector_store):
+    result = {"answer": "Alpha", "source_documents": [Document(page_content="Alpha", metadata={"source": "/a"})]}
+    answer_cache.update([1.0, 0.0], "What is A?", result, vector_store_corpus_version(vector_store))
+    assert answer_cache.lookup([1.0, 0.0], vector_store_corpus_version(vector_store)) is not None
+
+
+def test_a_page_replaced_at_equal_chunk_count_invalidates_cached_answers(site, embeddings, answer_cache, tmp_path):
+    site.page("/", "Home", links=["/a"])
+    site.page("/a", "Alpha")
+    persist_dir = str(tmp_path / "store")
+    vector_store = FakeChroma(embeddings, persist_dir)
+    chains._ingest(site.url, vector_store, persist_dir)
+    _cache_answer(answer_cache, vector_store)
+    count = vector_store.count()
+
+    site.page("/a", "Omega")
+    chains._ingest(site.url, vector_store, persist_dir)
+
+    assert vector_store.count() == count
+    assert answer_cache.lookup([1.0, 0.0], vector_store_corpus_version(vector_store)) is None
+
+
+def test_a_rebuilt_store_invalidates_cached_answers(site, embeddings, answer_cache, tmp_path):
+    # Both stores were written as many times, so their own versions are equal
+    site.page("/", "Home", links=["/a"])
+    site.page("/a", "Alpha")
+    vector_store = MmapVectorStore(embedding_function=embeddings, persist_directory=str(tmp_path / "build-1"))
+    chains._ingest(site.url, vector_store, vector_store.persist_directory)
+    _cache_answer(answer_cache, vector_store)
+
+    site.page("/a", "Omega")
+    rebuilt = MmapVectorStore(embedding_function=embeddings, persist_directory=str(tmp_path / "build-2"))
+    chains._ingest(site.url, rebuilt, rebuilt.persist_directory)
+
+    assert rebuilt.corpus_version == vector_store.corpus_version
+    assert answer_cache.lookup([1.0, 0.0], vector_store_corpus_version(rebuilt)) is None
@@ -0,0 +1,175 @@
+import asyncio
+import functools
+import json
+import os
+import threading
+
+import httpx
+import pytest
+from langchain.schema import Document
+
+os.environ.setdefault("BACKEND_URL", "http://127.0.0.1/")
+
+import api  # noqa: E402
+import chains  # noqa: E402
+import fakes  # noqa: E402
+
+
+@pytest.fixture(autouse=True)
+def existing_index(monkeypatch):
+    monkeypatch.setattr(api, "index_loaded", threading.Event())
+    monkeypatch.setattr(api, "index_error", None)
+    monkeypatch.setattr(chains, "collection_exists", lambda collection=None: True)
+
+
+def _start_and_request(monkeypatch, get_qa_chain, *requests):
+    # Runs the startup hook with the chain built by `get_qa_chain`, then sends the (method, path, json) requests
+    monkeypatch.setattr(chains, "get_qa_chain", get_qa_chain)
+
+    async def run():
+        await api.startup_event()
+        for _ in range(500):
+            if api.index_loaded.is_set() or api.index_error is not None:
+                break
+            await asyncio.sleep(0.01)
+        transport = httpx.ASGITransport(app=api.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+            return [await client.request(method, path, json=json) for method, path, json in requests]
+
+    return asyncio.run(run())
+
+
+def test_a_failed_warm_up_is_reported(monkeypatch):
+    def get_qa_chain(*args):
+        raise PermissionError("no credentials")
+
+    ready, status, query = _start_and_request(
+        monkeypatch,
+        get_qa_chain,
+        ("GET", "/ready", None),
+        ("GET", "/status", None),
+        ("POST", "/query", {"question": "What is A?", "chat_history": []}),
+    )
+
+    assert ready.status_code == 503
+    assert ready.json() == {"ready": False, "error": "PermissionError: no credentials"}
+    assert status.json()["error"] == "PermissionError: no credentials"
+    assert query.status_code == 503
+    assert query.json()["detail"] == "The index failed to load: PermissionError: no credentials"
+
+
+def test_ready_once_warmed_up(monkeypatch):
+    ready, status = _start_and_request(
+        monkeypatch, lambda *args: object(), ("GET", "/ready", None), ("GET", "/status", None)
+    )
+
+    assert ready.json() == {"ready": True}
+    assert status.json()["error"] is None
+
+
+@pytest.mark.parametrize(
+    "options", [{"temperature": -0.1}, {"temperature": 1.5}, {"k": 0}, {"k": api.MAX_K + 1}]
+)
+@pytest.mark.parametrize("path", ["/query", "/query/stream", "/query/batch"])
+def test_rejects_out_of_range_options(monkeypatch, path, options):
+    questions = {"questions": [{"question": "What is A?"}]} if path == "/query/batch" else {}
+    message = {"question": "What is A?", "chat_history": [], **questions, **options}
+
+    (response,) = _start_and_request(monkeypatch, lambda *args: object(), ("POST", path, message))
+
+    assert response.status_code == 422
+
+
+def _ingest(chains, pages):
+    documents = [Document(page_content=text, metadata={"source": source}) for source, text in pages.items()]
+    chains.embed_documents(chains.get_vector_store(), documents)
+
+
+def _batch(questions):
+    return ("POST", "/query/batch", {"questions": [{"question": question} for question in questions]})
+
+
+def _lines(response):
+    return [json.loads(line) for line in response.text.splitlines()]
+
+
+def test_a_batch_reports_each_question_once_when_retrieval_fails(monkeypatch, backend):
+    monkeypatch.setattr(backend, "ANSWER_CACHE", "memory")
+    _ingest(backend, {"/a": "Alpha is the first letter.", "/b": "Beta is the second letter."})
+    (cached,) = _start_and_request(monkeypatch, backend.get_qa_chain, _batch(["What is alpha?"]))
+    assert "answer" in _lines(cached)[0]
+
+    def retrieve_many(retriever, query_embeddings):
+        raise RuntimeError("search failed")
+
+    monkeypatch.setattr(backend, "_retrieve_many", retrieve_many)
+    (response,) = _start_and_request(
+        monkeypatch, backend.get_qa_chain, _batch(["What is alpha?", "What is beta?", "What is gamma?"])
+    )
+
+    lines = sorted(_lines(response), key=lambda line: line["index"])
+    assert [line["index"] for line in lines] == [0, 1, 2]
+    assert lines[0]["answer"] == _lines(cached)[0]["answer"]
+    assert [line.get("error") for line in lines[1:]] == [
+        "Error querying model request, with following error: search failed"
+    ] * 2
+
+
+@pytest.mark.parametrize("k", [1, 3])
+def test_k_sets_the_documents_retrieved(monkeypatch, backend, k):
+    _ingest(backend, {f"/{letter}": f"{letter} is a letter." for letter in "abcdef"})
+    message = {"question": "Which letters are there?", "chat_history": [], "k": k}
+
+    query, batch = _start_and_request(
+        monkeypatch,
+        backend.get_qa_chain,
+        ("POST", "/query", message),
+        ("POST", "/query/batch", {"questions": [{"question": message["question"]}], "k": k}),
+    )
+
+    assert len(query.json()["source_documents"]) == k
+    assert len(_lines(batch)[0]["source_documents"]) == k
+
+
+@pytest.mark.parametrize("async_supported", [False, True])
+def test_a_query_retrieves_once_whether_or_not_the_model_is_async(monkeypatch, backend, async_supported):
+    model = functools.partial(fakes.FakeChatModel, latency=0.0, async_supported=async_supported)
+    monkeypatch.setattr(backend, "ChatVertexAI", model)
+    _ingest(backend, {"/a": "Alpha is the first letter."})
+    retriever_type = type(backend.get_qa_chain(0.0, 3).retriever)
+    retrievals = []
+
+    def counted(name):
+        retrieve = getattr(retriever_type, name)
+
+        def wrapper(self, *args, **kwargs):
+            retrievals.append(name)
+            return retrieve(self, *args, **kwargs)
+
+        return wrapper
+
+    for name in ("_get_relevant_documents", "_aget_relevant_documents"):
+        monkeypatch.setattr(retriever_type, name, counted(name))
+
+    (query,) = _start_and_request(
+        monkeypatch, backend.get_qa_chain, ("POST", "/query", {"question": "What is alpha?", "chat_history": []})
+    )
+
+    assert query.status_code == 200
+    assert retrievals == ["_aget_relevant_documents" if async_supported else "_get_relevant_documents"]
+
+
+def test_a_batch_runs_on_its_own_threads(monkeypatch, backend):
+    _ingest(backend, {"/a": "Alpha is the first letter."})
+    threads = set()
+    retrieve_many = backend._retrieve_many
+
+    def recorded(retriever, query_embeddings):
+        threads.add(threading.current_thread().name.split("_")[0])
+        return retrieve_many(retriever, query_embeddings)
+
+    monkeypatch.setattr(backend, "_retrieve_many", recorded)
+    (response,) = _start_and_request(monkeypatch, backend.get_qa_chain, _batch(["What is alpha?"]))
+
+    assert "answer" in _lines(response)[0]
+    assert threads == {"qa-batch"}
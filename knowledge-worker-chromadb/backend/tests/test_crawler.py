@@ -0,0 +1,89 @@
+from crawler import CrawlCache, Crawler
+
+
+def _sources(result):
+    return sorted(document.metadata["source"] for document in result.documents)
+
+
+def test_crawls_the_pages_linked_below_the_root(site):
+    site.page("/", "Home", links=["/a", "/b#section", "http://example.invalid/elsewhere"])
+    site.page("/a", "Page A", links=["/a/c", "/"])
+    site.page("/b", "Page B")
+    site.page("/a/c", "Page C")
+
+    result = Crawler().crawl_sync(site.url)
+
+    assert _sources(result) == [site.url, site.url + "a", site.url + "a/c", site.url + "b"]
+    assert result.fetched == 4
+    assert result.complete
+    # Each page is fetched once, however many pages link to it
+    assert len(site.requested("/")) == 1
+
+
+def test_revalidates_unchanged_pages(site, tmp_path):
+    site.page("/", "Home", links=["/a"], etag='"home-1"')
+    site.page("/a", "Page A", links=["/a/c"], etag='"a-1"')
+    site.page("/a/c", "Page C", etag='"c-1"')
+    cache_path = str(tmp_path / "crawl_cache.json")
+
+    cache = CrawlCache(cache_path)
+    Crawler(cache=cache).crawl_sync(site.url)
+    cache.save()
+
+    site.page("/a/c", "Page C, edited", etag='"c-2"')
+    result = Crawler(cache=CrawlCache(cache_path)).crawl_sync(site.url)
+
+    assert site.requested("/a")[-1]["If-None-Match"] == '"a-1"'
+    # Links of a page which wasn't modified are followed from the cache
+    assert result.unchanged == {site.url, site.url + "a"}
+    assert _sources(result) == [site.url + "a/c"]
+    assert result.complete
+
+
+def test_stops_at_the_maximum_depth(site):
+    site.page("/", "Home", links=["/a"])
+    site.page("/a", "Page A", links=["/a/c"])
+    site.page("/a/c", "Page C")
+
+    result = Crawler(max_depth=1).crawl_sync(site.url)
+
+    assert _sources(result) == [site.url, site.url + "a"]
+    assert not site.requested("/a/c")
+
+
+def test_stops_at_the_maximum_pages(site):
+    site.page("/", "Home", links=["/a", "/b", "/c"])
+    for path in ("/a", "/b", "/c"):
+        site.page(path, path)
+
+    result = Crawler(max_pages=2).crawl_sync(site.url)
+
+    assert len(result.documents) == 2
+    assert result.truncated
+    assert not result.complete
+
+
+def test_reports_failed_and_removed_pages(site):
+    site.page("/", "Home", links=["/error", "/removed", "/slow", "/pdf", "/ok"])
+    site.page("/error", "Error", status=500)
+    site.page("/removed", "Removed", status=410)
+    site.page("/slow", "Slow", delay=1.0)
+    site.page("/pdf", "Not a page", content_type="application/pdf")
+    site.page("/ok", "OK")
+
+    result = Crawler(timeout=0.5).crawl_sync(site.url)
+
+    assert _sources(result) == [site.url, site.url + "ok"]
+    assert set(result.failed) == {site.url + "error", site.url + "slow"}
+    assert result.failed[site.url + "error"] == "HTTP 500"
+    assert result.gone == {site.url + "removed"}
+    assert not result.complete
+
+
+def test_reports_missing_pages_as_gone(site):
+    site.page("/", "Home", links=["/missing"])
+
+    result = Crawler().crawl_sync(site.url)
+
+    assert result.gone == {site.url + "missing"}
+    assert result.complete
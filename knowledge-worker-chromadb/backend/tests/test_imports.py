@@ -0,0 +1,40 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir, os.pardir, os.pardir, "benchmarks"))
+
+import bench_imports  # noqa: E402
+
+# The serving entry point is imported by every new worker before it can answer its health checks, and the formatter
+# by the notebooks. Generous compared to what they take (~0.3s and ~20ms), to catch heavy imports creeping back in.
+IMPORT_BUDGET_MS = 1000
+
+
+@pytest.mark.parametrize("module", ["main", "api"])
+def test_backend_imports_within_budget(module):
+    _, directory, forbidden = bench_imports.TARGETS["backend"]
+
+    result = bench_imports.check_import(module, directory, forbidden, runs=3, budget_ms=IMPORT_BUDGET_MS)
+
+    assert result["failures"] == []
+
+
+def test_formatter_helper_imports_within_budget():
+    # Only needs the standard library, so it's checked here rather than in the helper's locked environment
+    module, directory, forbidden = bench_imports.TARGETS["helper"]
+
+    result = bench_imports.check_import(module, directory, forbidden, runs=3, budget_ms=IMPORT_BUDGET_MS)
+
+    assert result["failures"] == []
+
+
+def test_a_module_failing_to_import_fails_the_check(tmp_path):
+    (tmp_path / "broken.py").write_text("import a_module_which_does_not_exist\n")
+
+    result = bench_imports.check_import("broken", str(tmp_path), runs=1)
+
+    assert result["failures"] == [
+        "importing broken failed: ModuleNotFoundError: No module named 'a_module_which_does_not_exist'"
+    ]
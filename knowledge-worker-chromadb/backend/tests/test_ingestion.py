@@ -0,0 +1,129 @@
+import asyncio
+import os
+import threading
+
+import httpx
+import pytest
+
+os.environ.setdefault("BACKEND_URL", "http://127.0.0.1/")
+
+import api  # noqa: E402
+from ingestion_jobs import IngestionJobs  # noqa: E402
+
+
+@pytest.fixture
+def server(monkeypatch, backend, site):
+    # The API ingesting the fixture site into the backend's stores, with no index loaded yet
+    monkeypatch.setattr(api, "WEBSITE", site.url)
+    monkeypatch.setattr(api, "ADMIN_TOKEN", "secret")
+    monkeypatch.setattr(api, "index_loaded", threading.Event())
+    monkeypatch.setattr(api, "index_error", None)
+    monkeypatch.setattr(api, "ingestion_jobs", IngestionJobs())
+    return backend
+
+
+def _serve(scenario):
+    # Runs the startup hook, then `scenario(client)`
+    async def run():
+        await api.startup_event()
+        transport = httpx.ASGITransport(app=api.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+            return await asyncio.wait_for(scenario(client), 20)
+
+    return asyncio.run(run())
+
+
+async def _until_jobs_done(client):
+    for _ in range(1000):
+        jobs = (await client.get("/status")).json()["jobs"]
+        if all(job["state"] in ("succeeded", "failed") for job in jobs):
+            return jobs
+        await asyncio.sleep(0.01)
+    raise AssertionError("Timed out waiting for the ingestion jobs")
+
+
+def _query(client, question):
+    return client.post("/query", json={"question": question, "chat_history": [], "k": 1})
+
+
+def _sources(response):
+    return [document["page_content"] for document in response.json()["source_documents"]]
+
+
+def test_not_ready_until_the_first_ingestion_is_done(monkeypatch, server, site):
+    site.page("/", "Alpha is the first letter.")
+    started, finish = threading.Event(), threading.Event()
+    create_embeddings = server.create_embeddings
+
+    def held_create_embeddings(url, collection=None, job=None):
+        started.set()
+        finish.wait(10)
+        return create_embeddings(url, collection, job=job)
+
+    monkeypatch.setattr(server, "create_embeddings", held_create_embeddings)
+
+    async def scenario(client):
+        await asyncio.to_thread(started.wait, 10)
+        ingesting = [await client.get("/ready"), await client.get("/status"), await _query(client, "What is alpha?")]
+        finish.set()
+        jobs = await _until_jobs_done(client)
+        return ingesting, jobs, await client.get("/ready"), await _query(client, "What is alpha?")
+
+    (ready, status, query), jobs, ready_after, query_after = _serve(scenario)
+
+    assert ready.status_code == 503
+    assert ready.json() == {"ready": False, "error": None}
+    assert [(job["kind"], job["state"]) for job in status.json()["jobs"]] == [("initial", "running")]
+    assert query.status_code == 503
+    assert query.json()["detail"] == "The index is still being built, retry later"
+
+    assert [(job["kind"], job["state"]) for job in jobs] == [("initial", "succeeded")]
+    assert jobs[0]["stats"]
+    assert ready_after.json() == {"ready": True}
+    assert query_after.status_code == 200
+    assert "Alpha is the first letter." in _sources(query_after)[0]
+
+
+def test_a_rebuild_swaps_the_store_without_interrupting_running_queries(monkeypatch, server, site):
+    site.page("/", "Alpha is the first letter.")
+    arun_chain = server.arun_chain
+    held = []
+    release = {}
+
+    async def held_arun_chain(qa_chain, inputs, callbacks=None):
+        # The first query to run is held, with its chain, until the test releases it
+        if not held:
+            held.append(inputs["question"])
+            await release["event"].wait()
+        return await arun_chain(qa_chain, inputs, callbacks=callbacks)
+
+    monkeypatch.setattr(server, "arun_chain", held_arun_chain)
+
+    async def scenario(client):
+        release["event"] = asyncio.Event()
+        await _until_jobs_done(client)
+        running = asyncio.ensure_future(_query(client, "Which letter is there?"))
+        while not held:
+            await asyncio.sleep(0.01)
+
+        site.page("/", "Omega is the last letter.")
+        unauthorized = await client.post("/admin/rebuild", json={}, headers={"X-Admin-Token": "wrong"})
+        rebuild = await client.post("/admin/rebuild", json={}, headers={"X-Admin-Token": "secret"})
+        jobs = await _until_jobs_done(client)
+        # Asked differently, the same question would share the answer of the query held
+        after = await _query(client, "Which letter is it?")
+
+        release["event"].set()
+        return unauthorized, rebuild, jobs, after, await running
+
+    unauthorized, rebuild, jobs, after, running = _serve(scenario)
+
+    assert unauthorized.status_code == 401
+    assert rebuild.status_code == 202
+    assert rebuild.json()["kind"] == "rebuild"
+    assert [(job["kind"], job["state"]) for job in jobs] == [("rebuild", "succeeded"), ("initial", "succeeded")]
+    # New queries are answered from the rebuilt store, the one running finishes on the store it started with
+    assert "Omega is the last letter." in _sources(after)[0]
+    assert held == ["Which letter is there?"]
+    assert running.status_code == 200
+    assert "Alpha is the first letter." in _sources(running)[0]
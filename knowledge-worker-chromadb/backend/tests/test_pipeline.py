@@ -0,0 +1,126 @@
+import time
+
+import pytest
+from crawler import Crawler
+from dt_gen_ai_hackathon_helper.vector_store.mmap_store import MmapVectorStore
+from langchain.text_splitter import RecursiveCharacterTextSplitter
+from pipeline import IngestionPipeline
+
+
+@pytest.fixture
+def vector_store(embeddings, tmp_path):
+    return MmapVectorStore(embedding_function=embeddings, persist_directory=str(tmp_path / "store"))
+
+
+@pytest.fixture
+def manifest():
+    return {"sources": {}}
+
+
+def _sync(site, vector_store, manifest):
+    pipeline = IngestionPipeline(
+        vector_store,
+        manifest,
+        RecursiveCharacterTextSplitter(chunk_size=1000, chunk_overlap=0),
+        checkpoint=lambda manifest: None,
+    )
+    return pipeline.run(Crawler(timeout=2), site.url)
+
+
+def _chunks(vector_store, manifest, source):
+    chunk_ids = manifest["sources"][source]["chunks"]
+    assert chunk_ids
+    documents = vector_store.similarity_search("Page", k=vector_store.count())
+    return [document for document in documents if document.metadata["source"] == source]
+
+
+def test_keeps_the_chunks_of_a_page_which_failed_to_load(site, vector_store, manifest):
+    site.page("/", "Home", links=["/a", "/b"])
+    site.page("/a", "Page A")
+    site.page("/b", "Page B")
+    _sync(site, vector_store, manifest)
+    count = vector_store.count()
+
+    site.page("/b", "Page B", status=500)
+    stats = _sync(site, vector_store, manifest)
+
+    assert stats["deleted"] == 0
+    assert stats["failed"] == 1
+    assert vector_store.count() == count
+    assert _chunks(vector_store, manifest, site.url + "b")
+
+
+def test_keeps_every_page_when_the_root_fails_to_load(site, vector_store, manifest):
+    site.page("/", "Home", links=["/a"])
+    site.page("/a", "Page A")
+    _sync(site, vector_store, manifest)
+    count = vector_store.count()
+
+    site.page("/", "Home", status=503)
+    stats = _sync(site, vector_store, manifest)
+
+    assert stats["deleted"] == 0
+    assert vector_store.count() == count
+    assert set(manifest["sources"]) == {site.url, site.url + "a"}
+
+
+def test_deletes_removed_pages_even_when_the_crawl_is_incomplete(site, vector_store, manifest):
+    site.page("/", "Home", links=["/a", "/b", "/c"])
+    site.page("/a", "Page A", links=["/a/d"])
+    site.page("/a/d", "Page D")
+    site.page("/b", "Page B")
+    site.page("/c", "Page C")
+    _sync(site, vector_store, manifest)
+
+    # A fails, so D isn't reached, while B is removed
+    site.page("/a", "Page A", status=500)
+    del site.pages["/b"]
+    _sync(site, vector_store, manifest)
+
+    assert set(manifest["sources"]) == {site.url, site.url + "a", site.url + "a/d", site.url + "c"}
+    assert _chunks(vector_store, manifest, site.url + "a/d")
+
+
+def test_deletes_pages_no_longer_linked_after_a_complete_crawl(site, vector_store, manifest):
+    site.page("/", "Home", links=["/a", "/b"])
+    site.page("/a", "Page A")
+    site.page("/b", "Page B")
+    _sync(site, vector_store, manifest)
+
+    site.page("/", "Home", links=["/a"])
+    _sync(site, vector_store, manifest)
+
+    assert set(manifest["sources"]) == {site.url, site.url + "a"}
+    documents = vector_store.similarity_search("Page", k=vector_store.count())
+    assert site.url + "b" not in {document.metadata["source"] for document in documents}
+
+
+def test_reports_the_crawl_apart_from_its_wait_on_the_embedding_stage(site, vector_store, manifest, monkeypatch):
+    paths = [f"/{letter}" for letter in "abcdefgh"]
+    site.page("/", "Home", links=paths, delay=0.05)
+    for path in paths:
+        site.page(path, f"Page {path}", delay=0.05)
+    embed_documents = vector_store._embedding_function.embed_documents
+
+    def slow_embed_documents(texts):
+        time.sleep(0.2)
+        return embed_documents(texts)
+
+    monkeypatch.setattr(vector_store._embedding_function, "embed_documents", slow_embed_documents)
+    pipeline = IngestionPipeline(
+        vector_store,
+        manifest,
+        RecursiveCharacterTextSplitter(chunk_size=1000, chunk_overlap=0),
+        checkpoint=lambda manifest: None,
+        batch_size=1,
+        queue_size=1,
+    )
+
+    crawl = pipeline.run(Crawler(timeout=2), site.url)["stages"]["crawl"]
+
+    assert crawl["items"] == 9
+    # Fetching takes the pages' delay. Handing them over waits on the embeddings, 0.2s per page, once the queues
+    # between the stages are full.
+    assert crawl["busy_seconds"] >= 0.45
+    assert crawl["queue_wait_seconds"] >= 0.6
+    assert crawl["busy_seconds"] < crawl["queue_wait_seconds"]
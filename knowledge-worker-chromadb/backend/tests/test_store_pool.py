@@ -0,0 +1,103 @@
+import threading
+import time
+
+import chains
+import pytest
+from store_pool import VectorStorePool
+
+
+@pytest.fixture
+def built(monkeypatch, tmp_path):
+    # The chains built, as (temperature, k, collection)
+    built = []
+
+    def build_qa_chain(vector_store, temperature, k, collection):
+        built.append((temperature, k, collection))
+        return object()
+
+    monkeypatch.setattr(chains, "_build_qa_chain", build_qa_chain)
+    monkeypatch.setattr(
+        chains, "_stores", VectorStorePool(open_store=lambda collection, directory: object(), directory_of=str)
+    )
+    return built
+
+
+def test_near_identical_temperatures_share_a_chain(built):
+    qa_chain = chains.get_qa_chain(0.1, 4)
+
+    assert chains.get_qa_chain(0.10001, 4) is qa_chain
+    assert built == [(0.1, 4, "default")]
+
+
+def test_keeps_the_most_recently_used_chains(built, monkeypatch):
+    monkeypatch.setattr(chains, "MAX_CHAINS_PER_COLLECTION", 2)
+    first = chains.get_qa_chain(0.0, 4)
+    chains.get_qa_chain(0.5, 4)
+    assert chains.get_qa_chain(0.0, 4) is first
+
+    chains.get_qa_chain(1.0, 4)
+
+    store = chains._stores.get_opened("default")
+    assert [key for key, _ in store.chains()] == [(0.0, 4), (1.0, 4)]
+    assert chains.get_qa_chain(0.0, 4) is first
+    assert len(built) == 3
+
+
+class PersistedCollections:
+    """Collections persisted in `directory`, whose stores record the collections opened, in order."""
+
+    def __init__(self, directory, collections):
+        self.directory = directory
+        self.opened = []
+        for collection in collections:
+            (directory / collection).mkdir()
+
+    def pool(self, **options):
+        return VectorStorePool(self.open_store, lambda collection: str(self.directory / collection), **options)
+
+    def open_store(self, collection, directory):
+        self.opened.append(collection)
+        # Opening a store takes a while, e.g. Chroma loading its collection
+        time.sleep(0.05)
+        return object()
+
+
+@pytest.fixture
+def persisted(tmp_path):
+    return PersistedCollections(tmp_path, "abc")
+
+
+def test_evicts_the_least_recently_used_store_at_capacity(persisted):
+    pool = persisted.pool(max_open=2)
+    a = pool.get("a")
+    pool.get("b")
+    assert pool.get("a") is a
+
+    pool.get("c")
+
+    assert [store.collection for store in pool.stores()] == ["a", "c"]
+    assert pool.get_opened("b") is None
+    assert pool.evictions == 1
+    # An evicted store is opened again when next used
+    pool.get("b")
+    assert persisted.opened == ["a", "b", "c", "b"]
+    assert pool.get_opened("a") is None
+
+
+def test_a_collection_requested_by_two_threads_at_once_is_opened_once(persisted):
+    pool = persisted.pool()
+    both_waiting = threading.Barrier(2)
+    stores = []
+
+    def get():
+        both_waiting.wait()
+        stores.append(pool.get("a"))
+
+    threads = [threading.Thread(target=get) for _ in range(2)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert persisted.opened == ["a"]
+    assert stores[0] is stores[1]
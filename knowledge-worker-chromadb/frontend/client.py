@@ -0,0 +1,208 @@
+import asyncio
+import json
+import os
+import random
+import threading
+import time
+
+import google.auth.transport.requests
+import google.oauth2.id_token
+import requests
+from requests.adapters import HTTPAdapter
+
+# (connect, read) timeouts in seconds, the read timeout also bounds the gap between two streamed events
+BACKEND_CONNECT_TIMEOUT = float(os.environ.get("BACKEND_CONNECT_TIMEOUT", 3.05))
+BACKEND_READ_TIMEOUT = float(os.environ.get("BACKEND_READ_TIMEOUT", 120))
+BACKEND_MAX_RETRIES = int(os.environ.get("BACKEND_MAX_RETRIES", 2))
+BACKEND_POOL_SIZE = int(os.environ.get("BACKEND_POOL_SIZE", 16))
+
+# Responses worth retrying: the backend turned the request away without starting on it. A query isn't idempotent (it
+# calls the LLM), so gateway errors and read timeouts, after which the backend may still be answering, aren't retried.
+RETRY_STATUS_CODES = {429, 503}
+# Seconds before retrying after failing to fetch an ID token, e.g. when running locally without credentials
+ID_TOKEN_RETRY_SECONDS = 60
+
+
+class IdTokenCache:
+    # Fetches an ID token for the backend audience once, and reuses it until it is about to expire
+    def __init__(self, audience):
+        self.audience = audience
+        self._request = google.auth.transport.requests.Request()
+        self._credentials = None
+        self._failed_at = None
+        self._lock = threading.Lock()
+
+    def token(self):
+        with self._lock:
+            if self._failed_at is not None and time.monotonic() - self._failed_at < ID_TOKEN_RETRY_SECONDS:
+                return None
+            try:
+                if self._credentials is None:
+                    self._credentials = google.oauth2.id_token.fetch_id_token_credentials(
+                        self.audience, request=self._request
+                    )
+                # valid is False once the token is expired, or about to
+                if not self._credentials.valid:
+                    self._credentials.refresh(self._request)
+                self._failed_at = None
+                return self._credentials.token
+            except Exception as error:
+                print(error)
+                self._failed_at = time.monotonic()
+                return None
+
+    def headers(self):
+        token = self.token()
+        if token is None:
+            return {"Content-Type": "application/json"}
+        return {
+            "Content-Type": "application/json",
+            "Authorization": f"Bearer {token}",
+        }
+
+
+def _backoff(attempt, retry_after=None):
+    # Exponential backoff with full jitter, unless the backend tells us how long to wait
+    if retry_after is not None:
+        try:
+            return float(retry_after)
+        except ValueError:
+            pass
+    return random.uniform(0, 0.5 * 2**attempt)
+
+
+class _EventParser:
+    # Server-sent events: an "event:" line names the event, the "data:" line carries its JSON payload
+    def __init__(self):
+        self.event = "message"
+
+    def feed(self, line):
+        if line.startswith("event:"):
+            self.event = line[len("event:") :].strip()
+        elif line.startswith("data:"):
+            return self.event, json.loads(line[len("data:") :])
+        return None
+
+
+class BackendClient:
+    # Talks to the backend over a pool of keep-alive connections, with cached ID tokens, timeouts and retries
+    def __init__(
+        self,
+        base_url,
+        timeout=(BACKEND_CONNECT_TIMEOUT, BACKEND_READ_TIMEOUT),
+        max_retries=BACKEND_MAX_RETRIES,
+        pool_size=BACKEND_POOL_SIZE,
+    ):
+        self.base_url = base_url
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.id_tokens = IdTokenCache(audience=base_url)
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+    def query(self, question, chat_history):
+        response = self._post("/query", {"question": question, "chat_history": chat_history})
+        return response.json()
+
+    def stream_query(self, question, chat_history):
+        response = self._post(
+            "/query/stream", {"question": question, "chat_history": chat_history}, stream=True
+        )
+        parser = _EventParser()
+        with response:
+            for line in response.iter_lines(decode_unicode=True):
+                event = parser.feed(line)
+                if event is not None:
+                    yield event
+
+    def _post(self, path, body, stream=False):
+        # Only failures to connect are retried, before the request was sent. A streamed response is never replayed.
+        for attempt in range(self.max_retries + 1):
+            last_attempt = attempt == self.max_retries
+            try:
+                response = self.session.post(
+                    url=self.base_url + path,
+                    headers=self.id_tokens.headers(),
+                    json=body,
+                    timeout=self.timeout,
+                    stream=stream,
+                )
+            except (requests.ConnectTimeout, requests.ConnectionError):
+                if last_attempt:
+                    raise
+                time.sleep(_backoff(attempt))
+                continue
+
+            if response.status_code in RETRY_STATUS_CODES and not last_attempt:
+                response.close()
+                time.sleep(_backoff(attempt, response.headers.get("Retry-After")))
+                continue
+
+            response.raise_for_status()
+            return response
+
+
+class AsyncBackendClient:
+    # The same client on httpx, so async Gradio handlers don't hold a worker thread while waiting on the backend
+    def __init__(
+        self,
+        base_url,
+        timeout=(BACKEND_CONNECT_TIMEOUT, BACKEND_READ_TIMEOUT),
+        max_retries=BACKEND_MAX_RETRIES,
+        pool_size=BACKEND_POOL_SIZE,
+    ):
+        import httpx
+
+        self.base_url = base_url
+        self.max_retries = max_retries
+        self.id_tokens = IdTokenCache(audience=base_url)
+        self._httpx = httpx
+        self.client = httpx.AsyncClient(
+            base_url=base_url,
+            timeout=httpx.Timeout(timeout[1], connect=timeout[0]),
+            limits=httpx.Limits(max_connections=pool_size, max_keepalive_connections=pool_size),
+        )
+
+    async def query(self, question, chat_history):
+        response = await self._post("/query", {"question": question, "chat_history": chat_history})
+        return response.json()
+
+    async def stream_query(self, question, chat_history):
+        response = await self._post(
+            "/query/stream", {"question": question, "chat_history": chat_history}, stream=True
+        )
+        parser = _EventParser()
+        try:
+            async for line in response.aiter_lines():
+                event = parser.feed(line)
+                if event is not None:
+                    yield event
+        finally:
+            await response.aclose()
+
+    async def _post(self, path, body, stream=False):
+        for attempt in range(self.max_retries + 1):
+            last_attempt = attempt == self.max_retries
+            # Fetching or refreshing a token blocks, but only happens once per token lifetime
+            headers = await asyncio.to_thread(self.id_tokens.headers)
+            request = self.client.build_request("POST", path, headers=headers, json=body)
+            try:
+                response = await self.client.send(request, stream=stream)
+            # As above: failing to connect, or to get a connection from the pool, means the request was never sent
+            except (self._httpx.ConnectError, self._httpx.ConnectTimeout, self._httpx.PoolTimeout):
+                if last_attempt:
+                    raise
+                await asyncio.sleep(_backoff(attempt))
+                continue
+
+            if response.status_code in RETRY_STATUS_CODES and not last_attempt:
+                await response.aclose()
+                await asyncio.sleep(_backoff(attempt, response.headers.get("Retry-After")))
+                continue
+
+            if response.is_error:
+                await response.aread()
+                response.raise_for_status()
+            return response
@@ -1,19 +1,30 @@
 import os
 
-import google.auth.transport.requests
-import google.oauth2.id_token
 import gradio as gr
-import requests
+from client import AsyncBackendClient, BackendClient
 
 BACKEND_URL = os.environ["BACKEND_URL"]
+# Use the httpx client with async handlers, so waiting on the backend doesn't hold a Gradio worker thread
+BACKEND_ASYNC = os.environ.get("BACKEND_ASYNC", "false").lower() == "true"
+
+# One client per process: connections and ID tokens are reused across questions
+backend = BackendClient(BACKEND_URL)
+async_backend = AsyncBackendClient(BACKEND_URL) if BACKEND_ASYNC else None
 
 
 def submit(msg, chatbot):
     # First create a new entry in the conversation log
     msg, chatbot = user(msg, chatbot)
-    # Then get the chatbot response to the user question
-    chatbot = bot(chatbot)
-    return msg, chatbot
+    # Then stream the chatbot response to the user question, repainting as it arrives
+    for chatbot in bot(chatbot):
+        yield msg, chatbot
+
+
+async def asubmit(msg, chatbot):
+    # Same as submit, for the async client
+    msg, chatbot = user(msg, chatbot)
+    async for chatbot in abot(chatbot):
+        yield msg, chatbot
 
 
 def user(user_message, history):
@@ -24,58 +35,53 @@ def user(user_message, history):
 def bot(history):
     # Get the user question from conversation history
     user_message = history[-1][0]
-    # Get the response and sources used to answer the user question
-    bot_message, bot_sources = q_a(user_message, history[:-1])
+    # map history (list of lists) to expected format of chat_history (list of tuples)
+    chat_history = list(map(tuple, history[:-1]))
 
-    # Using a template, format the response and sources together
-    bot_template = "{0}\n\n<details><summary><b>Sources</b></summary>\n\n{1}</details>"
-    # Place the response into the conversation history and return
-    history[-1][1] = bot_template.format(bot_message, bot_sources)
-    return history
+    # The backend sends the sources used to answer the user question first, then the answer token by token
+    response = _BotResponse()
+    for event, data in backend.stream_query(user_message, chat_history):
+        # Place the partial response into the conversation history and repaint
+        history[-1][1] = response.update(event, data)
+        yield history
 
 
-def q_a(question: str, history: list):
-    # map history (list of lists) to expected format of chat_history (list of tuples)
-    chat_history = map(tuple, history)
+async def abot(history):
+    # Same as bot, for the async client
+    user_message = history[-1][0]
+    chat_history = list(map(tuple, history[:-1]))
 
-    response = _query_model(question, chat_history)
+    response = _BotResponse()
+    async for event, data in async_backend.stream_query(user_message, chat_history):
+        history[-1][1] = response.update(event, data)
+        yield history
 
+
+class _BotResponse:
+    # Accumulates the streamed events into the message displayed in the chatbot
+    def __init__(self):
+        self.message = ""
+        self.sources = ""
+
+    def update(self, event, data):
+        if event == "sources":
+            self.sources = _format_sources(data["source_documents"])
+        elif event == "token":
+            self.message += data["token"]
+        elif event == "error":
+            self.message = data["detail"]
+
+        # Using a template, format the response and sources together
+        bot_template = "{0}\n\n<details><summary><b>Sources</b></summary>\n\n{1}</details>"
+        return bot_template.format(self.message, self.sources)
+
+
+def _format_sources(source_documents):
     # Format source documents (sources of excerpts passed to the LLM) into links the user can validate
     sources = [
-        "[{0}]({0})".format(doc.metadata["source"])
-        for doc in response["source_documents"]
+        "[{0}]({0})".format(doc["metadata"]["source"]) for doc in source_documents
     ]
-
-    # Return the LLM answer, and list of sources used (formatted as a string)
-    return response["answer"], "\n\n".join(sources)
-
-
-def _query_model(question, history):
-    qa_req_body = {
-        "question": question,
-        "chat_history": history,
-    }
-    return requests.post(
-        url=BACKEND_URL + "/query_model",
-        headers=_make_request_headers(),
-        json=qa_req_body,
-    ).json()
-
-
-def _make_request_headers():
-    try:
-        request = google.auth.transport.requests.Request()
-        audience = BACKEND_URL
-        token = google.oauth2.id_token.fetch_id_token(request, audience)
-        return {
-            "Content-Type": "application/json",
-            "Authorization": f"Bearer {token}",
-        }
-    except Exception as error:
-        print(error)
-        return {
-            "Content-Type": "application/json",
-        }
+    return "\n\n".join(sources)
 
 
 def main():
@@ -100,8 +106,10 @@ def main():
             )
 
         # Submit message on <enter> or clicking "Send" button
-        msg.submit(submit, [msg, chatbot], [msg, chatbot], queue=False)
-        send.click(submit, [msg, chatbot], [msg, chatbot], queue=False)
+        # The response is streamed by a generator, which requires the queue
+        handler = asubmit if BACKEND_ASYNC else submit
+        msg.submit(handler, [msg, chatbot], [msg, chatbot])
+        send.click(handler, [msg, chatbot], [msg, chatbot])
 
         # Clear chatbot history on clicking "Clear History" button
         clear.click(lambda: None, None, chatbot, queue=False)
@@ -0,0 +1,104 @@
+import datetime
+import logging
+import threading
+
+import google.auth
+import google.auth.transport.requests
+import requests
+from requests.adapters import HTTPAdapter
+
+CLOUD_PLATFORM_SCOPE = "https://www.googleapis.com/auth/cloud-platform"
+
+
+class TokenProvider:
+    """
+    Provides access tokens of the application default credentials, and a pooled HTTP session to use them with.
+    The token is cached in memory and refreshed in the background shortly before it expires,
+    so callers don't wait on a refresh (or a `gcloud` process) for every request.
+    Args:
+        scopes: The OAuth scopes to request.
+        refresh_margin_seconds: How long before expiry the token is refreshed.
+        pool_maxsize: The maximum number of pooled connections per host, i.e. concurrent requests.
+    """
+
+    def __init__(self, scopes=(CLOUD_PLATFORM_SCOPE,), refresh_margin_seconds=300, pool_maxsize=32):
+        self.credentials, self.project_id = google.auth.default(scopes=list(scopes))
+        self.refresh_margin = datetime.timedelta(seconds=refresh_margin_seconds)
+
+        # Keep-alive connections shared by all REST calls, including the token refreshes
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=pool_maxsize)
+        self.session.mount("https://", adapter)
+
+        self._lock = threading.Lock()
+        self._timer = None
+
+    def token(self) -> str:
+        """Return a valid access token, refreshing it only if the cached one is (almost) expired."""
+        with self._lock:
+            if not self._is_fresh():
+                self._refresh()
+            return self.credentials.token
+
+    def headers(self, project_id: str) -> dict:
+        """Return the headers of an authenticated JSON request, billed to the given project."""
+        return {
+            "Authorization": f"Bearer {self.token()}",
+            "X-Goog-User-Project": project_id,
+            "Content-Type": "application/json",
+        }
+
+    def close(self):
+        with self._lock:
+            if self._timer is not None:
+                self._timer.cancel()
+        self.session.close()
+
+    def _is_fresh(self):
+        expiry = self.credentials.expiry
+        if not self.credentials.token:
+            return False
+        # Credentials without an expiry never expire
+        return expiry is None or expiry - datetime.datetime.utcnow() > self.refresh_margin
+
+    def _refresh(self):
+        self.credentials.refresh(google.auth.transport.requests.Request(session=self.session))
+        self._schedule_refresh()
+
+    def _schedule_refresh(self):
+        if self._timer is not None:
+            self._timer.cancel()
+        if self.credentials.expiry is None:
+            return
+
+        delay = (self.credentials.expiry - datetime.datetime.utcnow() - self.refresh_margin).total_seconds()
+        if delay <= 0:
+            # The new token already expires within the margin, refreshing it again right away would loop.
+            # token() refreshes it on demand instead.
+            self._timer = None
+            return
+        self._timer = threading.Timer(delay, self._refresh_in_background)
+        self._timer.daemon = True
+        self._timer.start()
+
+    def _refresh_in_background(self):
+        try:
+            with self._lock:
+                self._refresh()
+        except Exception as err:
+            # The next call to token() retries the refresh
+            logging.warning(f"Background refresh of the access token failed: {err}")
+
+
+_token_provider = None
+_token_provider_lock = threading.Lock()
+
+
+def get_token_provider() -> TokenProvider:
+    """Return the token provider shared within this process, created on first use."""
+    global _token_provider
+
+    with _token_provider_lock:
+        if _token_provider is None:
+            _token_provider = TokenProvider()
+        return _token_provider
@@ -0,0 +1,315 @@
+"""Semantic answer cache for conversational Q&A chains."""
+import json
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from typing import Any, Callable, Dict, List, Optional
+
+import numpy as np
+from langchain.chains.base import Chain
+from langchain.chains.conversational_retrieval.base import _get_chat_history
+from langchain.schema import Document
+
+
+class BaseAnswerCache:
+    """Stores Q&A chain results keyed on the embedding of the standalone question.
+
+    A lookup matches the closest cached question whose cosine similarity reaches `similarity_threshold`.
+    Entries expire after `ttl_seconds` and the least recently used entries are evicted beyond `max_entries`.
+    All entries are dropped when the corpus version of the vector store changes.
+    """
+
+    def __init__(self, similarity_threshold=0.95, ttl_seconds=None, max_entries=1000):
+        self.similarity_threshold = similarity_threshold
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    def lookup(self, embedding: List[float], corpus_version: str) -> Optional[Dict[str, Any]]:
+        """Return the cached result for the most similar question, or None."""
+        with self._lock:
+            self._check_corpus_version(corpus_version)
+            result = self._lookup(_normalise(embedding), time.time())
+
+        if result is None:
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        return _deserialise_result(result)
+
+    def update(self, embedding: List[float], question: str, result: Dict[str, Any], corpus_version: str):
+        """Cache the result of the chain for a standalone question."""
+        with self._lock:
+            self._check_corpus_version(corpus_version)
+            self._update(_normalise(embedding), question, _serialise_result(result), time.time())
+
+    def clear(self):
+        """Drop all cached answers."""
+        with self._lock:
+            self._clear()
+
+    def _check_corpus_version(self, corpus_version):
+        # Answers are only valid for the documents they were generated from
+        if self._get_corpus_version() != corpus_version:
+            self._clear()
+            self._set_corpus_version(corpus_version)
+
+    def _is_expired(self, created_at, now):
+        return self.ttl_seconds is not None and now - created_at > self.ttl_seconds
+
+    def _lookup(self, embedding, now):
+        raise NotImplementedError
+
+    def _update(self, embedding, question, result, now):
+        raise NotImplementedError
+
+    def _clear(self):
+        raise NotImplementedError
+
+    def _get_corpus_version(self):
+        raise NotImplementedError
+
+    def _set_corpus_version(self, corpus_version):
+        raise NotImplementedError
+
+
+class InMemoryAnswerCache(BaseAnswerCache):
+    """Answer cache held in the memory of the current process."""
+
+    def __init__(self, similarity_threshold=0.95, ttl_seconds=None, max_entries=1000):
+        super().__init__(similarity_threshold, ttl_seconds, max_entries)
+        # Ordered from least to most recently used
+        self._entries = OrderedDict()
+        self._next_key = 0
+        self._corpus_version = None
+
+    def _lookup(self, embedding, now):
+        for key in [key for key, entry in self._entries.items() if self._is_expired(entry["created_at"], now)]:
+            del self._entries[key]
+
+        if not self._entries:
+            return None
+
+        keys = list(self._entries)
+        similarities = np.stack([self._entries[key]["embedding"] for key in keys]) @ embedding
+        best = int(np.argmax(similarities))
+        if similarities[best] < self.similarity_threshold:
+            return None
+
+        self._entries.move_to_end(keys[best])
+        return self._entries[keys[best]]["result"]
+
+    def _update(self, embedding, question, result, now):
+        self._entries[self._next_key] = {
+            "embedding": embedding,
+            "question": question,
+            "result": result,
+            "created_at": now,
+        }
+        self._next_key += 1
+
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def _clear(self):
+        self._entries.clear()
+
+    def _get_corpus_version(self):
+        return self._corpus_version
+
+    def _set_corpus_version(self, corpus_version):
+        self._corpus_version = corpus_version
+
+
+class SQLiteAnswerCache(BaseAnswerCache):
+    """Answer cache persisted in a local SQLite database, shared between processes and restarts.
+
+    Several caches (e.g. for chains with different temperatures) can share a database using distinct namespaces.
+    """
+
+    def __init__(self, path, namespace="default", similarity_threshold=0.95, ttl_seconds=None, max_entries=1000):
+        super().__init__(similarity_threshold, ttl_seconds, max_entries)
+        self.namespace = namespace
+        self._connection = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS answers ("
+            "id INTEGER PRIMARY KEY, namespace TEXT, question TEXT, embedding BLOB, "
+            "result TEXT, created_at REAL, last_access REAL)"
+        )
+        self._connection.execute("CREATE INDEX IF NOT EXISTS answers_namespace ON answers (namespace)")
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS corpus_versions (namespace TEXT PRIMARY KEY, version TEXT)"
+        )
+
+    def _lookup(self, embedding, now):
+        if self.ttl_seconds is not None:
+            self._connection.execute(
+                "DELETE FROM answers WHERE namespace = ? AND created_at < ?",
+                (self.namespace, now - self.ttl_seconds),
+            )
+
+        rows = self._connection.execute(
+            "SELECT id, embedding FROM answers WHERE namespace = ?", (self.namespace,)
+        ).fetchall()
+        if not rows:
+            return None
+
+        similarities = np.stack([np.frombuffer(row[1], dtype=np.float32) for row in rows]) @ embedding
+        best = int(np.argmax(similarities))
+        if similarities[best] < self.similarity_threshold:
+            return None
+
+        entry_id = rows[best][0]
+        self._connection.execute("UPDATE answers SET last_access = ? WHERE id = ?", (now, entry_id))
+        (result,) = self._connection.execute("SELECT result FROM answers WHERE id = ?", (entry_id,)).fetchone()
+        return json.loads(result)
+
+    def _update(self, embedding, question, result, now):
+        self._connection.execute(
+            "INSERT INTO answers (namespace, question, embedding, result, created_at, last_access) "
+            "VALUES (?, ?, ?, ?, ?, ?)",
+            (self.namespace, question, embedding.tobytes(), json.dumps(result), now, now),
+        )
+        # Evict the least recently used entries beyond the limit
+        self._connection.execute(
+            "DELETE FROM answers WHERE id IN ("
+            "SELECT id FROM answers WHERE namespace = ? ORDER BY last_access DESC LIMIT -1 OFFSET ?)",
+            (self.namespace, self.max_entries),
+        )
+
+    def _clear(self):
+        self._connection.execute("DELETE FROM answers WHERE namespace = ?", (self.namespace,))
+
+    def _get_corpus_version(self):
+        row = self._connection.execute(
+            "SELECT version FROM corpus_versions WHERE namespace = ?", (self.namespace,)
+        ).fetchone()
+        return row[0] if row else None
+
+    def _set_corpus_version(self, corpus_version):
+        self._connection.execute(
+            "INSERT OR REPLACE INTO corpus_versions (namespace, version) VALUES (?, ?)",
+            (self.namespace, corpus_version),
+        )
+
+
+class CachedQAChain(Chain):
+    """Wraps a ConversationalRetrievalChain with a semantic answer cache.
+
+    The question is condensed with the chat history first, and the standalone question is embedded to look up
+    a previous answer. On a miss the wrapped chain answers the standalone question, so it is only condensed once.
+    """
+
+    qa_chain: Chain
+    embeddings: Any
+    answer_cache: Any
+    corpus_version: Callable[[], str]
+
+    @property
+    def input_keys(self) -> List[str]:
+        return self.qa_chain.input_keys
+
+    @property
+    def output_keys(self) -> List[str]:
+        return self.qa_chain.output_keys
+
+    def condense_question(self, question, chat_history, callbacks=None):
+        """Rephrase a follow-up question as a standalone question, using the wrapped chain's condense step."""
+        chat_history_str = (self.qa_chain.get_chat_history or _get_chat_history)(list(chat_history))
+        if not chat_history_str:
+            return question
+        return self.qa_chain.question_generator.run(
+            question=question, chat_history=chat_history_str, callbacks=callbacks
+        )
+
+    def lookup(self, question):
+        """Return the embedding and corpus version of a standalone question, with its cached result if any."""
+        embedding = self.embeddings.embed_query(question)
+        corpus_version = self.corpus_version()
+        return embedding, corpus_version, self.answer_cache.lookup(embedding, corpus_version)
+
+    def _call(self, inputs, run_manager=None):
+        callbacks = run_manager.get_child() if run_manager else None
+        question = self.condense_question(inputs["question"], inputs["chat_history"], callbacks=callbacks)
+        embedding, corpus_version, result = self.lookup(question)
+        if result is not None:
+            return result
+
+        result = self.qa_chain(
+            {"question": question, "chat_history": []}, callbacks=callbacks, return_only_outputs=True
+        )
+        self.answer_cache.update(embedding, question, result, corpus_version)
+        return result
+
+
+# Written next to a persisted store by whatever ingests into it, see bump_corpus_version
+CORPUS_VERSION_FILE = "corpus_version"
+
+
+def vector_store_corpus_version(vector_store):
+    """A cheap fingerprint of a vector store's contents, which changes as documents are added, removed or replaced."""
+    # MmapVectorStore versions every write, Chroma only exposes the number of documents. Neither tells apart a store
+    # whose chunks were replaced by as many others, e.g. rebuilt into a new directory: the version recorded by the
+    # ingestion does.
+    if hasattr(vector_store, "corpus_version"):
+        version = vector_store.corpus_version
+    else:
+        version = str(vector_store._collection.count())
+
+    persist_directory = _persist_directory(vector_store)
+    if persist_directory:
+        try:
+            with open(os.path.join(persist_directory, CORPUS_VERSION_FILE)) as f:
+                version = f"{f.read().strip()}-{version}"
+        except FileNotFoundError:
+            pass
+    return version
+
+
+def bump_corpus_version(vector_store):
+    """Record that the contents of a persisted store changed, so the answers cached for it are dropped.
+
+    To be called by ingestion once it wrote to the store, including when it failed part way.
+    """
+    persist_directory = _persist_directory(vector_store)
+    if not persist_directory:
+        return
+    os.makedirs(persist_directory, exist_ok=True)
+    path = os.path.join(persist_directory, CORPUS_VERSION_FILE)
+    with open(path + ".tmp", "w") as f:
+        f.write(uuid.uuid4().hex)
+    os.replace(path + ".tmp", path)
+
+
+def _persist_directory(vector_store):
+    # MmapVectorStore, Chroma
+    return getattr(vector_store, "persist_directory", None) or getattr(vector_store, "_persist_directory", None)
+
+
+def _normalise(embedding):
+    embedding = np.asarray(embedding, dtype=np.float32)
+    return embedding / (np.linalg.norm(embedding) or 1.0)
+
+
+def _serialise_result(result):
+    return {
+        "answer": result["answer"],
+        "source_documents": [
+            {"page_content": doc.page_content, "metadata": doc.metadata}
+            for doc in result.get("source_documents", [])
+        ],
+    }
+
+
+def _deserialise_result(result):
+    return {
+        "answer": result["answer"],
+        "source_documents": [Document(**doc) for doc in result["source_documents"]],
+    }
@@ -0,0 +1,71 @@
+"""Content-addressed, persistent cache of document embeddings."""
+import hashlib
+import sqlite3
+import threading
+from typing import Dict, List
+
+import numpy as np
+
+
+class EmbeddingCache:
+    """Stores embeddings in a local SQLite database, keyed on a hash of the model name and the text.
+
+    Identical texts embedded by the same model are looked up instead of being sent to the API again,
+    across ingestion runs and processes. `hits` and `misses` count the texts served from and missing
+    from the cache.
+    """
+
+    def __init__(self, path="embedding_cache.sqlite"):
+        self.path = path
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS embeddings (key TEXT PRIMARY KEY, embedding BLOB)"
+        )
+
+    @staticmethod
+    def key(model_name: str, text: str) -> str:
+        """The content address of a text embedded by a model."""
+        return hashlib.sha256(f"{model_name}\0{text}".encode("utf-8")).hexdigest()
+
+    def get_many(self, keys: List[str]) -> Dict[str, List[float]]:
+        """Return the cached embeddings of the given keys, skipping the keys which aren't cached."""
+        unique_keys = list(dict.fromkeys(keys))
+        found = {}
+
+        with self._lock:
+            # Stay below SQLite's limit on the number of query parameters
+            for start in range(0, len(unique_keys), 500):
+                batch = unique_keys[start : start + 500]
+                rows = self._connection.execute(
+                    f"SELECT key, embedding FROM embeddings WHERE key IN ({','.join('?' * len(batch))})",
+                    batch,
+                ).fetchall()
+                found.update(
+                    (key, np.frombuffer(embedding, dtype=np.float32).tolist()) for key, embedding in rows
+                )
+
+            hits = sum(key in found for key in keys)
+            self.hits += hits
+            self.misses += len(keys) - hits
+
+        return found
+
+    def set_many(self, embeddings: Dict[str, List[float]]):
+        """Cache embeddings by key."""
+        with self._lock, self._connection:
+            self._connection.executemany(
+                "INSERT OR REPLACE INTO embeddings (key, embedding) VALUES (?, ?)",
+                [
+                    (key, np.asarray(embedding, dtype=np.float32).tobytes())
+                    for key, embedding in embeddings.items()
+                ],
+            )
+
+    @property
+    def hit_rate(self) -> float:
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
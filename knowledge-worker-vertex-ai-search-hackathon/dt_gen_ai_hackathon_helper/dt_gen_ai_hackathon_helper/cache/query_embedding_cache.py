@@ -0,0 +1,143 @@
+"""In-process LRU cache of query embeddings."""
+import threading
+from collections import OrderedDict
+from typing import List
+
+from langchain.embeddings.base import Embeddings
+
+from dt_gen_ai_hackathon_helper.cache.embedding_cache import EmbeddingCache
+
+
+def normalise_query(text: str) -> str:
+    """Queries differing only in whitespace or case share their embedding."""
+    return " ".join(text.split()).lower()
+
+
+class CachedQueryEmbeddings(Embeddings):
+    """Wraps an embeddings model so repeated queries are embedded once.
+
+    Query embeddings are kept in a thread-safe LRU of `max_entries`, keyed on the normalised query, and optionally in
+    an EmbeddingCache so they survive restarts. Documents are passed through to the wrapped model.
+    `hits` count the queries served from either cache, `misses` the queries sent to the model.
+
+    Arguments:
+        embeddings (Embeddings): The wrapped embeddings model.
+        max_entries (int): The number of query embeddings kept in memory.
+        persistent_cache (EmbeddingCache): Optional on-disk cache, shared between processes and restarts.
+    """
+
+    def __init__(self, embeddings: Embeddings, max_entries: int = 1024, persistent_cache: EmbeddingCache = None):
+        self.embeddings = embeddings
+        self.max_entries = max_entries
+        self.persistent_cache = persistent_cache
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        # Embeddings of another model must not be served from the persistent cache
+        self._model_name = getattr(embeddings, "model_name", type(embeddings).__name__)
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        return self.embeddings.embed_documents(texts)
+
+    def embed_query(self, text: str) -> List[float]:
+        query = normalise_query(text)
+
+        with self._lock:
+            embedding = self._entries.get(query)
+            if embedding is not None:
+                self.hits += 1
+                self._entries.move_to_end(query)
+                return list(embedding)
+
+        embedding = self._get_persisted(query)
+        hit = embedding is not None
+        if not hit:
+            embedding = self.embeddings.embed_query(text)
+            if self.persistent_cache is not None:
+                self.persistent_cache.set_many({self._persistent_key(query): embedding})
+
+        with self._lock:
+            # Only queries sent to the model count as misses
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+            self._entries[query] = tuple(embedding)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+        return list(embedding)
+
+    def embed_queries(self, texts: List[str]) -> List[List[float]]:
+        """Embed many queries at once, the ones missing from both caches in a single batched request to the model.
+
+        The misses are embedded with `embed_documents`, which batches them: the Vertex AI models embed queries and
+        documents alike, a model which doesn't should implement `embed_queries` itself.
+        """
+        queries = [normalise_query(text) for text in texts]
+        embeddings = {}
+        with self._lock:
+            for query in queries:
+                embedding = self._entries.get(query)
+                if embedding is not None:
+                    self._entries.move_to_end(query)
+                    embeddings[query] = embedding
+
+        missing = [query for query in dict.fromkeys(queries) if query not in embeddings]
+        persisted = self._get_many_persisted(missing)
+        embeddings.update(persisted)
+
+        # Identical queries in the batch are only embedded once
+        texts_by_query = dict(zip(queries, texts))
+        missing = [query for query in missing if query not in persisted]
+        if missing:
+            embed = getattr(self.embeddings, "embed_queries", self.embeddings.embed_documents)
+            computed = dict(zip(missing, embed([texts_by_query[query] for query in missing])))
+            if self.persistent_cache is not None:
+                self.persistent_cache.set_many({self._persistent_key(query): computed[query] for query in missing})
+            embeddings.update(computed)
+
+        with self._lock:
+            self.hits += len(queries) - len(missing)
+            self.misses += len(missing)
+            for query in missing + list(persisted):
+                self._entries[query] = tuple(embeddings[query])
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+        return [list(embeddings[query]) for query in queries]
+
+    @property
+    def hit_rate(self) -> float:
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def _get_persisted(self, query):
+        if self.persistent_cache is None:
+            return None
+        key = self._persistent_key(query)
+        return self.persistent_cache.get_many([key]).get(key)
+
+    def _get_many_persisted(self, queries):
+        if self.persistent_cache is None or not queries:
+            return {}
+        keys = {self._persistent_key(query): query for query in queries}
+        return {keys[key]: embedding for key, embedding in self.persistent_cache.get_many(list(keys)).items()}
+
+    def _persistent_key(self, query):
+        # Queries and documents are embedded differently by some models, so they don't share keys
+        return EmbeddingCache.key(self._model_name, f"query\0{query}")
+
+
+def with_query_embedding_cache(vector_store, max_entries: int = 1024, persistent_cache: EmbeddingCache = None):
+    """Wrap the embeddings of a vector store with a CachedQueryEmbeddings, unless they already are."""
+    if not isinstance(vector_store._embedding_function, CachedQueryEmbeddings):
+        vector_store._embedding_function = CachedQueryEmbeddings(
+            vector_store._embedding_function, max_entries=max_entries, persistent_cache=persistent_cache
+        )
+    return vector_store
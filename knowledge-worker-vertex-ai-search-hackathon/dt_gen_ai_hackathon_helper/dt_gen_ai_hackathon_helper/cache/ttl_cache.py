@@ -0,0 +1,54 @@
+"""In-process cache with time-to-live and least-recently-used eviction."""
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Hashable, Optional
+
+
+class TTLCache:
+    """Thread-safe mapping whose entries expire after `ttl_seconds`, holding at most `max_entries`.
+
+    Beyond `max_entries` the least recently used entry is evicted. `hits` and `misses` count the lookups.
+    """
+
+    def __init__(self, max_entries: int = 256, ttl_seconds: Optional[float] = 300):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: Hashable) -> Optional[Any]:
+        """Return the value cached for a key, or None if it is missing or expired."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and self._is_expired(entry[0]):
+                del self._entries[key]
+                entry = None
+
+            if entry is None:
+                self.misses += 1
+                return None
+
+            self.hits += 1
+            self._entries.move_to_end(key)
+            return entry[1]
+
+    def set(self, key: Hashable, value: Any):
+        """Cache a value, evicting the least recently used entries beyond the limit."""
+        with self._lock:
+            self._entries[key] = (time.monotonic(), value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _is_expired(self, created_at):
+        return self.ttl_seconds is not None and time.monotonic() - created_at > self.ttl_seconds
@@ -1,8 +1,19 @@
+import queue
+import threading
+
+from langchain.callbacks.base import BaseCallbackHandler
 from langchain.chains import ConversationalRetrievalChain
+from langchain.chains.conversational_retrieval.base import _get_chat_history
 from langchain.llms import VertexAI
 
+from dt_gen_ai_hackathon_helper.cache.answer_cache import CachedQAChain, vector_store_corpus_version
+from dt_gen_ai_hackathon_helper.cache.query_embedding_cache import with_query_embedding_cache
+from dt_gen_ai_hackathon_helper.context_packer.context_packer import ContextPackingRetriever
+
 
-def create_qa_chain(vector_store, condense_question_prompt, k=4, temperature=0.0):
+def create_qa_chain(
+    vector_store, condense_question_prompt, k=4, temperature=0.0, answer_cache=None, context_packer=None
+):
     """ Create a Q&A conversation chain using the VertexAI LLM.
 
     Arguments:
@@ -10,10 +21,18 @@ def create_qa_chain(vector_store, condense_question_prompt, k=4, temperature=0.0
         condense_question_prompt (PromptTemplate): The prompt template used to prompt engineer our LLM to respond in a certain tone, etc.
         k (int): the 'k' value indicates the number of sources to use per query. 'k' as in 'k-nearest-neighbours' to the query in the embedding space.
         temperature (float): the degree of randomness introduced into the LLM response.
+        answer_cache (BaseAnswerCache): optional semantic cache, answering near-identical questions without calling the LLM.
+        context_packer (ContextPacker): optional packer, deduplicating the k retrieved documents and cutting them to a token budget.
     """
 
+    # Regenerated answers and frequently asked questions reuse the embedding of their standalone question
+    vector_store = with_query_embedding_cache(vector_store)
+
     # A vector store retriever relates queries to embedded documents
-    retriever = vector_store.as_retriever(k=k)
+    retriever = vector_store.as_retriever(search_kwargs={"k": k})
+    if context_packer is not None:
+        # Duplicate and redundant documents are dropped before they reach the prompt, within its token budget
+        retriever = ContextPackingRetriever(vector_store=vector_store, packer=context_packer, fetch_k=k)
 
     # The selected Google model uses embedded documents related to the query
     # It parses these documents in order to answer the user question.
@@ -31,4 +50,115 @@ def create_qa_chain(vector_store, condense_question_prompt, k=4, temperature=0.0
         condense_question_prompt=condense_question_prompt,
     )
 
-    return chain
\ No newline at end of file
+    if answer_cache is not None:
+        # Near-identical standalone questions against the same documents reuse the cached answer and sources
+        chain = CachedQAChain(
+            qa_chain=chain,
+            embeddings=vector_store._embedding_function,
+            answer_cache=answer_cache,
+            corpus_version=lambda: vector_store_corpus_version(vector_store),
+        )
+
+    return chain
+
+
+class _TokenQueueHandler(BaseCallbackHandler):
+    """Forwards tokens from a streaming LLM to a queue, so they can be consumed while generation runs."""
+
+    def __init__(self, tokens):
+        self.tokens = tokens
+
+    def on_llm_new_token(self, token, **kwargs):
+        self.tokens.put(token)
+
+
+def stream_qa_chain(qa_chain, question, chat_history):
+    """ Run a Q&A conversation chain step by step, yielding results as soon as they are available.
+
+    Yields ("sources", documents) once retrieval finishes, then ("token", text) as the answer is generated,
+    and finally ("answer", text) with the complete answer. Chains other than a ConversationalRetrievalChain
+    are run in one go.
+
+    Arguments:
+        qa_chain (Chain): The Q&A chain, e.g. as created by create_qa_chain.
+        question (str): The user question.
+        chat_history (iterable): The previous (question, answer) pairs of the conversation.
+    """
+    chat_history = list(chat_history)
+
+    if isinstance(qa_chain, CachedQAChain):
+        yield from _stream_cached_qa_chain(qa_chain, question, chat_history)
+        return
+
+    if not isinstance(qa_chain, ConversationalRetrievalChain):
+        response = qa_chain({"question": question, "chat_history": chat_history})
+        yield "sources", response.get("source_documents", [])
+        yield "token", response["answer"]
+        yield "answer", response["answer"]
+        return
+
+    # Condense the question and retrieve the sources the same way ConversationalRetrievalChain does
+    chat_history_str = (qa_chain.get_chat_history or _get_chat_history)(chat_history)
+    if chat_history_str:
+        question = qa_chain.question_generator.run(
+            question=question, chat_history=chat_history_str
+        )
+
+    documents = qa_chain.retriever.get_relevant_documents(question)
+    yield "sources", documents
+
+    # Generation runs in its own thread, the tokens it streams are handed over through the queue
+    tokens = queue.Queue()
+    end_of_answer = object()
+    result = {}
+
+    def generate():
+        try:
+            result["answer"] = qa_chain.combine_docs_chain.run(
+                input_documents=documents,
+                question=question,
+                chat_history=chat_history_str,
+                callbacks=[_TokenQueueHandler(tokens)],
+            )
+        except Exception as e:
+            result["error"] = e
+        finally:
+            tokens.put(end_of_answer)
+
+    threading.Thread(target=generate, daemon=True).start()
+
+    streamed = False
+    for token in iter(tokens.get, end_of_answer):
+        streamed = True
+        yield "token", token
+
+    if "error" in result:
+        raise result["error"]
+
+    # LLMs without token streaming produce the whole answer at once
+    if not streamed:
+        yield "token", result["answer"]
+
+    yield "answer", result["answer"]
+
+
+def _stream_cached_qa_chain(cached_chain, question, chat_history):
+    question = cached_chain.condense_question(question, chat_history)
+    embedding, corpus_version, result = cached_chain.lookup(question)
+
+    if result is not None:
+        yield "sources", result["source_documents"]
+        yield "token", result["answer"]
+        yield "answer", result["answer"]
+        return
+
+    # The question is already standalone, so the wrapped chain doesn't need the chat history
+    documents = []
+    for event, data in stream_qa_chain(cached_chain.qa_chain, question, []):
+        if event == "sources":
+            documents = data
+        elif event == "answer":
+            cached_chain.answer_cache.update(
+                embedding, question, {"answer": data, "source_documents": documents}, corpus_version
+            )
+        yield event, data
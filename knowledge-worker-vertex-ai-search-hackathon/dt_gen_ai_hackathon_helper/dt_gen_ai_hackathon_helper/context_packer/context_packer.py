@@ -0,0 +1,214 @@
+"""Post-retrieval packing of the documents stuffed into the prompt."""
+import asyncio
+import hashlib
+from typing import Any, Callable, List, Optional, Sequence
+
+import numpy as np
+from langchain.schema import BaseRetriever, Document
+
+
+def approximate_token_count(text: str) -> int:
+    """A cheap token estimate (about four characters per token)."""
+    return len(text) // 4 + 1
+
+
+class ContextPacker:
+    """Selects the retrieved documents which go into the prompt.
+
+    Exact duplicates and near-duplicates are dropped, the remaining documents are ordered by maximal marginal
+    relevance (MMR) and added until the token budget is spent. Similarity is the cosine of the document embeddings
+    when they are available, and the overlap of word shingles otherwise.
+
+    Arguments:
+        token_budget (int): The maximum (estimated) number of tokens of the selected documents.
+        max_documents (int): Optional maximum number of selected documents.
+        lambda_mult (float): Trades relevance (1.0) against diversity (0.0) in MMR.
+        duplicate_threshold (float): Documents whose embedding is at least this similar to a selected document's are
+            dropped.
+        shingle_duplicate_threshold (float): The same, for the shingle overlap when there are no embeddings.
+        min_score (float): Optional minimum cosine similarity to the query, only applied with embeddings.
+        token_counter (callable): Estimates the number of tokens of a text.
+    """
+
+    def __init__(
+        self,
+        token_budget: int = 3000,
+        max_documents: Optional[int] = None,
+        lambda_mult: float = 0.7,
+        duplicate_threshold: float = 0.95,
+        shingle_duplicate_threshold: float = 0.8,
+        min_score: Optional[float] = None,
+        token_counter: Callable[[str], int] = approximate_token_count,
+    ):
+        self.token_budget = token_budget
+        self.max_documents = max_documents
+        self.lambda_mult = lambda_mult
+        self.duplicate_threshold = duplicate_threshold
+        self.shingle_duplicate_threshold = shingle_duplicate_threshold
+        self.min_score = min_score
+        self.token_counter = token_counter
+
+    def pack(
+        self,
+        documents: Sequence[Document],
+        embeddings: Optional[Sequence[Sequence[float]]] = None,
+        query_embedding: Optional[Sequence[float]] = None,
+    ) -> List[Document]:
+        """Return the documents to put into the prompt, most relevant first.
+
+        Arguments:
+            documents (list): The retrieved documents, by decreasing relevance.
+            embeddings (list): Optional embeddings of the documents.
+            query_embedding (list): Optional embedding of the query, to score relevance against the embeddings.
+        """
+        documents, embeddings = _drop_exact_duplicates(documents, embeddings)
+        if not documents:
+            return []
+
+        vectors = _normalise(np.asarray(embeddings, dtype=np.float32)) if embeddings is not None else None
+        if vectors is not None and query_embedding is not None:
+            relevance = vectors @ _normalise(np.asarray(query_embedding, dtype=np.float32))
+            if self.min_score is not None:
+                keep = np.flatnonzero(relevance >= self.min_score)
+                documents, vectors, relevance = [documents[i] for i in keep], vectors[keep], relevance[keep]
+        else:
+            # Retrievers return documents by decreasing relevance, so the rank stands in for the score
+            relevance = 1.0 - np.arange(len(documents)) / len(documents)
+        shingles = None if vectors is not None else [_shingles(document.page_content) for document in documents]
+        duplicate_threshold = self.duplicate_threshold if vectors is not None else self.shingle_duplicate_threshold
+
+        selected, tokens = [], 0
+        remaining = list(range(len(documents)))
+        # The similarity of every document to its closest selected document
+        max_similarity = np.zeros(len(documents), dtype=np.float32)
+        while remaining and (self.max_documents is None or len(selected) < self.max_documents):
+            scores = self.lambda_mult * relevance[remaining] - (1 - self.lambda_mult) * max_similarity[remaining]
+            best = remaining.pop(int(np.argmax(scores)))
+
+            if selected and max_similarity[best] >= duplicate_threshold:
+                continue
+            cost = self.token_counter(documents[best].page_content)
+            if tokens + cost > self.token_budget:
+                # A shorter document further down may still fit
+                continue
+
+            selected.append(best)
+            tokens += cost
+            if vectors is not None:
+                similarity = vectors @ vectors[best]
+            else:
+                similarity = np.array([_jaccard(shingles[best], other) for other in shingles], dtype=np.float32)
+            np.maximum(max_similarity, similarity, out=max_similarity)
+
+        return [documents[i] for i in selected]
+
+
+class ContextPackingRetriever(BaseRetriever):
+    """Retrieves candidate documents and packs them with a ContextPacker.
+
+    Given a vector store, the candidates are searched with their stored embeddings, so packing doesn't embed
+    anything again. Given any other retriever (e.g. EnterpriseSearchRetriever), documents are compared by their text.
+
+    Arguments:
+        packer (ContextPacker): Selects the documents put into the prompt.
+        vector_store (VectorStore): The Chroma or MmapVectorStore to search, or else
+        retriever (BaseRetriever): The retriever whose documents are packed.
+        fetch_k (int): The number of candidates searched in the vector store.
+    """
+
+    packer: Any
+    vector_store: Any = None
+    retriever: Optional[BaseRetriever] = None
+    fetch_k: int = 20
+
+    class Config:
+        arbitrary_types_allowed = True
+
+    def _get_relevant_documents(self, query: str, *, run_manager=None) -> List[Document]:
+        if self.vector_store is not None:
+            return self._search_and_pack(query)
+
+        callbacks = run_manager.get_child() if run_manager else None
+        return self.packer.pack(self.retriever.get_relevant_documents(query, callbacks=callbacks))
+
+    async def _aget_relevant_documents(self, query: str, *, run_manager=None) -> List[Document]:
+        if self.vector_store is not None:
+            return await asyncio.get_running_loop().run_in_executor(None, self._search_and_pack, query)
+
+        callbacks = run_manager.get_child() if run_manager else None
+        return self.packer.pack(await self.retriever.aget_relevant_documents(query, callbacks=callbacks))
+
+    def _search_and_pack(self, query):
+        # Embedded once by the query embedding cache, e.g. when the answer cache embedded it before
+        query_embedding = self.vector_store._embedding_function.embed_query(query)
+        documents, embeddings = search_with_embeddings(self.vector_store, query_embedding, self.fetch_k)
+        return self.packer.pack(documents, embeddings=embeddings, query_embedding=query_embedding)
+
+    def search_and_pack_many(self, query_embeddings: List[List[float]]) -> List[List[Document]]:
+        """Search the candidates of many embedded queries in one call to the vector store, and pack each."""
+        return [
+            self.packer.pack(documents, embeddings=embeddings, query_embedding=query_embedding)
+            for query_embedding, (documents, embeddings) in zip(
+                query_embeddings, search_many_with_embeddings(self.vector_store, query_embeddings, self.fetch_k)
+            )
+        ]
+
+
+def search_with_embeddings(vector_store, query_embedding, k):
+    """Return the k documents closest to an embedding, with their stored embeddings."""
+    return search_many_with_embeddings(vector_store, [query_embedding], k)[0]
+
+
+def search_many_with_embeddings(vector_store, query_embeddings, k):
+    """Search the k documents closest to each of many embeddings in one call, with their stored embeddings."""
+    if hasattr(vector_store, "similarity_search_by_vectors_with_embeddings"):
+        return [
+            ([document for document, _ in results], [embedding for _, embedding in results])
+            for results in vector_store.similarity_search_by_vectors_with_embeddings(query_embeddings, k=k)
+        ]
+
+    # Chroma refuses to return more results than the collection holds
+    collection = vector_store._collection
+    n_results = min(k, collection.count())
+    if not n_results:
+        return [([], []) for _ in query_embeddings]
+    results = collection.query(
+        query_embeddings=list(query_embeddings),
+        n_results=n_results,
+        include=["documents", "metadatas", "embeddings"],
+    )
+    return [
+        (
+            [Document(page_content=text, metadata=metadata or {}) for text, metadata in zip(texts, metadatas)],
+            embeddings,
+        )
+        for texts, metadatas, embeddings in zip(results["documents"], results["metadatas"], results["embeddings"])
+    ]
+
+
+def _drop_exact_duplicates(documents, embeddings):
+    seen = set()
+    kept_documents, kept_embeddings = [], []
+    for i, document in enumerate(documents):
+        key = hashlib.sha1(" ".join(document.page_content.split()).lower().encode("utf-8")).digest()
+        if key in seen:
+            continue
+        seen.add(key)
+        kept_documents.append(document)
+        if embeddings is not None:
+            kept_embeddings.append(embeddings[i])
+    return kept_documents, kept_embeddings if embeddings is not None else None
+
+
+def _shingles(text, size=3):
+    words = text.lower().split()
+    return {tuple(words[i : i + size]) for i in range(max(len(words) - size + 1, 1))}
+
+
+def _jaccard(a, b):
+    return len(a & b) / len(a | b) if a or b else 1.0
+
+
+def _normalise(vectors):
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    return vectors / np.where(norms == 0, 1.0, norms)
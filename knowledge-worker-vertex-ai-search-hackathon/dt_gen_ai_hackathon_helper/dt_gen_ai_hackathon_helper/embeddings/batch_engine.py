@@ -0,0 +1,136 @@
+"""Concurrent, pipelined batch embedding."""
+import random
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from typing import Callable, Iterator, List, Optional, Tuple, Type
+
+from google.api_core import exceptions as google_exceptions
+
+from dt_gen_ai_hackathon_helper.rate_limiter.rate_limiter import RateLimiter
+
+# Errors a retry may get past: quota exhausted, service overloaded, timeouts and connection errors.
+# Others, e.g. InvalidArgument for a text over the model's limit, would fail again, so they are raised right away.
+TRANSIENT_ERRORS = (
+    google_exceptions.ResourceExhausted,
+    google_exceptions.TooManyRequests,
+    google_exceptions.ServiceUnavailable,
+    google_exceptions.DeadlineExceeded,
+    ConnectionError,
+    TimeoutError,
+)
+
+
+def approximate_token_count(text: str) -> int:
+    """A cheap token estimate (about four characters per token), good enough to size batches."""
+    return len(text) // 4 + 1
+
+
+class BatchEmbeddingEngine:
+    """Embeds texts in batches, keeping several batches in flight at once.
+
+    Batches are packed by number of texts and by token budget. Each batch is retried on its own when it fails,
+    and the embeddings are returned in the order of the input texts.
+
+    The time spent waiting on the rate limiter and in requests is totalled in `rate_limit_wait_seconds` and
+    `request_seconds`, to tell the limiter stalling apart from the API being slow.
+
+    Arguments:
+        embed_batch (callable): Embeds a list of texts with one API request, returning one vector per text.
+        max_instances_per_batch (int): The maximum number of texts per request.
+        max_tokens_per_batch (int): The maximum (estimated) number of tokens per request.
+        max_concurrent_requests (int): The maximum number of requests in flight.
+        requests_per_minute (int): Optional quota, requests are spaced to stay within it.
+        max_retries (int): The number of times a failing batch is retried, with exponential backoff.
+        retry_on (tuple): The errors a batch is retried on, transient ones by default.
+        token_counter (callable): Estimates the number of tokens of a text.
+    """
+
+    def __init__(
+        self,
+        embed_batch: Callable[[List[str]], List[List[float]]],
+        max_instances_per_batch: int = 5,
+        max_tokens_per_batch: int = 20000,
+        max_concurrent_requests: int = 4,
+        requests_per_minute: Optional[int] = None,
+        max_retries: int = 3,
+        token_counter: Callable[[str], int] = approximate_token_count,
+        retry_on: Tuple[Type[BaseException], ...] = TRANSIENT_ERRORS,
+    ):
+        self.embed_batch = embed_batch
+        self.max_instances_per_batch = max_instances_per_batch
+        self.max_tokens_per_batch = max_tokens_per_batch
+        self.max_concurrent_requests = max_concurrent_requests
+        self.max_retries = max_retries
+        self.retry_on = retry_on
+        self.token_counter = token_counter
+        self.rate_limiter = RateLimiter(requests_per_minute) if requests_per_minute else None
+        self.rate_limit_wait_seconds = 0.0
+        self.request_seconds = 0.0
+        self._timings_lock = threading.Lock()
+
+    def pack(self, texts: List[str]) -> Iterator[range]:
+        """Yield batches as ranges of indices into `texts`, within the instance and token limits."""
+        start, tokens = 0, 0
+        for index, text in enumerate(texts):
+            text_tokens = self.token_counter(text)
+            batch_full = (
+                index - start >= self.max_instances_per_batch
+                or tokens + text_tokens > self.max_tokens_per_batch
+            )
+            # A text over the token budget still gets a batch of its own
+            if batch_full and index > start:
+                yield range(start, index)
+                start, tokens = index, 0
+            tokens += text_tokens
+
+        if start < len(texts):
+            yield range(start, len(texts))
+
+    def embed(self, texts: List[str]) -> List[List[float]]:
+        """Embed all texts, returning their embeddings in order."""
+        texts = list(texts)
+        results = [None] * len(texts)
+        batches = self.pack(texts)
+
+        with ThreadPoolExecutor(max_workers=self.max_concurrent_requests) as executor:
+            in_flight = {}
+
+            def submit_next():
+                batch = next(batches, None)
+                if batch is not None:
+                    future = executor.submit(self._embed_with_retries, [texts[i] for i in batch])
+                    in_flight[future] = batch
+
+            # Keep every worker busy, without materialising the futures for the whole corpus
+            for _ in range(self.max_concurrent_requests):
+                submit_next()
+
+            while in_flight:
+                done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                for future in done:
+                    batch = in_flight.pop(future)
+                    results[batch.start : batch.stop] = future.result()
+                    submit_next()
+
+        return results
+
+    def _embed_with_retries(self, batch: List[str]) -> List[List[float]]:
+        for attempt in range(self.max_retries + 1):
+            try:
+                return self._request(batch)
+            except self.retry_on:
+                if attempt == self.max_retries:
+                    raise
+                # Exponential backoff with jitter, so failed batches don't retry in lockstep
+                time.sleep(2**attempt + random.random())
+
+    def _request(self, batch: List[str]) -> List[List[float]]:
+        wait = self.rate_limiter.acquire() if self.rate_limiter is not None else 0.0
+        started = time.perf_counter()
+        try:
+            return self.embed_batch(batch)
+        finally:
+            with self._timings_lock:
+                self.rate_limit_wait_seconds += wait
+                self.request_seconds += time.perf_counter() - started
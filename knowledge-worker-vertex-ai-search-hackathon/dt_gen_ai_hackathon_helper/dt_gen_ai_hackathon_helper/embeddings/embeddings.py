@@ -1,39 +1,99 @@
-from typing import List
+import threading
+from typing import Any, List
 from langchain.vectorstores import Chroma
 from langchain.embeddings import VertexAIEmbeddings
-from dt_gen_ai_hackathon_helper.rate_limiter.rate_limiter import rate_limit
+from pydantic import PrivateAttr
+from dt_gen_ai_hackathon_helper.cache.embedding_cache import EmbeddingCache
+from dt_gen_ai_hackathon_helper.cache.query_embedding_cache import CachedQueryEmbeddings
+from dt_gen_ai_hackathon_helper.embeddings.batch_engine import BatchEmbeddingEngine
+from dt_gen_ai_hackathon_helper.vector_store.mmap_store import MmapVectorStore
 
 
 class CustomVertexAIEmbeddings(VertexAIEmbeddings):
     requests_per_minute: int
     num_instances_per_batch: int
+    # Batches kept in flight at once, and the (estimated) token budget of a batch.
+    # Requests are still spaced to stay within requests_per_minute, however many are in flight.
+    max_concurrent_requests: int = 4
+    max_tokens_per_batch: int = 20000
+    # Optional EmbeddingCache, so unchanged texts aren't embedded again on every ingestion run
+    embedding_cache: Any = None
+    # Built on first use and shared by every call, so its rate limiter spaces the requests of all of them
+    _engine: Any = PrivateAttr(default=None)
+    _engine_lock: Any = PrivateAttr(default_factory=threading.Lock)
+
+    @property
+    def rate_limit_wait_seconds(self) -> float:
+        """The time spent waiting on the rate limiter, over every call."""
+        return self._get_engine().rate_limit_wait_seconds
+
+    @property
+    def embedding_request_seconds(self) -> float:
+        """The time spent in embedding requests, over every call."""
+        return self._get_engine().request_seconds
 
     # Overriding embed_documents method
     def embed_documents(self, texts: List[str]):
-        limiter = rate_limit(self.requests_per_minute)
-        results = []
-        docs = list(texts)
+        texts = list(texts)
+        if self.embedding_cache is None:
+            return self._embed_batches(texts)
+
+        keys = [self.embedding_cache.key(self.model_name, text) for text in texts]
+        embeddings = self.embedding_cache.get_many(keys)
+
+        # Only the texts missing from the cache are sent to the API, each distinct text once
+        missing = {}
+        for key, text in zip(keys, texts):
+            if key not in embeddings:
+                missing.setdefault(key, text)
 
-        while docs:
-            # Working in batches because the API accepts maximum 5
-            # documents per request to get embeddings
-            head, docs = (
-                docs[: self.num_instances_per_batch],
-                docs[self.num_instances_per_batch :],
-            )
-            chunk = self.client.get_embeddings(head)
-            results.extend(chunk)
-            next(limiter)
+        if missing:
+            new_embeddings = dict(zip(missing, self._embed_batches(list(missing.values()))))
+            self.embedding_cache.set_many(new_embeddings)
+            embeddings.update(new_embeddings)
 
-        return [r.values for r in results]
+        # Return the embeddings in the order of the input texts
+        return [embeddings[key] for key in keys]
 
+    def _embed_batches(self, texts: List[str]):
+        return self._get_engine().embed(texts)
 
-def load_embeddings(persist_directory):
+    def _get_engine(self) -> BatchEmbeddingEngine:
+        with self._engine_lock:
+            if self._engine is None:
+                # Working in batches because the API accepts maximum 5
+                # documents per request to get embeddings
+                self._engine = BatchEmbeddingEngine(
+                    embed_batch=lambda batch: [r.values for r in self.client.get_embeddings(batch)],
+                    max_instances_per_batch=self.num_instances_per_batch,
+                    max_tokens_per_batch=self.max_tokens_per_batch,
+                    max_concurrent_requests=self.max_concurrent_requests,
+                    requests_per_minute=self.requests_per_minute,
+                )
+            return self._engine
+
+
+def load_embeddings(
+    persist_directory, store_type="chroma", dtype="float32", query_cache_size=1024, query_cache_path=None
+):
     # We use VertexAI embeddings model, however other models can be substituted here
-    embeddings = VertexAIEmbeddings()
+    # Repeated questions are only embedded once, optionally across restarts (query_cache_path)
+    embeddings = CachedQueryEmbeddings(
+        VertexAIEmbeddings(),
+        max_entries=query_cache_size,
+        persistent_cache=EmbeddingCache(query_cache_path) if query_cache_path else None,
+    )
 
     # Creating embeddings with each re-run is highly inefficient and costly.
     # We instead aim to embed once, then load these embeddings from storage.
+    if store_type == "mmap":
+        # Memory-mapped NumPy segments: opens in milliseconds and is shared between processes through the page cache
+        return MmapVectorStore(
+            embedding_function=embeddings,
+            persist_directory=persist_directory,
+            dtype=dtype,
+        )
+
     vector_store = Chroma(
         embedding_function=embeddings,
         persist_directory=persist_directory,
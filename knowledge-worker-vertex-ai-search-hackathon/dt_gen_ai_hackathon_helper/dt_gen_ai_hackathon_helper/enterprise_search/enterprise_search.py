@@ -2,7 +2,10 @@
 # pylint: disable=no-self-argument
 from __future__ import annotations
 
-from typing import Any, Dict, List
+import asyncio
+import json
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, List, Optional
 
 from google.cloud import discoveryengine_v1beta
 from google.cloud.discoveryengine_v1beta.services.search_service import pagers
@@ -10,6 +13,8 @@ from langchain.schema import BaseRetriever, Document
 from langchain.utils import get_from_dict_or_env
 from pydantic import BaseModel, Extra, root_validator
 
+from dt_gen_ai_hackathon_helper.cache.ttl_cache import TTLCache
+
 
 class EnterpriseSearchRetriever(BaseRetriever, BaseModel):
     """Wrapper around Google Cloud Enterprise Search.
@@ -19,6 +24,7 @@ class EnterpriseSearchRetriever(BaseRetriever, BaseModel):
     """
 
     client: Any = None  #: :meta private:
+    async_clients: Any = None  #: :meta private:
     serving_config: Any = None  #: :meta private:Any
     content_search_spec: Any = None  #: :meta private:Any
     project_id: str = ""
@@ -31,6 +37,14 @@ class EnterpriseSearchRetriever(BaseRetriever, BaseModel):
     "when making API calls. If not provided, credentials will be ascertained from "
     "the environment."
     k: int = 100  # The maximum number of documents to return.
+    max_documents: Optional[int] = None
+    "The maximum number of snippets (LangChain documents) to return, e.g. what fits into the prompt. "
+    "Search results stop being converted as soon as it is reached."
+    cache_ttl_seconds: Optional[float] = 300
+    "How long search results are cached in-process, so repeated questions skip the remote search. "
+    "Set cache_max_entries to 0 to disable the cache."
+    cache_max_entries: int = 256
+    search_cache: Any = None  #: :meta private:
 
     class Config:
         """Configuration for this pydantic object."""
@@ -83,17 +97,29 @@ class EnterpriseSearchRetriever(BaseRetriever, BaseModel):
         }
         values["content_search_spec"] = content_search_spec
 
+        # The async (gRPC asyncio) client is bound to the event loop it was created on, so there is one per loop,
+        # e.g. each asyncio.run() in a notebook runs on a new loop
+        values["async_clients"] = {}
+
+        if values["cache_max_entries"] > 0:
+            values["search_cache"] = TTLCache(
+                max_entries=values["cache_max_entries"],
+                ttl_seconds=values["cache_ttl_seconds"],
+            )
+
         return values
 
     def _convert_search_response(
         self, search_results: pagers.SearchPager
     ) -> List[Document]:
-        """Converts search response to a list of LangChain documents."""
+        """Converts search response to a list of LangChain documents, up to `max_documents`."""
         documents = []
         for result in search_results:
             if hasattr(result.document, "derived_struct_data"):
                 doc_data = result.document.derived_struct_data
                 for snippet in doc_data.get("snippets", []):
+                    if self._budget_reached(documents):
+                        break
                     documents.append(
                         Document(
                             page_content=snippet.get("snippet", ""),
@@ -103,20 +129,110 @@ class EnterpriseSearchRetriever(BaseRetriever, BaseModel):
                             },
                         )
                     )
+            # Checked before moving on, the pager fetches the next page when iterated past the current one
+            if self._budget_reached(documents):
+                break
         return documents
 
-    def get_relevant_documents(self, query: str) -> List[Document]:
-        """Get documents relevant for a query."""
-        request = discoveryengine_v1beta.SearchRequest(
+    def _budget_reached(self, documents: List[Document]) -> bool:
+        return self.max_documents is not None and len(documents) >= self.max_documents
+
+    def _create_search_request(self, query: str) -> discoveryengine_v1beta.SearchRequest:
+        # Results usually carry at least one snippet, so requesting more results than the budget only adds payload
+        page_size = self.k if self.max_documents is None else min(self.k, self.max_documents)
+        return discoveryengine_v1beta.SearchRequest(
             query=query,
             serving_config=self.serving_config,
             content_search_spec=self.content_search_spec,
-            page_size=self.k,
+            page_size=page_size,
         )
+
+    def _cache_key(self, query: str):
+        return (
+            query,
+            self.serving_config,
+            json.dumps(self.content_search_spec, sort_keys=True),
+            self.k,
+            self.max_documents,
+        )
+
+    def _get_cached_documents(self, query: str) -> Optional[List[Document]]:
+        if self.search_cache is None:
+            return None
+        documents = self.search_cache.get(self._cache_key(query))
+        return list(documents) if documents is not None else None
+
+    def _cache_documents(self, query: str, documents: List[Document]):
+        if self.search_cache is not None:
+            self.search_cache.set(self._cache_key(query), list(documents))
+
+    def _get_async_client(self) -> discoveryengine_v1beta.SearchServiceAsyncClient:
+        """Returns the async client of the running event loop, creating it on first use."""
+        loop = asyncio.get_running_loop()
+        async_client = self.async_clients.get(loop)
+        if async_client is None:
+            # The clients of closed loops can't be used again (nor closed), drop them
+            for closed_loop in [other for other in self.async_clients if other.is_closed()]:
+                del self.async_clients[closed_loop]
+            async_client = discoveryengine_v1beta.SearchServiceAsyncClient(
+                credentials=self.credentials
+            )
+            self.async_clients[loop] = async_client
+        return async_client
+
+    def get_relevant_documents(self, query: str) -> List[Document]:
+        """Get documents relevant for a query."""
+        documents = self._get_cached_documents(query)
+        if documents is not None:
+            return documents
+
+        request = self._create_search_request(query)
         response = self.client.search(request)
         documents = self._convert_search_response(response.results)
+        self._cache_documents(query, documents)
 
         return documents
 
     async def aget_relevant_documents(self, query: str) -> List[Document]:
-        raise NotImplementedError("Async interface not implemented")
+        """Get documents relevant for a query, using the async Discovery Engine client."""
+        documents = self._get_cached_documents(query)
+        if documents is not None:
+            return documents
+
+        request = self._create_search_request(query)
+        response = await self._get_async_client().search(request)
+        documents = self._convert_search_response(response.results)
+        self._cache_documents(query, documents)
+
+        return documents
+
+    def get_relevant_documents_for_queries(self, queries: List[str]) -> List[Document]:
+        """Search several queries concurrently (e.g. a question and its rephrased variants).
+
+        The snippets of all queries are merged, dropping duplicates of the same document page, so the
+        total latency is that of the slowest query rather than the sum of all of them.
+        """
+        with ThreadPoolExecutor(max_workers=max(len(queries), 1)) as executor:
+            results = list(executor.map(self.get_relevant_documents, queries))
+
+        return _merge_documents(results)
+
+    async def aget_relevant_documents_for_queries(self, queries: List[str]) -> List[Document]:
+        """Search several queries concurrently, see `get_relevant_documents_for_queries`."""
+        results = await asyncio.gather(
+            *(self.aget_relevant_documents(query) for query in queries)
+        )
+
+        return _merge_documents(results)
+
+
+def _merge_documents(results: List[List[Document]]) -> List[Document]:
+    """Merges the documents of several searches, keeping the first snippet of each document page."""
+    documents = {}
+    for result in results:
+        for document in result:
+            # The source identifies the page within the document: "{link}:{pageNumber}"
+            key = (document.metadata["id"], document.metadata["source"])
+            documents.setdefault(key, document)
+
+    return list(documents.values())
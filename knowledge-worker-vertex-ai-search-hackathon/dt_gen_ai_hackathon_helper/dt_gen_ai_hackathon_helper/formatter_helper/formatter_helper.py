@@ -1,9 +1,5 @@
-from langchain.document_loaders.xorbits import XorbitsLoader
 from typing import Any, Dict
 
-from IPython.display import HTML
-import pandas as pd
-
 
 def gsutil_uri_to_gcs_url(gsutil_uri: str) -> str:
     """Converts a gsutil URI to a GCS URL.
@@ -25,6 +21,9 @@ def format_results(results: Dict, print_source=False, return_html=True) -> Any:
     Returns:
         None
     """
+    # pandas and IPython are only imported once results are formatted, they make importing the helper slow
+    import pandas as pd
+
     sep = "*" * 79
     docs = results['source_documents']
     # Display settings for columns
@@ -52,6 +51,8 @@ def format_results(results: Dict, print_source=False, return_html=True) -> Any:
             print(doc.page_content)
     
     if return_html:
+        from IPython.display import HTML
+
         return HTML(df.to_html(render_links=True, escape=False))
 
     return df
@@ -0,0 +1,120 @@
+"""Token-budgeted chat history for conversational Q&A chains."""
+import hashlib
+import json
+import threading
+from collections import OrderedDict
+from typing import Callable, Iterable, List, Optional, Tuple
+
+from langchain.prompts import PromptTemplate
+
+SUMMARY_PROMPT = PromptTemplate.from_template(
+    """\
+Progressively summarize the conversation below, adding onto the previous summary.
+Keep the facts, names and numbers the user may refer back to.
+
+Previous summary:
+{summary}
+
+New lines of conversation:
+{conversation}
+
+New summary:"""
+)
+
+# Stands in for the question of the turn holding the summary of the older turns
+SUMMARY_TURN_QUESTION = "Summarize our conversation so far."
+
+
+def approximate_token_count(text: str) -> int:
+    """A cheap token estimate (about four characters per token)."""
+    return len(text) // 4 + 1
+
+
+class ChatHistoryManager:
+    """Keeps the chat history passed to a conversational chain within a token budget.
+
+    The last `keep_last_turns` turns are kept verbatim. When the history exceeds `token_budget`, older turns are
+    folded into a rolling summary, which is cached per session so each turn is only summarized once.
+
+    Arguments:
+        llm (BaseLanguageModel): The model used to summarize the older turns.
+        token_budget (int): The maximum (estimated) number of tokens of the compacted history.
+        keep_last_turns (int): The number of most recent turns always kept verbatim (budget permitting).
+        token_counter (callable): Estimates the number of tokens of a text.
+        max_sessions (int): The number of session summaries kept in memory.
+    """
+
+    def __init__(
+        self,
+        llm,
+        token_budget: int = 1000,
+        keep_last_turns: int = 3,
+        token_counter: Callable[[str], int] = approximate_token_count,
+        max_sessions: int = 1000,
+    ):
+        self.llm = llm
+        self.token_budget = token_budget
+        self.keep_last_turns = keep_last_turns
+        self.token_counter = token_counter
+        self.max_sessions = max_sessions
+        self._summaries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def compact(self, chat_history: Iterable, session_id: Optional[str] = None) -> List[Tuple[str, str]]:
+        """Return the chat history to pass to the chain, within the token budget.
+
+        An empty history stays empty, so the chain skips condensing the question.
+        """
+        turns = [tuple(turn) for turn in chat_history]
+        if self._count_tokens(turns) <= self.token_budget:
+            return turns
+
+        split = max(len(turns) - self.keep_last_turns, 0)
+        older, recent = turns[:split], turns[split:]
+        compacted = [(SUMMARY_TURN_QUESTION, self._summarize(older, session_id))] + recent if older else recent
+
+        # Still over budget: drop the oldest verbatim turns, the summary covers the gist of the conversation
+        while len(compacted) > 1 and self._count_tokens(compacted) > self.token_budget:
+            compacted.pop(1 if older else 0)
+
+        return compacted
+
+    def _summarize(self, older: List[Tuple[str, str]], session_id: Optional[str]) -> str:
+        # Without a session id, the first turn identifies the conversation
+        key = session_id or _fingerprint(older[:1])
+
+        with self._lock:
+            cached = self._summaries.get(key)
+            if cached is not None:
+                self._summaries.move_to_end(key)
+
+        # Only the turns which weren't folded into the cached summary yet are summarized
+        summary, folded = "", 0
+        if cached is not None:
+            cached_folded, cached_fingerprint, cached_summary = cached
+            if cached_folded <= len(older) and _fingerprint(older[:cached_folded]) == cached_fingerprint:
+                summary, folded = cached_summary, cached_folded
+
+        if folded < len(older):
+            conversation = "\n".join(
+                f"Human: {question}\nAssistant: {answer}" for question, answer in older[folded:]
+            )
+            summary = self.llm.predict(
+                SUMMARY_PROMPT.format(summary=summary or "(none)", conversation=conversation)
+            ).strip()
+
+            with self._lock:
+                self._summaries[key] = (len(older), _fingerprint(older), summary)
+                self._summaries.move_to_end(key)
+                # Evict the least recently active sessions
+                while len(self._summaries) > self.max_sessions:
+                    self._summaries.popitem(last=False)
+
+        return summary
+
+    def _count_tokens(self, turns: List[Tuple[str, str]]) -> int:
+        return sum(self.token_counter(question) + self.token_counter(answer) for question, answer in turns)
+
+
+def _fingerprint(turns):
+    return hashlib.sha256(json.dumps(turns).encode("utf-8")).hexdigest()
@@ -1,3 +1,4 @@
+import threading
 import time
 
 
@@ -14,3 +15,27 @@ def rate_limit(max_per_minute):
         if sleep_time > 0:
             print(".", end="")
             time.sleep(sleep_time)
+
+
+class RateLimiter:
+    """Thread-safe rate limiter, spacing requests evenly so at most `max_per_minute` start per minute.
+
+    Unlike `rate_limit`, it can be shared by several threads with requests in flight at the same time.
+    """
+
+    def __init__(self, max_per_minute):
+        self.period = 60 / max_per_minute
+        self._lock = threading.Lock()
+        self._next_slot = time.monotonic()
+
+    def acquire(self):
+        """Block until the next request may start, and return the time spent waiting in seconds."""
+        with self._lock:
+            now = time.monotonic()
+            slot = max(now, self._next_slot)
+            self._next_slot = slot + self.period
+
+        wait = slot - now
+        if wait > 0:
+            time.sleep(wait)
+        return wait
@@ -0,0 +1,377 @@
+"""Memory-mapped, NumPy-backed vector store with an append-only segment format."""
+import json
+import os
+import shutil
+import threading
+import uuid
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+import numpy as np
+from langchain.docstore.document import Document
+from langchain.embeddings.base import Embeddings
+from langchain.vectorstores.base import VectorStore
+
+MANIFEST_FILE = "segments.json"
+# Rows scored at once, which bounds the temporary memory of a search over a float16 matrix
+SEARCH_BLOCK_ROWS = 65536
+
+
+class _Segment:
+    """An immutable batch of rows: vectors, texts, ids and metadata columns, as written by one add.
+
+    Vectors and texts are memory-mapped read-only, so every process opening the store shares them through the page
+    cache. Ids and metadata are only read when a search returns rows of the segment, or rows are deleted.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.vectors = np.load(os.path.join(path, "vectors.npy"), mmap_mode="r")
+        self.offsets = np.load(os.path.join(path, "offsets.npy"))
+        # Rows not deleted (tombstoned) since the segment was written
+        self.alive = np.ones(len(self.vectors), dtype=bool)
+        self._texts = None
+        self._ids = None
+        self._metadata = None
+
+    @property
+    def ids(self) -> List[str]:
+        if self._ids is None:
+            with open(os.path.join(self.path, "ids.json")) as f:
+                self._ids = json.load(f)
+        return self._ids
+
+    def text(self, row: int) -> str:
+        if self._texts is None:
+            # An empty file can't be memory-mapped
+            size = os.path.getsize(os.path.join(self.path, "texts.bin"))
+            self._texts = np.memmap(os.path.join(self.path, "texts.bin"), dtype=np.uint8, mode="r") if size else b""
+        return bytes(self._texts[self.offsets[row]:self.offsets[row + 1]]).decode("utf-8")
+
+    def metadata(self, row: int) -> Dict[str, Any]:
+        if self._metadata is None:
+            with open(os.path.join(self.path, "metadata.json")) as f:
+                self._metadata = json.load(f)
+        # Columns only hold the keys set on some row of the segment, missing values are None
+        return {key: column[row] for key, column in self._metadata.items() if column[row] is not None}
+
+    def deleted_rows(self) -> List[int]:
+        return np.flatnonzero(~self.alive).tolist()
+
+    def top_k(self, query: np.ndarray, k: int) -> Tuple[np.ndarray, np.ndarray]:
+        return self.top_k_many(query[np.newaxis], k)[0]
+
+    def top_k_many(self, queries: np.ndarray, k: int) -> List[Tuple[np.ndarray, np.ndarray]]:
+        # Each block of rows is read once, and scored against every query with one matrix product
+        rows, scores = [[] for _ in queries], [[] for _ in queries]
+        for start in range(0, len(self.vectors), SEARCH_BLOCK_ROWS):
+            block = queries @ np.asarray(self.vectors[start:start + SEARCH_BLOCK_ROWS], dtype=np.float32).T
+            block[:, ~self.alive[start:start + SEARCH_BLOCK_ROWS]] = -np.inf
+            for i, query_scores in enumerate(block):
+                best = _top_k_indices(query_scores, k)
+                rows[i].append(best + start)
+                scores[i].append(query_scores[best])
+
+        results = []
+        for query_rows, query_scores in zip(rows, scores):
+            query_rows, query_scores = np.concatenate(query_rows), np.concatenate(query_scores)
+            live = np.isfinite(query_scores)
+            results.append((query_rows[live], query_scores[live]))
+        return results
+
+    @staticmethod
+    def write(path: str, ids, vectors, texts, metadatas, dtype):
+        encoded = [text.encode("utf-8") for text in texts]
+        offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum([len(text) for text in encoded])
+
+        columns = {}
+        for row, metadata in enumerate(metadatas):
+            for key, value in (metadata or {}).items():
+                columns.setdefault(key, [None] * len(metadatas))[row] = value
+
+        # Written to a temporary directory first, so readers never see a partial segment.
+        # Leftovers of a write interrupted before its manifest was saved are discarded.
+        tmp_path = f"{path}.tmp"
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        shutil.rmtree(path, ignore_errors=True)
+        os.makedirs(tmp_path)
+        np.save(os.path.join(tmp_path, "vectors.npy"), _normalise(vectors).astype(dtype))
+        np.save(os.path.join(tmp_path, "offsets.npy"), offsets)
+        with open(os.path.join(tmp_path, "texts.bin"), "wb") as f:
+            f.write(b"".join(encoded))
+        with open(os.path.join(tmp_path, "ids.json"), "w") as f:
+            json.dump(list(ids), f)
+        with open(os.path.join(tmp_path, "metadata.json"), "w") as f:
+            json.dump(columns, f)
+        os.replace(tmp_path, path)
+
+
+class MmapVectorStore(VectorStore):
+    """A local vector store whose normalised embeddings live in memory-mapped NumPy files.
+
+    Every add writes a new immutable segment and deletes are recorded as tombstones in the manifest, so incremental
+    ingestion never rewrites existing files. Opening the store only reads the manifest and maps the segments, and a
+    search scores all rows with a matrix product and keeps the top k with `argpartition`.
+    Only one process should write to a store at a time, readers pick up its changes on their next search.
+
+    Arguments:
+        embedding_function (Embeddings): Embeds documents on add, and queries on search.
+        persist_directory (str): The directory holding the manifest and the segments.
+        dtype (str): The precision of the stored vectors, "float32" or "float16" (half the memory).
+    """
+
+    def __init__(self, embedding_function: Embeddings, persist_directory: str, dtype: str = "float32"):
+        self._embedding_function = embedding_function
+        self.persist_directory = persist_directory
+        self.dtype = dtype
+        self._lock = threading.RLock()
+        self._manifest_mtime = None
+        self._segments = []
+        self._version = 0
+        # Maps ids to their (segment, row), built on the first write
+        self._id_index = None
+        os.makedirs(persist_directory, exist_ok=True)
+        self._refresh()
+
+    @property
+    def embeddings(self) -> Optional[Embeddings]:
+        return self._embedding_function
+
+    @property
+    def corpus_version(self) -> str:
+        """Changes whenever rows are added or deleted."""
+        self._refresh()
+        return str(self._version)
+
+    def count(self) -> int:
+        self._refresh()
+        return int(sum(segment.alive.sum() for segment in self._segments))
+
+    def add_texts(
+        self, texts: Iterable[str], metadatas: Optional[List[dict]] = None, ids: Optional[List[str]] = None, **kwargs
+    ) -> List[str]:
+        texts = list(texts)
+        embeddings = self._embedding_function.embed_documents(texts) if texts else []
+        return self.add_embeddings(texts, embeddings, metadatas=metadatas, ids=ids)
+
+    def add_embeddings(
+        self,
+        texts: List[str],
+        embeddings: List[List[float]],
+        metadatas: Optional[List[dict]] = None,
+        ids: Optional[List[str]] = None,
+    ) -> List[str]:
+        """Add texts with precomputed embeddings as a new segment."""
+        ids = list(ids) if ids is not None else [str(uuid.uuid4()) for _ in texts]
+        if not ids:
+            return ids
+
+        with self._lock:
+            self._refresh()
+            # Re-adding an id replaces its previous row
+            self._tombstone(set(ids))
+            name = f"segment-{self._version + 1:06d}"
+            _Segment.write(
+                os.path.join(self.persist_directory, name),
+                ids,
+                np.asarray(embeddings, dtype=np.float32),
+                texts,
+                metadatas or [{}] * len(texts),
+                self.dtype,
+            )
+            segment = _Segment(os.path.join(self.persist_directory, name))
+            self._segments.append(segment)
+            for row, row_id in enumerate(ids):
+                self._id_index[row_id] = (segment, row)
+            self._save_manifest()
+
+        return ids
+
+    def delete(self, ids: Optional[List[str]] = None, **kwargs):
+        """Delete rows by id, or every row when no ids are given."""
+        with self._lock:
+            self._refresh()
+            if ids is None:
+                for segment in self._segments:
+                    segment.alive[:] = False
+                self._id_index = {}
+            else:
+                self._tombstone(set(ids))
+            self._save_manifest()
+
+    def persist(self):
+        # Segments and the manifest are written durably on every add or delete
+        pass
+
+    def compact(self):
+        """Rewrite the live rows into a single segment, dropping the tombstoned rows and merging small segments."""
+        with self._lock:
+            self._refresh()
+            ids, vectors, texts, metadatas = [], [], [], []
+            for segment in self._segments:
+                for row in np.flatnonzero(segment.alive):
+                    ids.append(segment.ids[row])
+                    vectors.append(np.asarray(segment.vectors[row], dtype=np.float32))
+                    texts.append(segment.text(row))
+                    metadatas.append(segment.metadata(row))
+
+            stale_segments = self._segments
+            self._segments = []
+            self._id_index = None
+            if ids:
+                name = f"segment-{self._version + 1:06d}"
+                _Segment.write(
+                    os.path.join(self.persist_directory, name), ids, np.stack(vectors), texts, metadatas, self.dtype
+                )
+                self._segments.append(_Segment(os.path.join(self.persist_directory, name)))
+            self._save_manifest()
+
+            # Readers still mapping the old files keep them alive until they refresh (on POSIX)
+            for segment in stale_segments:
+                shutil.rmtree(segment.path, ignore_errors=True)
+
+    def similarity_search(self, query: str, k: int = 4, **kwargs: Any) -> List[Document]:
+        return [document for document, _ in self.similarity_search_with_score(query, k=k, **kwargs)]
+
+    def similarity_search_with_score(self, query: str, k: int = 4, **kwargs: Any) -> List[Tuple[Document, float]]:
+        return self.similarity_search_by_vector_with_score(self._embedding_function.embed_query(query), k=k)
+
+    def similarity_search_by_vector(self, embedding: List[float], k: int = 4, **kwargs: Any) -> List[Document]:
+        return [document for document, _ in self.similarity_search_by_vector_with_score(embedding, k=k)]
+
+    def similarity_search_by_vector_with_score(
+        self, embedding: List[float], k: int = 4
+    ) -> List[Tuple[Document, float]]:
+        """Return the k documents with the highest cosine similarity to an embedding, with their similarity."""
+        self._refresh()
+        return [
+            (Document(page_content=segment.text(row), metadata=segment.metadata(row)), score)
+            for score, segment, row in self._top_k(embedding, k)
+        ]
+
+    def similarity_search_by_vector_with_embeddings(
+        self, embedding: List[float], k: int = 4
+    ) -> List[Tuple[Document, List[float]]]:
+        """Return the k documents closest to an embedding, with their (normalised) stored embeddings."""
+        return self.similarity_search_by_vectors_with_embeddings([embedding], k=k)[0]
+
+    def similarity_search_by_vectors_with_embeddings(
+        self, embeddings: List[List[float]], k: int = 4
+    ) -> List[List[Tuple[Document, List[float]]]]:
+        """Search the k documents closest to each of many embeddings at once, reading the vectors only once."""
+        self._refresh()
+        return [
+            [
+                (
+                    Document(page_content=segment.text(row), metadata=segment.metadata(row)),
+                    segment.vectors[row].tolist(),
+                )
+                for _, segment, row in candidates
+            ]
+            for candidates in self._top_k_many(embeddings, k)
+        ]
+
+    def _similarity_search_with_relevance_scores(
+        self, query: str, k: int = 4, **kwargs: Any
+    ) -> List[Tuple[Document, float]]:
+        # Cosine similarity in [-1, 1], rescaled to a relevance in [0, 1]
+        return [(document, (score + 1) / 2) for document, score in self.similarity_search_with_score(query, k=k)]
+
+    @classmethod
+    def from_texts(
+        cls,
+        texts: List[str],
+        embedding: Embeddings,
+        metadatas: Optional[List[dict]] = None,
+        ids: Optional[List[str]] = None,
+        persist_directory: str = "mmap_store",
+        dtype: str = "float32",
+        **kwargs: Any,
+    ) -> "MmapVectorStore":
+        vector_store = cls(embedding_function=embedding, persist_directory=persist_directory, dtype=dtype)
+        vector_store.add_texts(texts, metadatas=metadatas, ids=ids)
+        return vector_store
+
+    def _top_k(self, embedding, k):
+        return self._top_k_many([embedding], k)[0]
+
+    def _top_k_many(self, embeddings, k):
+        queries = _normalise(np.asarray(embeddings, dtype=np.float32))
+
+        # The top k of every segment, then the top k of those, for each query
+        candidates = [[] for _ in queries]
+        for segment in self._segments:
+            for query_candidates, (rows, scores) in zip(candidates, segment.top_k_many(queries, k)):
+                query_candidates.extend(zip(scores.tolist(), [segment] * len(rows), rows.tolist()))
+        for query_candidates in candidates:
+            query_candidates.sort(key=lambda candidate: candidate[0], reverse=True)
+        return [query_candidates[:k] for query_candidates in candidates]
+
+    def _tombstone(self, ids):
+        if self._id_index is None:
+            self._id_index = {}
+            for segment in self._segments:
+                for row in np.flatnonzero(segment.alive).tolist():
+                    self._id_index[segment.ids[row]] = (segment, row)
+
+        for row_id in ids:
+            entry = self._id_index.pop(row_id, None)
+            if entry is not None:
+                segment, row = entry
+                segment.alive[row] = False
+
+    def _refresh(self):
+        # Picks up segments and tombstones written by another process, for the cost of a stat per search
+        path = os.path.join(self.persist_directory, MANIFEST_FILE)
+        try:
+            mtime = os.stat(path).st_mtime_ns
+        except FileNotFoundError:
+            return
+        if mtime == self._manifest_mtime:
+            return
+
+        with self._lock:
+            with open(path) as f:
+                manifest = json.load(f)
+            segments = {segment.path: segment for segment in self._segments}
+            self._segments = []
+            for entry in manifest["segments"]:
+                segment_path = os.path.join(self.persist_directory, entry["name"])
+                segment = segments.get(segment_path) or _Segment(segment_path)
+                segment.alive[:] = True
+                segment.alive[entry["deleted"]] = False
+                self._segments.append(segment)
+            self._version = manifest["version"]
+            self._id_index = None
+            self.dtype = manifest.get("dtype", self.dtype)
+            self._manifest_mtime = mtime
+
+    def _save_manifest(self):
+        self._version += 1
+        manifest = {
+            "version": self._version,
+            "dtype": self.dtype,
+            "segments": [
+                {"name": os.path.basename(segment.path), "deleted": segment.deleted_rows()}
+                for segment in self._segments
+            ],
+        }
+        path = os.path.join(self.persist_directory, MANIFEST_FILE)
+        with open(f"{path}.tmp", "w") as f:
+            json.dump(manifest, f)
+        os.replace(f"{path}.tmp", path)
+        self._manifest_mtime = os.stat(path).st_mtime_ns
+
+
+def _normalise(vectors):
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    return vectors / np.where(norms == 0, 1.0, norms)
+
+
+def _top_k_indices(scores, k):
+    # argpartition finds the top k in linear time, only those k are sorted
+    if k < len(scores):
+        best = np.argpartition(-scores, k)[:k]
+    else:
+        best = np.arange(len(scores))
+    return best[np.argsort(-scores[best])]
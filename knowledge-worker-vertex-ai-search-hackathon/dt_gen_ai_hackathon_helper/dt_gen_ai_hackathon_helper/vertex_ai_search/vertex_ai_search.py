@@ -1,17 +1,21 @@
-import http.client
+import asyncio
+import functools
 import json
 import logging
-import subprocess
-from typing import Optional
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional, Tuple
 
 import requests
 from google.api_core.client_options import ClientOptions
-from google.cloud import discoveryengine
+from google.cloud import discoveryengine, storage
+
+from dt_gen_ai_hackathon_helper.auth.auth import get_token_provider
 
 logging.basicConfig(level=logging.INFO)
 
 
-def create_data_store(project_id: str, data_store_id: str, display_name: str):
+def create_data_store(project_id: str, data_store_id: str, display_name: str) -> bool:
     """
     Create a data store in the default collection of the project.
     Args:
@@ -19,7 +23,7 @@ def create_data_store(project_id: str, data_store_id: str, display_name: str):
         data_store_id: The ID of the data store to create.
         display_name: The display name of the data store to create.
     Returns:
-        None
+        Whether the data store was created.
     e.g.:
     from dt_gen_ai_hackathon_helper.vertex_ai_search import vertex_ai_search
 
@@ -29,17 +33,11 @@ def create_data_store(project_id: str, data_store_id: str, display_name: str):
 
     vertex_ai_search.create_data_store(PROJECT_ID, data_store_name + "_" + hackathon_team_name, display_name)
     """
-    # Get the access token from gcloud
-    process = subprocess.Popen(["gcloud", "auth", "print-access-token"], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    out, err = process.communicate()
-    access_token = out.decode('utf-8').strip()
+    # Get the (cached) access token of the default credentials
+    token_provider = get_token_provider()
 
     # Define headers and payload
-    headers = {
-        "Authorization": f"Bearer {access_token}",
-        "X-Goog-User-Project": project_id,
-        "Content-Type": "application/json"
-    }
+    headers = token_provider.headers(project_id)
 
     payload = {
         "displayName": display_name,
@@ -53,14 +51,36 @@ def create_data_store(project_id: str, data_store_id: str, display_name: str):
     parent = f"projects/{project_id}/locations/global/collections/default_collection"
     url = f"https://discoveryengine.googleapis.com/v1alpha/{parent}/dataStores/{data_store_id}"
     # Make the request
-    response = requests.post(url, headers=headers, json=payload)
+    response = token_provider.session.post(url, headers=headers, json=payload)
 
     if response.status_code == 200 or response.status_code == 201:
         logging.info("Data store created successfully.")
         logging.info(json.dumps(response.json(), indent=4))
+        return True
     else:
         logging.error(f"Failed to create data store. Status code: {response.status_code}")
         logging.error(response.text)
+        return False
+
+
+def create_data_stores(project_id: str, data_stores: List[Tuple[str, str]], max_workers: int = 8) -> Dict[str, bool]:
+    """
+    Create many data stores concurrently, sharing one access token and connection pool.
+    Args:
+        project_id: The project ID of the project to create the data stores in.
+        data_stores: The (data store ID, display name) of each data store to create.
+        max_workers: The maximum number of concurrent requests.
+    Returns:
+        Whether each data store was created, by data store ID.
+    e.g.:
+    teams = ["team_1", "team_2", "team_3"]
+    vertex_ai_search.create_data_stores(PROJECT_ID, [(f"alphabet_investor_pdfs_{team}", team) for team in teams])
+    """
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        created = executor.map(
+            lambda data_store: create_data_store(project_id, *data_store), data_stores
+        )
+        return dict(zip([data_store_id for data_store_id, _ in data_stores], created))
 
 
 def ingest_documents(
@@ -85,16 +105,8 @@ def ingest_documents(
     Returns:
         The operation name of the import documents operation.
     """
-    #  For more information, refer to:
-    # https://cloud.google.com/generative-ai-app-builder/docs/locations#specify_a_multi-region_for_your_data_store
-    client_options = (
-        ClientOptions(api_endpoint=f"{location}-discoveryengine.googleapis.com")
-        if location != "global"
-        else None
-    )
-
-    # Create a client
-    client = discoveryengine.DocumentServiceClient(client_options=client_options)
+    # Reuse the client of this location
+    client = _document_service_client(location)
 
     # The full resource name of the search engine branch.
     # e.g. projects/{project}/locations/{location}/dataStores/{data_store_id}/branches/{branch}
@@ -143,7 +155,140 @@ def ingest_documents(
     return operation.operation.name
 
 
-def create_search_ai_app(project_id: str, display_name: str, data_store_id: str, solution_type_search: str):
+@functools.lru_cache(maxsize=None)
+def _document_service_client(location: str) -> discoveryengine.DocumentServiceClient:
+    #  For more information, refer to:
+    # https://cloud.google.com/generative-ai-app-builder/docs/locations#specify_a_multi-region_for_your_data_store
+    client_options = (
+        ClientOptions(api_endpoint=f"{location}-discoveryengine.googleapis.com")
+        if location != "global"
+        else None
+    )
+
+    # Creating a client sets up credentials and a gRPC channel, so it's done once per location
+    return discoveryengine.DocumentServiceClient(client_options=client_options)
+
+
+class ImportJob:
+    """
+    Handle on a set of concurrent document import operations, returned without waiting for them.
+    Poll it with done() and progress(), block on result(), or await it from async code.
+    """
+
+    def __init__(self, operations: list):
+        self.operations = operations
+
+    def done(self) -> bool:
+        """Whether every import operation has finished (refreshes the status of the unfinished ones)."""
+        return all(operation.done() for operation in self.operations)
+
+    def progress(self) -> Dict[str, int]:
+        """Sum the success and failure counts reported in the ImportDocumentsMetadata of the operations."""
+        progress = {"operations": len(self.operations), "done": 0, "success_count": 0, "failure_count": 0}
+        for operation in self.operations:
+            progress["done"] += operation.done()
+            if operation.metadata is not None:
+                metadata = discoveryengine.ImportDocumentsMetadata(operation.metadata)
+                progress["success_count"] += metadata.success_count
+                progress["failure_count"] += metadata.failure_count
+        return progress
+
+    def result(self, poll_interval: float = 10, timeout: Optional[float] = None) -> list:
+        """
+        Wait for all import operations, logging the progress, and return their responses.
+        Args:
+            poll_interval: Seconds between two status checks of the operations.
+            timeout: The maximum number of seconds to wait.
+        Returns:
+            The ImportDocumentsResponse of each operation.
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            progress = self.progress()
+            logging.info(
+                f"Imported {progress['success_count']} documents ({progress['failure_count']} failed), "
+                f"{progress['done']}/{progress['operations']} imports done."
+            )
+            if progress["done"] == progress["operations"]:
+                break
+            if deadline is not None and time.monotonic() >= deadline:
+                raise TimeoutError(f"Document import did not complete within {timeout} seconds.")
+            time.sleep(poll_interval)
+
+        return [operation.result() for operation in self.operations]
+
+    def __await__(self):
+        # Poll on a worker thread, so awaiting the job doesn't block the event loop
+        return asyncio.get_running_loop().run_in_executor(None, self.result).__await__()
+
+
+def list_gcs_uris(gcs_prefix: str) -> List[str]:
+    """
+    List the objects under a GCS prefix.
+    Args:
+        gcs_prefix: The prefix to list, e.g. "gs://bucket-name/folder/".
+    Returns:
+        The gsutil URI of every object under the prefix.
+    """
+    bucket_name, _, prefix = gcs_prefix.replace("gs://", "", 1).partition("/")
+    blobs = storage.Client().list_blobs(bucket_name, prefix=prefix)
+    return [f"gs://{bucket_name}/{blob.name}" for blob in blobs if not blob.name.endswith("/")]
+
+
+def ingest_documents_sharded(
+        project_id: str,
+        location: str,
+        data_store_id: str,
+        gcs_prefix: str,
+        uris_per_import: int = 100,
+        max_workers: int = 8,
+        data_schema: str = "content",
+) -> ImportJob:
+    """
+    Ingest all documents under a GCS prefix into a data store, as concurrent import operations.
+    Args:
+        project_id: The project ID of the project to import documents into.
+        location: The location of the data store to import documents into.
+        data_store_id: The ID of the data store to import documents into.
+        gcs_prefix: The GCS prefix of the documents to import, e.g. "gs://bucket-name/folder/".
+        uris_per_import: The number of documents (GCS URIs) per import operation.
+        max_workers: The maximum number of import requests submitted at once.
+        data_schema: The data schema of the documents to import.
+    Returns:
+        An ImportJob, without waiting for the imports to complete.
+    e.g.:
+    job = vertex_ai_search.ingest_documents_sharded(PROJECT_ID, "global", data_store_id, "gs://bucket-name/pdfs/")
+    job.result()  # or `await job`
+    """
+    client = _document_service_client(location)
+    parent = client.branch_path(
+        project=project_id,
+        location=location,
+        data_store=data_store_id,
+        branch="default_branch",
+    )
+
+    uris = list_gcs_uris(gcs_prefix)
+    shards = [uris[start:start + uris_per_import] for start in range(0, len(uris), uris_per_import)]
+    logging.info(f"Importing {len(uris)} documents from {gcs_prefix} in {len(shards)} operations.")
+
+    def submit(shard):
+        request = discoveryengine.ImportDocumentsRequest(
+            parent=parent,
+            gcs_source=discoveryengine.GcsSource(input_uris=shard, data_schema=data_schema),
+            # Options: `FULL`, `INCREMENTAL`
+            reconciliation_mode=discoveryengine.ImportDocumentsRequest.ReconciliationMode.INCREMENTAL,
+        )
+        # Returns the long-running operation as soon as the import is accepted
+        return client.import_documents(request=request)
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        operations = list(executor.map(submit, shards))
+
+    return ImportJob(operations)
+
+
+def create_search_ai_app(project_id: str, display_name: str, data_store_id: str, solution_type_search: str) -> bool:
     """
     Create a search AI app.
     Args:
@@ -152,7 +297,7 @@ def create_search_ai_app(project_id: str, display_name: str, data_store_id: str,
         data_store_id: The ID of the data store to create the search AI app in.
         solution_type_search: The solution type of the search AI app to create.
     Returns:
-        None
+        Whether the search AI app was created.
     e.g.:
     from dt_gen_ai_hackathon_helper.vertex_ai_search import vertex_ai_search
 
@@ -161,17 +306,11 @@ def create_search_ai_app(project_id: str, display_name: str, data_store_id: str,
 
     vertex_ai_search.create_search_ai_app(PROJECT_ID, display_name, data_store_id, solution_type_search)
     """
-    # Get the access token from gcloud
-    process = subprocess.Popen(["gcloud", "auth", "print-access-token"], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    out, err = process.communicate()
-    access_token = out.decode('utf-8').strip()
+    # Get the (cached) access token of the default credentials
+    token_provider = get_token_provider()
 
     # Define headers and payload
-    headers = {
-        "Authorization": f"Bearer {access_token}",
-        "Content-Type": "application/json",
-        "X-Goog-User-Project": project_id,
-    }
+    headers = token_provider.headers(project_id)
 
     payload = {
         "displayName": display_name,
@@ -182,10 +321,35 @@ def create_search_ai_app(project_id: str, display_name: str, data_store_id: str,
     url = f"https://discoveryengine.googleapis.com/v1alpha/projects/{project_id}/locations/global/collections/default_collection/engines?engineId={data_store_id}"
 
     try:
-        response = requests.post(url, headers=headers, json=payload)
+        response = token_provider.session.post(url, headers=headers, json=payload)
         response.raise_for_status()  # Raises HTTPError for bad responses (4xx and 5xx)
         logging.info(f"Success: {response.json()}")
+        return True
     except requests.HTTPError as http_err:
         logging.error(f"HTTP error occurred: {http_err}")
     except Exception as err:
         logging.error(f"An error occurred: {err}")
+    return False
+
+
+def create_search_ai_apps(
+        project_id: str,
+        apps: List[Tuple[str, str]],
+        solution_type_search: str = "SOLUTION_TYPE_SEARCH",
+        max_workers: int = 8,
+) -> Dict[str, bool]:
+    """
+    Create many search AI apps concurrently, sharing one access token and connection pool.
+    Args:
+        project_id: The project ID of the project to create the search AI apps in.
+        apps: The (display name, data store ID) of each search AI app to create.
+        solution_type_search: The solution type of the search AI apps to create.
+        max_workers: The maximum number of concurrent requests.
+    Returns:
+        Whether the search AI app of each data store was created, by data store ID.
+    """
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        created = executor.map(
+            lambda app: create_search_ai_app(project_id, app[0], app[1], solution_type_search), apps
+        )
+        return dict(zip([data_store_id for _, data_store_id in apps], created))
@@ -1,13 +1,13 @@
 import gradio as gr
 from langchain.prompts import PromptTemplate
 
-from dt_gen_ai_hackathon_helper.chains.chains import create_qa_chain
+from dt_gen_ai_hackathon_helper.chains.chains import create_qa_chain, stream_qa_chain
 from dt_gen_ai_hackathon_helper.formatter_helper.formatter_helper import gsutil_uri_to_gcs_url
 from dt_gen_ai_hackathon_helper.prompts.prompts import TASK_01_PROMPT
 
 
 class View:
-    def __init__(self, qa_chain=None, vector_store=None):
+    def __init__(self, qa_chain=None, vector_store=None, history_manager=None):
         if vector_store:
             condense_question_prompt = PromptTemplate.from_template(TASK_01_PROMPT)
             self.qa_chain = create_qa_chain(vector_store, condense_question_prompt)
@@ -16,9 +16,12 @@ class View:
         else:
             raise Exception("Must pass either qa_chain or vector_store as argument.")
 
+        # Optional ChatHistoryManager keeping long conversations within a token budget
+        self.history_manager = history_manager
+
     def q_a(self, question: str, history: list):
         # map history (list of lists) to expected format of chat_history (list of tuples)
-        chat_history = map(tuple, history)
+        chat_history = self.compact_history(history)
 
         # Query the LLM to get a response
         # First the Q&A chain will collect documents semantically similar to the question
@@ -31,6 +34,17 @@ class View:
             }
         )
 
+        # Return the LLM answer, and list of sources used (formatted as a string)
+        return response["answer"], self.format_sources(response["source_documents"])
+
+    def compact_history(self, history):
+        # Older turns are folded into a summary once the conversation exceeds the token budget
+        chat_history = [tuple(turn) for turn in history]
+        if self.history_manager:
+            chat_history = self.history_manager.compact(chat_history)
+        return chat_history
+
+    def format_sources(self, source_documents):
         # Format source documents (sources of excerpts passed to the LLM) into links the user can validate
         # Strip index.html so URLs terminate in the parent folder
         # Strip https:// and http:// and replace with https:// to enforce https protocol and catch cases where
@@ -38,17 +52,16 @@ class View:
         source_gcs_urls = [
             gsutil_uri_to_gcs_url(doc.metadata['source']) if doc.metadata['source'].startswith("gs://")
             else f"https://{doc.metadata['source'].replace('index.html', '').replace('https://', '').replace('http://', '')}"
-            for doc in response["source_documents"]
+            for doc in source_documents
         ]
-        # Return the LLM answer, and list of sources used (formatted as a string)
-        return response["answer"], "\n\n".join(source_gcs_urls)
+        return "\n\n".join(source_gcs_urls)
 
     def submit(self, msg, chatbot):
         # First create a new entry in the conversation log
         msg, chatbot = self.user(msg, chatbot)
-        # Then get the chatbot response to the user question
-        chatbot = self.bot(chatbot)
-        return msg, chatbot
+        # Then stream the chatbot response to the user question, repainting as it arrives
+        for chatbot in self.bot(chatbot):
+            yield msg, chatbot
 
     def user(self, user_message, history):
         # Return "" to clear the user input, and add the user question to the conversation history
@@ -57,16 +70,26 @@ class View:
     def bot(self, history):
         # Get the user question from conversation history
         user_message = history[-1][0]
-        # Get the response and sources used to answer the user question
-        bot_message, bot_sources = self.q_a(user_message, history[:-1])
+        # map history (list of lists) to expected format of chat_history (list of tuples)
+        chat_history = self.compact_history(history[:-1])
 
         # Using a template, format the response and sources together
         bot_template = (
             "{0}\n\n<details><summary><b>Sources</b></summary>\n\n{1}</details>"
         )
-        # Place the response into the conversation history and return
-        history[-1][1] = bot_template.format(bot_message, bot_sources)
-        return history
+        bot_message, bot_sources = "", ""
+
+        # The sources used to answer the user question arrive first, then the answer as it is generated
+        for event, data in stream_qa_chain(self.qa_chain, user_message, chat_history):
+            if event == "sources":
+                bot_sources = self.format_sources(data)
+            elif event == "token":
+                bot_message += data
+            else:
+                continue
+            # Place the partial response into the conversation history and repaint
+            history[-1][1] = bot_template.format(bot_message, bot_sources)
+            yield history
 
     def launch_interface(self, share=True, debug=True):
         # Build a simple GradIO app that accepts user input and queries the LLM
@@ -88,8 +111,9 @@ class View:
                 clear = gr.Button(value="Clear History", variant="secondary", size="sm")
 
             # Submit message on <enter> or clicking "Send" button
-            msg.submit(self.submit, [msg, chatbot], [msg, chatbot], queue=False)
-            send.click(self.submit, [msg, chatbot], [msg, chatbot], queue=False)
+            # The response is streamed by a generator, which requires the queue
+            msg.submit(self.submit, [msg, chatbot], [msg, chatbot])
+            send.click(self.submit, [msg, chatbot], [msg, chatbot])
 
             # Clear chatbot history on clicking "Clear History" button
             clear.click(lambda: None, None, chatbot, queue=False)
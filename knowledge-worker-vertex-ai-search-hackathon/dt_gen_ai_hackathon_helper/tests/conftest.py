@@ -0,0 +1,5 @@
+import os
+import sys
+
+# The benchmarks' fakes of the Vertex AI and Discovery Engine clients
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir, os.pardir, os.pardir, "benchmarks"))
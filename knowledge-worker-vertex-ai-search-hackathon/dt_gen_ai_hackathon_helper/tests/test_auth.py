@@ -0,0 +1,58 @@
+import datetime
+
+import google.auth
+import pytest
+
+from dt_gen_ai_hackathon_helper.auth.auth import TokenProvider
+
+
+class FakeCredentials:
+    """Credentials whose refreshed tokens are valid for `lifetime`, counting the refreshes."""
+
+    def __init__(self, lifetime):
+        self.lifetime = lifetime
+        self.token = None
+        self.expiry = None
+        self.refreshes = 0
+
+    def refresh(self, request):
+        self.refreshes += 1
+        self.token = f"token-{self.refreshes}"
+        self.expiry = datetime.datetime.utcnow() + self.lifetime
+
+
+@pytest.fixture
+def token_provider(monkeypatch):
+    # A provider of the credentials `lifetime` returns, refreshed 5 minutes before they expire
+    providers = []
+
+    def create(lifetime):
+        credentials = FakeCredentials(lifetime)
+        monkeypatch.setattr(google.auth, "default", lambda scopes: (credentials, "project"))
+        providers.append(TokenProvider(refresh_margin_seconds=300))
+        return providers[-1]
+
+    yield create
+    for provider in providers:
+        provider.close()
+
+
+def test_schedules_the_refresh_before_the_token_expires(token_provider):
+    provider = token_provider(datetime.timedelta(hours=1))
+
+    assert provider.token() == "token-1"
+    assert provider.token() == "token-1"
+
+    assert provider.credentials.refreshes == 1
+    assert provider._timer.interval == pytest.approx(3300, abs=5)
+
+
+def test_doesnt_schedule_a_refresh_for_a_token_expiring_within_the_margin(token_provider):
+    provider = token_provider(datetime.timedelta(minutes=1))
+
+    assert provider.token() == "token-1"
+
+    # Refreshed on demand rather than by a timer firing right away, again and again
+    assert provider._timer is None
+    assert provider.credentials.refreshes == 1
+    assert provider.token() == "token-2"
@@ -0,0 +1,103 @@
+import random
+import threading
+import time
+
+import fakes
+import pytest
+from google.api_core import exceptions as google_exceptions
+
+from dt_gen_ai_hackathon_helper.embeddings.batch_engine import BatchEmbeddingEngine
+from dt_gen_ai_hackathon_helper.embeddings.embeddings import CustomVertexAIEmbeddings
+
+
+class FlakyBatches:
+    """Embeds each text as [len(text)], raising the queued errors first. Records the batches requested."""
+
+    def __init__(self, errors=(), latency=0.0):
+        self.errors = list(errors)
+        self.latency = latency
+        self.batches = []
+        self._lock = threading.Lock()
+
+    def __call__(self, batch):
+        with self._lock:
+            self.batches.append(list(batch))
+            error = self.errors.pop(0) if self.errors else None
+        if error is not None:
+            raise error
+        if self.latency:
+            # Batches complete in a random order
+            time.sleep(random.uniform(0, self.latency))
+        return [[float(len(text))] for text in batch]
+
+
+@pytest.fixture
+def no_backoff(monkeypatch):
+    sleeps = []
+    monkeypatch.setattr(time, "sleep", sleeps.append)
+    return sleeps
+
+
+def test_returns_the_embeddings_in_the_order_of_the_texts():
+    texts = ["x" * length for length in range(1, 41)]
+    embed_batch = FlakyBatches(latency=0.01)
+    engine = BatchEmbeddingEngine(embed_batch, max_instances_per_batch=3, max_concurrent_requests=4)
+
+    assert engine.embed(texts) == [[float(length)] for length in range(1, 41)]
+    assert len(embed_batch.batches) == 14
+
+
+def test_packs_batches_within_the_token_budget():
+    engine = BatchEmbeddingEngine(
+        FlakyBatches(), max_instances_per_batch=3, max_tokens_per_batch=10, token_counter=len
+    )
+    texts = ["aaaa", "bbbb", "cc", "d", "eeeeeeeeeeeeeeee", "f", "g", "h", "i"]
+
+    # A text over the budget gets a batch of its own, and batches hold at most 3 texts
+    assert list(engine.pack(texts)) == [range(0, 3), range(3, 4), range(4, 5), range(5, 8), range(8, 9)]
+
+
+def test_retries_transient_errors(no_backoff):
+    embed_batch = FlakyBatches(errors=[google_exceptions.ServiceUnavailable("overloaded")])
+    engine = BatchEmbeddingEngine(embed_batch, max_concurrent_requests=1, max_retries=3)
+
+    assert engine.embed(["a", "bb"]) == [[1.0], [2.0]]
+    assert len(embed_batch.batches) == 2
+    assert len(no_backoff) == 1
+
+
+def test_raises_other_errors_right_away(no_backoff):
+    embed_batch = FlakyBatches(errors=[google_exceptions.InvalidArgument("text too long")])
+    engine = BatchEmbeddingEngine(embed_batch, max_concurrent_requests=1, max_retries=3)
+
+    with pytest.raises(google_exceptions.InvalidArgument):
+        engine.embed(["a", "bb"])
+    assert len(embed_batch.batches) == 1
+    assert no_backoff == []
+
+
+def test_raises_transient_errors_once_out_of_retries(no_backoff):
+    errors = [google_exceptions.ResourceExhausted("quota")] * 3
+    embed_batch = FlakyBatches(errors=errors)
+    engine = BatchEmbeddingEngine(embed_batch, max_concurrent_requests=1, max_retries=2)
+
+    with pytest.raises(google_exceptions.ResourceExhausted):
+        engine.embed(["a"])
+    assert len(embed_batch.batches) == 3
+
+
+def test_the_rate_limit_spans_calls():
+    # construct() skips the validator, which would connect to Vertex AI to create the client
+    embeddings = CustomVertexAIEmbeddings.construct(
+        requests_per_minute=600,
+        num_instances_per_batch=5,
+        client=fakes.FakeTextEmbeddingModel(latency=0.0, dimensions=4),
+    )
+
+    started = time.monotonic()
+    for _ in range(3):
+        embeddings.embed_documents(["a", "b"])
+
+    # One request per call, 0.1s apart
+    assert time.monotonic() - started >= 0.2
+    assert embeddings.rate_limit_wait_seconds >= 0.19
@@ -0,0 +1,65 @@
+import fakes
+import numpy as np
+import pytest
+
+from dt_gen_ai_hackathon_helper.cache.embedding_cache import EmbeddingCache
+from dt_gen_ai_hackathon_helper.embeddings.embeddings import CustomVertexAIEmbeddings
+
+
+@pytest.fixture
+def cache_path(tmp_path):
+    return str(tmp_path / "embedding_cache.sqlite")
+
+
+def _embeddings(cache_path, **options):
+    # construct() skips the validator, which would connect to Vertex AI to create the client
+    return CustomVertexAIEmbeddings.construct(
+        requests_per_minute=600,
+        num_instances_per_batch=5,
+        client=fakes.FakeTextEmbeddingModel(latency=0.0, dimensions=8),
+        embedding_cache=EmbeddingCache(cache_path),
+        **options,
+    )
+
+
+def test_a_cached_text_is_embedded_without_a_request(cache_path):
+    embeddings = _embeddings(cache_path)
+    first = embeddings.embed_documents(["Alpha", "Beta"])
+
+    second = embeddings.embed_documents(["Beta", "Alpha", "Beta"])
+
+    np.testing.assert_allclose(second, [first[1], first[0], first[1]], atol=1e-6)
+    assert embeddings.client.requests == 1
+    assert (embeddings.embedding_cache.hits, embeddings.embedding_cache.misses) == (3, 2)
+
+
+def test_a_changed_text_is_embedded_again(cache_path):
+    embeddings = _embeddings(cache_path)
+    embeddings.embed_documents(["Alpha is the first letter."])
+
+    changed = embeddings.embed_documents(["Alpha is the first letter of the alphabet."])
+
+    expected = fakes.fake_embedding("Alpha is the first letter of the alphabet.", 8)
+    np.testing.assert_allclose(changed, [expected], atol=1e-6)
+    assert embeddings.client.requests == 2
+    assert embeddings.embedding_cache.misses == 2
+
+
+def test_the_cache_survives_a_restart(cache_path):
+    first = _embeddings(cache_path).embed_documents(["Alpha", "Beta"])
+
+    restarted = _embeddings(cache_path)
+    second = restarted.embed_documents(["Alpha", "Beta"])
+
+    np.testing.assert_allclose(second, first, atol=1e-6)
+    assert restarted.client.requests == 0
+    assert restarted.embedding_cache.hit_rate == 1.0
+
+
+def test_embeddings_of_another_model_arent_reused(cache_path):
+    _embeddings(cache_path).embed_documents(["Alpha"])
+
+    other_model = _embeddings(cache_path, model_name="textembedding-gecko-multilingual")
+    other_model.embed_documents(["Alpha"])
+
+    assert other_model.client.requests == 1
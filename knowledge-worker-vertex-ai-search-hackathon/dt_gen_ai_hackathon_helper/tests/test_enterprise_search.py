@@ -0,0 +1,123 @@
+import asyncio
+import functools
+from types import SimpleNamespace
+
+import fakes
+import pytest
+from google.cloud import discoveryengine_v1beta
+
+from dt_gen_ai_hackathon_helper.cache import ttl_cache
+from dt_gen_ai_hackathon_helper.enterprise_search.enterprise_search import EnterpriseSearchRetriever
+
+
+class PagedSearchServiceClient(fakes.FakeSearchServiceClient):
+    """Returns its results through a pager, like the real client, recording the results the caller iterated over."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.results_read = 0
+
+    def _response(self, request):
+        results = super()._response(request).results
+
+        def pager():
+            for result in results:
+                self.results_read += 1
+                yield result
+
+        return SimpleNamespace(results=pager())
+
+
+@pytest.fixture
+def clients(monkeypatch):
+    # The clients created by the retrievers, which search the fake Discovery Engine without latency
+    clients = []
+
+    def recorded(client_class, credentials=None):
+        client = client_class(credentials=credentials, latency=0.0, snippets=3, words=5)
+        clients.append(client)
+        return client
+
+    monkeypatch.setattr(
+        discoveryengine_v1beta, "SearchServiceClient", functools.partial(recorded, PagedSearchServiceClient)
+    )
+    monkeypatch.setattr(
+        discoveryengine_v1beta,
+        "SearchServiceAsyncClient",
+        functools.partial(recorded, fakes.FakeSearchServiceAsyncClient),
+    )
+    return clients
+
+
+def _retriever(**options):
+    return EnterpriseSearchRetriever(project_id="project", search_engine_id="engine", location_id="global", **options)
+
+
+def test_converts_each_snippet_to_a_document(clients):
+    documents = _retriever(k=2).get_relevant_documents("What is Vertex AI?")
+
+    assert len(documents) == 6
+    assert len({document.metadata["id"] for document in documents}) == 2
+    assert documents[0].metadata["source"].endswith(".pdf:1")
+    assert clients[0].requests == 1
+
+
+def test_the_async_path_uses_a_client_per_event_loop(clients):
+    retriever = _retriever(k=2, cache_max_entries=0)
+
+    async def search():
+        return await asyncio.gather(*(retriever.aget_relevant_documents(query) for query in ("alpha", "beta")))
+
+    first = asyncio.run(search())
+    second = asyncio.run(search())
+
+    assert first == second
+    assert [len(documents) for documents in first] == [6, 6]
+    # The first loop's client is dropped with its loop, the synchronous client is never used
+    sync_client, first_client, second_client = clients
+    assert [first_client.requests, second_client.requests, sync_client.requests] == [2, 2, 0]
+    assert list(retriever.async_clients.values()) == [second_client]
+
+
+@pytest.mark.parametrize("use_async", [False, True])
+def test_merges_the_documents_of_several_queries(clients, use_async):
+    retriever = _retriever(k=2, cache_max_entries=0)
+    alpha, beta = retriever.get_relevant_documents("alpha"), retriever.get_relevant_documents("beta")
+    queries = ["alpha", "beta", "alpha"]
+
+    if use_async:
+        documents = asyncio.run(retriever.aget_relevant_documents_for_queries(queries))
+    else:
+        documents = retriever.get_relevant_documents_for_queries(queries)
+
+    # Duplicates of the same page are dropped, the pages of one document are all kept
+    assert documents == alpha + beta
+    assert len({(document.metadata["id"], document.metadata["source"]) for document in documents}) == 12
+
+
+def test_stops_reading_results_once_the_snippet_budget_is_reached(clients):
+    retriever = _retriever(k=10, max_documents=4)
+
+    documents = retriever.get_relevant_documents("What is Vertex AI?")
+
+    assert len(documents) == 4
+    # The budget needs 2 results of 3 snippets each, no more are read from the 4 requested
+    assert clients[0].results_read == 2
+
+
+def test_caches_results_until_they_expire(clients, monkeypatch):
+    now = [0.0]
+    monkeypatch.setattr(ttl_cache, "time", SimpleNamespace(monotonic=lambda: now[0]))
+    retriever = _retriever(k=2, cache_ttl_seconds=60)
+
+    first = retriever.get_relevant_documents("What is Vertex AI?")
+    assert asyncio.run(retriever.aget_relevant_documents("What is Vertex AI?")) == first
+    # Options changing the results are part of the key
+    retriever.k = 1
+    assert len(retriever.get_relevant_documents("What is Vertex AI?")) == 3
+    retriever.k = 2
+    assert clients[0].requests == 2
+
+    now[0] = 61.0
+    assert retriever.get_relevant_documents("What is Vertex AI?") == first
+    assert clients[0].requests == 3